@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for classify_cloudinary.py
+
+Runs the whole tagging pipeline against a local stand-in for Cloudinary (the
+Admin API listing and the image CDN, including /upload/<transform>/
+derivatives and Range requests), serving synthetic JPEGs with EXIF dates.
+Each library size runs in a fresh subprocess and work directory, and the
+results (with the pipeline's own per-stage metrics) are written as JSON so
+runs can be compared over time.
+
+Usage:
+    python benchmark_classify.py                         # 25, 100 and 400 photos, tiny encoder
+    python benchmark_classify.py --sizes 50 500 --output bench.json
+    python benchmark_classify.py --encoder clip          # Real CLIP weights (downloads once)
+"""
+
+import argparse
+import email.utils
+import hashlib
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+DEFAULT_SIZES = [25, 100, 400]  # Library sizes to benchmark
+DEFAULT_IMAGE_SIZE = (1600, 1067)  # Synthetic originals (3:2, like the camera files)
+BENCHMARK_FOLDERS = ["portfolio", "rugby"]  # Library is split evenly across these
+CLOUD_NAME = "benchmark"
+PAGE_SIZE_LIMIT = 500  # Largest max_results the listing endpoint honours
+RATE_LIMIT = 500  # Reported in the X-FeatureRateLimit-* headers
+
+# ============================================================================
+# SYNTHETIC LIBRARY
+# ============================================================================
+
+def make_photo(seed, size):
+    """
+    Draw a synthetic photo: a smooth two-colour gradient with a few shapes and
+    mild sensor noise, so JPEG sizes and palettes look like real photos
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+
+    top, bottom = rng.integers(0, 256, (2, 3))
+    ramp = np.linspace(0.0, 1.0, height)[:, None, None]
+    pixels = np.broadcast_to(top + (bottom - top) * ramp, (height, width, 3))
+    image = Image.fromarray(pixels.astype(np.uint8))
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.integers(3, 8)):
+        x0, x1 = sorted(rng.integers(0, width, 2))
+        y0, y1 = sorted(rng.integers(0, height, 2))
+        fill = tuple(int(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=fill)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=fill)
+
+    noisy = np.asarray(image, dtype=np.int16) + rng.integers(-6, 7, (height, width, 3))
+    return Image.fromarray(np.clip(noisy, 0, 255).astype(np.uint8))
+
+def build_library(directory, count, size=DEFAULT_IMAGE_SIZE):
+    """
+    Write `count` synthetic JPEGs with EXIF capture dates into `directory`
+
+    Returns:
+        List of asset dicts shaped like Cloudinary's listing resources
+    """
+    os.makedirs(directory, exist_ok=True)
+    start = datetime(2023, 1, 1, 9, 0, 0)
+    assets = []
+
+    for index in range(count):
+        folder = BENCHMARK_FOLDERS[index % len(BENCHMARK_FOLDERS)]
+        public_id = f"{folder}/photo-{index:05d}"
+        path = os.path.join(directory, f"photo-{index:05d}.jpg")
+
+        if not os.path.exists(path):
+            exif = Image.Exif()
+            exif[0x0132] = (start + timedelta(days=index + 30)).strftime("%Y:%m:%d %H:%M:%S")  # DateTime
+            exif.get_ifd(0x8769)[36867] = (start + timedelta(hours=index)).strftime("%Y:%m:%d %H:%M:%S")  # DateTimeOriginal
+            make_photo(index, size).save(path, "JPEG", quality=90, exif=exif.tobytes())
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        assets.append({
+            "public_id": public_id,
+            "asset_folder": folder,
+            "file": path,
+            "format": "jpg",
+            "resource_type": "image",
+            "type": "upload",
+            "version": 1700000000 + index,
+            "created_at": (start + timedelta(days=365, minutes=index)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "width": size[0],
+            "height": size[1],
+            "bytes": len(data),
+            "etag": hashlib.md5(data).hexdigest()
+        })
+
+    return assets
+
+# ============================================================================
+# FAKE CLOUDINARY SERVER
+# ============================================================================
+
+class FakeCloudinary:
+    """
+    Local stand-in for the Cloudinary Admin API and image delivery
+
+    Serves GET /v1_1/<cloud>/resources/by_asset_folder (paged with
+    next_cursor) and /<cloud>/image/upload/[<transform>/]v<version>/<public_id>.jpg.
+    c_limit,w_,h_ transformations are applied and cached; originals honour
+    Range requests. Only the first `library_size` assets are listed.
+    Transferred bytes are counted per kind of request.
+    """
+
+    def __init__(self, assets):
+        self.assets = assets
+        self.library_size = len(assets)
+        self.by_public_id = {asset["public_id"]: asset for asset in assets}
+        self.derivatives = {}
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, kind, size):
+        with self.lock:
+            requests, total = self.counters.get(kind, (0, 0))
+            self.counters[kind] = (requests + 1, total + size)
+
+    def take_counters(self):
+        """Return and reset the per-kind {requests, bytes} counters"""
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        return {kind: {"requests": n, "bytes": size} for kind, (n, size) in counters.items()}
+
+    def secure_url(self, asset):
+        return f"{self.url}/{CLOUD_NAME}/image/upload/v{asset['version']}/{asset['public_id']}.jpg"
+
+    def listing(self, query):
+        folder = query.get("asset_folder", [""])[0]
+        max_results = min(int(query.get("max_results", ["50"])[0]), PAGE_SIZE_LIMIT)
+        start = int(query.get("next_cursor", ["0"])[0] or 0)
+
+        matching = [asset for asset in self.assets[:self.library_size] if asset["asset_folder"] == folder]
+        page = matching[start:start + max_results]
+        body = {"resources": [
+            {key: value for key, value in asset.items() if key != "file"} | {"secure_url": self.secure_url(asset)}
+            for asset in page
+        ]}
+        if start + max_results < len(matching):
+            body["next_cursor"] = str(start + max_results)
+        return body
+
+    def derivative(self, asset, transform):
+        """Apply a c_limit,w_,h_ transformation (other parameters are ignored)"""
+        key = (asset["public_id"], transform)
+        with self.lock:
+            data = self.derivatives.get(key)
+        if data is not None:
+            return data
+
+        params = dict(part.split("_", 1) for part in transform.split(",") if "_" in part)
+        image = Image.open(asset["file"])
+        if params.get("c") == "limit":
+            image.thumbnail((int(params.get("w", image.width)), int(params.get("h", image.height))))
+        buffer = BytesIO()
+        # Cloudinary strips metadata from derivatives, so no EXIF here either
+        image.convert("RGB").save(buffer, "JPEG", quality=90)
+        data = buffer.getvalue()
+
+        with self.lock:
+            self.derivatives[key] = data
+        return data
+
+    def make_handler(self):
+        fake = self
+        image_path = re.compile(rf"^/{CLOUD_NAME}/image/upload/(?:([a-z]_[^/]*)/)?v\d+/(.+)\.jpg$")
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, data, content_type, headers=()):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+
+                if url.path == f"/v1_1/{CLOUD_NAME}/resources/by_asset_folder":
+                    data = json.dumps(fake.listing(parse_qs(url.query))).encode()
+                    reset = email.utils.formatdate(time.time() + 3600, usegmt=True)
+                    fake.count("listing", len(data))
+                    return self.send_body(200, data, "application/json", [
+                        ("X-FeatureRateLimit-Limit", str(RATE_LIMIT)),
+                        ("X-FeatureRateLimit-Remaining", str(RATE_LIMIT - 1)),
+                        ("X-FeatureRateLimit-Reset", reset)
+                    ])
+
+                match = image_path.match(url.path)
+                asset = match and fake.by_public_id.get(match.group(2))
+                if not asset:
+                    return self.send_body(404, b"not found", "text/plain")
+
+                if match.group(1):
+                    data = fake.derivative(asset, match.group(1))
+                    fake.count("derivative", len(data))
+                    return self.send_body(200, data, "image/jpeg")
+
+                with open(asset["file"], "rb") as f:
+                    data = f.read()
+
+                byte_range = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+                if byte_range:
+                    start = int(byte_range.group(1))
+                    end = min(int(byte_range.group(2) or len(data) - 1), len(data) - 1)
+                    fake.count("range", end + 1 - start)
+                    return self.send_body(206, data[start:end + 1], "image/jpeg", [
+                        ("Content-Range", f"bytes {start}-{end}/{len(data)}")
+                    ])
+
+                fake.count("original", len(data))
+                return self.send_body(200, data, "image/jpeg")
+
+        return Handler
+
+# ============================================================================
+# BENCHMARK CHILD (runs the pipeline in its own process)
+# ============================================================================
+
+def run_child(config):
+    """Tag the fake library once and write its timing and memory use to config['result']"""
+    started = time.perf_counter()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import cloudinary
+    import classify_cloudinary
+
+    os.chdir(config["workdir"])
+    with open(".cloudinary-config", "w") as f:
+        json.dump({"cloud_name": CLOUD_NAME, "api_key": "benchmark", "api_secret": "benchmark"}, f)
+    cloudinary.config(upload_prefix=config["server"])
+    import_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    classify_cloudinary.main(config["argv"])
+    seconds = time.perf_counter() - started
+
+    with open("tags.json") as f:
+        tagged = len(json.load(f))
+
+    result = {
+        "tagged": tagged,
+        "seconds": seconds,
+        "import_seconds": import_seconds,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    }
+    with open(config["result"], "w") as f:
+        json.dump(result, f)
+
+# ============================================================================
+# REPORTING
+# ============================================================================
+
+def environment():
+    """Host details that matter when comparing reports"""
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__
+    }
+    try:
+        import torch
+        info["torch"] = torch.__version__
+        info["cuda"] = torch.cuda.is_available()
+    except ImportError:
+        pass
+    return info
+
+def print_report(report):
+    print()
+    print(f"{'photos':>7} {'seconds':>8} {'img/s':>8} {'peak MB':>8}  slowest stages (p50 ms)")
+    for run in report["runs"]:
+        slowest = sorted(run["stages"].items(), key=lambda item: -item[1]["total_seconds"])[:3]
+        stages = ", ".join(f"{name} {stats['p50_ms']:.1f}" for name, stats in slowest)
+        print(f"{run['images']:>7} {run['seconds']:>8.2f} {run['images_per_second']:>8.1f} "
+              f"{run['peak_rss_mb']:>8.0f}  {stages}")
+
+# ============================================================================
+# MAIN
+# ============================================================================
+
+def run_benchmark(args):
+    import classify_cloudinary
+
+    root = tempfile.mkdtemp(prefix="classify-bench-")
+    try:
+        print(f"Generating {max(args.sizes)} synthetic photos ({args.image_size[0]}x{args.image_size[1]})...")
+        assets = build_library(os.path.join(root, "library"), max(args.sizes), args.image_size)
+
+        # Render the derivatives up front so the server's resizing isn't timed as download latency
+        fake = FakeCloudinary(assets).start()
+        if classify_cloudinary.INFERENCE_TRANSFORM:
+            for asset in assets:
+                fake.derivative(asset, classify_cloudinary.INFERENCE_TRANSFORM)
+
+        runs = []
+        for size in args.sizes:
+            fake.library_size = size
+            fake.take_counters()
+            workdir = os.path.join(root, f"run-{size}")
+            os.makedirs(workdir)
+
+            config = {
+                "server": fake.url,
+                "workdir": workdir,
+                "result": os.path.join(workdir, "benchmark-result.json"),
+                "argv": ["tag", *BENCHMARK_FOLDERS, "--encoder", args.encoder,
+                         "--metrics-json", os.path.join(workdir, "metrics.json"),
+                         "--batch-size", str(args.batch_size), "--workers", str(args.workers),
+                         "--processes", str(args.processes), "--engine", args.engine]
+                        + (["--quantize"] if args.quantize else [])
+            }
+
+            print(f"Tagging {size} photos...")
+            log_path = os.path.join(workdir, "pipeline.log")
+            with open(log_path, "w") as log:
+                process = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", json.dumps(config)],
+                    stdout=log, stderr=subprocess.STDOUT
+                )
+            transfer = fake.take_counters()
+
+            if process.returncode != 0:
+                with open(log_path) as log:
+                    print(log.read()[-4000:])
+                sys.exit(f"Benchmark run with {size} photos failed")
+
+            with open(config["result"]) as f:
+                result = json.load(f)
+            # Per-stage timings and counters recorded by the pipeline itself
+            with open(os.path.join(workdir, "metrics.json")) as f:
+                metrics = json.load(f)
+
+            runs.append({
+                "images": size,
+                "tagged": result["tagged"],
+                "seconds": round(result["seconds"], 3),
+                "import_seconds": round(result["import_seconds"], 3),
+                "images_per_second": round(size / result["seconds"], 2),
+                "peak_rss_mb": round(result["peak_rss_mb"], 1),
+                "peak_worker_rss_mb": round(result["peak_worker_rss_mb"], 1),
+                "transfer": transfer,
+                "stages": metrics["stages"],
+                "counters": metrics["counters"],
+                "gauges": metrics.get("gauges", {})
+            })
+
+        report = {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "environment": environment(),
+            "settings": {
+                "encoder": args.encoder,
+                "quantize": args.quantize,
+                "engine": args.engine,
+                "batch_size": args.batch_size,
+                "workers": args.workers,
+                "processes": args.processes,
+                "image_size": list(args.image_size)
+            },
+            "runs": runs
+        }
+        fake.stop()
+    finally:
+        if args.keep:
+            print(f"Work directories kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+    else:
+        print()
+        print(json.dumps(report, indent=2))
+
+def parse_size(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["--child"]:
+        return run_child(json.loads(argv[1]))
+
+    import classify_cloudinary
+
+    parser = argparse.ArgumentParser(description="Benchmark classify_cloudinary.py against a local fake Cloudinary")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help=f"library sizes to run (default: {' '.join(map(str, DEFAULT_SIZES))})")
+    parser.add_argument("--image-size", type=parse_size, default=DEFAULT_IMAGE_SIZE,
+                        help="synthetic original size, WIDTHxHEIGHT (default: 1600x1067)")
+    parser.add_argument("--encoder", choices=sorted(classify_cloudinary.ENCODERS), default="tiny",
+                        help="encoder to run (default: tiny, which needs no weight download)")
+    parser.add_argument("--quantize", action="store_true", help="use the int8 image encoder")
+    parser.add_argument("--engine", choices=["eager", "compiled"], default=classify_cloudinary.ENGINE,
+                        help="inference engine (compiled reports its warm-up speed-up under gauges)")
+    parser.add_argument("--batch-size", type=int, default=classify_cloudinary.BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=classify_cloudinary.DOWNLOAD_WORKERS)
+    parser.add_argument("--processes", type=int, default=classify_cloudinary.PROCESSES,
+                        help="pipeline worker processes")
+    parser.add_argument("--output", metavar="JSON", help="write the report here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the generated library and work directories")
+    run_benchmark(parser.parse_args(argv))
+
+if __name__ == "__main__":
+    main()
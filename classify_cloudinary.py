@@ -4,23 +4,56 @@ Cloudinary Photo Classifier using CLIP
 Automatically tags photos in your Cloudinary account with content, style, lighting, and color labels.
 
 Usage:
-    python classify_cloudinary.py              # Process both portfolio and rugby
-    python classify_cloudinary.py portfolio    # Process only portfolio folder
-    python classify_cloudinary.py rugby        # Process only rugby folder
+    python classify_cloudinary.py                  # Tag both portfolio and rugby
+    python classify_cloudinary.py tag portfolio    # Tag only the portfolio folder
+    python classify_cloudinary.py tag --incremental  # Only new or changed photos, drop deleted ones
+    python classify_cloudinary.py tag --compact    # Also write the compact sharded export to tags/
+    python classify_cloudinary.py tag --atlas      # Also pack texture atlases for zoomed-out views into atlases/
+    python classify_cloudinary.py atlas            # Rebuild the texture atlases from tags.json
+    python classify_cloudinary.py list             # List Cloudinary assets without tagging
+    python classify_cloudinary.py retag            # Recompute tags from stored embeddings only
+    python classify_cloudinary.py stats            # Summarize tags.json and local caches
+    python classify_cloudinary.py search muddy scrum at dusk  # Text search over stored embeddings
+    python classify_cloudinary.py serve            # The same search over HTTP: GET /search?q=...
+    python classify_cloudinary.py tag --quantize   # int8 image encoder on the CPU
+    python classify_cloudinary.py tag --engine compiled  # Compiled, bfloat16 encoder (speed-up in the run summary)
+    python classify_cloudinary.py tag --dedup-distance 6  # Looser near-duplicate matching (-1 disables)
+    python classify_cloudinary.py tag --metrics-prom /var/lib/node_exporter/classify.prom
+    python classify_cloudinary.py parity --local refs/   # Compare int8 and fp32 tags on reference images
+    python classify_cloudinary.py tag --local ~/shoots/2024-05 --url-prefix https://res.cloudinary.com/<cloud>/image/upload/
+    python classify_cloudinary.py tag --manifest photos.csv  # Photos listed in a manifest file
+
+    `python classify_cloudinary.py portfolio` still works as a shortcut for `tag portfolio`.
 """
 
-import torch
-import clip
-from PIL import Image
+import argparse
+import numpy as np
+from PIL import Image, ImageOps
 from PIL.ExifTags import TAGS
 import requests
+from requests.adapters import HTTPAdapter
 from io import BytesIO
 import json
 import cloudinary
 import cloudinary.api
+from cloudinary.exceptions import GeneralError, RateLimited
 from tqdm import tqdm
 import os
 import sys
+import hashlib
+import base64
+import gzip
+import time
+import calendar
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
+from collections import deque
+import multiprocessing
+import mmap
+import csv
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 
 # ============================================================================
@@ -38,16 +71,14 @@ def load_config():
   "api_key": "your_api_key",
   "api_secret": "your_api_secret"
 }''')
+        print('Optionally add "folders": ["portfolio", "rugby"] to choose the asset folders to tag.')
         sys.exit(1)
 
     with open(config_path, 'r') as f:
         return json.load(f)
 
-config = load_config()
-
-CLOUD_NAME = config['cloud_name']
-API_KEY = config['api_key']
-API_SECRET = config['api_secret']
+# Asset folders tagged by default (overridden by "folders" in .cloudinary-config, or --all-folders)
+DEFAULT_FOLDERS = ["portfolio", "rugby"]
 
 # Tagging settings
 TAGS_PER_IMAGE = 5
@@ -55,6 +86,77 @@ STYLE_TAGS_PER_IMAGE = 3
 LIGHTING_TAGS_PER_IMAGE = 2
 COLOR_TAGS_PER_IMAGE = 2
 
+# CLIP settings
+MODEL_NAME = "ViT-B/32"
+ENCODER = "clip"  # "clip" (pretrained MODEL_NAME) or "tiny" (random weights, for tests and benchmarks)
+TINY_MODEL_NAME = "tiny-random"
+ENGINE = "eager"  # "eager" (plain PyTorch) or "compiled" (torch.compile, bfloat16 and channels-last on the CPU)
+ENGINE_WARMUP_RUNS = 3  # Timed warm-up batches per engine when the model loads
+PROMPT_TEMPLATE = "a photo of {label}"
+TEXT_CACHE_DIR = ".clip-cache"  # Encoded label features, reused across runs
+
+# Batched inference settings
+BATCH_SIZE = 32  # Images per CLIP forward pass (halved automatically on out-of-memory)
+
+# CPU sharding settings (for hosts without a GPU)
+PROCESSES = 1  # Worker processes, each with its own copy of the model
+CHUNK_BATCHES = 4  # CLIP batches per task handed to a worker process
+
+# Embedding store settings
+EMBEDDINGS_DIR = "embeddings"  # float16 CLIP image embeddings, keyed by public_id
+STORE_INDEX_INTERVAL = 60  # Seconds between index rewrites during a run; the journal covers the rows in between
+
+# Results journal: finished photos are appended here so an interrupted run can resume
+JOURNAL_PATH = "tags.journal.jsonl"
+
+# Compact export settings
+COMPACT_EXPORT_DIR = "tags"  # Columnar, dictionary-encoded shards of tags.json (one per folder)
+
+# Texture atlas settings (zoomed-out canvas views draw from a few shared textures)
+ATLAS_DIR = "atlases"  # Per-folder atlas pages and each photo's UV rectangle
+ATLAS_SIZE = 2048  # Largest atlas page in pixels (pages are powers of two, so the GPU can mipmap them)
+ATLAS_ROW_HEIGHT = 128  # Height of every photo in an atlas
+ATLAS_PADDING = 2  # Edge pixels repeated around each photo, so mipmaps don't bleed into neighbours
+ATLAS_QUALITY = 85  # JPEG quality of atlas pages
+ATLAS_TRANSFORM = f"c_limit,h_{ATLAS_ROW_HEIGHT},q_90,f_jpg"  # Cloudinary thumbnail for photos not in the cache
+THUMBNAIL_CACHE_DIR = ".thumb-cache"  # Atlas-size thumbnails saved while tagging
+
+# Duplicate detection settings (burst sequences)
+DEDUP_DISTANCE = 4  # Max Hamming distance between 64-bit perceptual hashes to reuse a photo's tags (-1 disables)
+DUPLICATES_PATH = "duplicates.json"  # Duplicate groups of the last run: {original id: [duplicate ids]}
+
+# Similar photo settings
+SIMILAR_PER_PHOTO = 10  # Nearest neighbours written to each tags.json entry
+SIMILARITY_BLOCK_SIZE = 2048  # Rows per block when computing neighbours
+
+# Semantic search settings (IVF-PQ index over the embedding store)
+SEARCH_INDEX_PATH = os.path.join(EMBEDDINGS_DIR, "search-index.npz")  # Rebuilt when the stored photos change
+SEARCH_RESULTS = 20  # Photos returned per query
+SEARCH_PROBES = 32  # Inverted lists scanned per query
+SEARCH_SUBVECTORS = 32  # Product quantizer subspaces, i.e. bytes per photo in the index
+SEARCH_RERANK = 500  # Best quantized candidates re-scored with the exact embeddings
+SEARCH_HOST = "127.0.0.1"
+SEARCH_PORT = 8765
+
+# Cloudinary listing settings
+LISTING_WORKERS = 4  # Asset folders paged concurrently
+LISTING_PAGE_SIZE = 500  # Largest max_results the Admin API allows
+LISTING_RETRIES = 4  # Extra attempts for rate limiting, server and connection errors
+LISTING_BACKOFF = 2.0  # Seconds before the first retry, doubled after each attempt
+LISTING_RATE_RESERVE = 5  # Admin API calls to leave unused before waiting for the rate-limit reset
+
+# Download settings
+DOWNLOAD_WORKERS = 8  # Parallel image downloads
+PREFETCH_IMAGES = 16  # Downloads allowed to run ahead of CLIP processing
+DOWNLOAD_RETRIES = 3  # Extra attempts for timeouts, connection errors and 429/5xx responses
+DOWNLOAD_BACKOFF = 1.0  # Seconds before the first retry, doubled after each attempt
+# Cloudinary transformation for the copy that gets analyzed (same URL rewrite as
+# getPhotoURL in photo-data.js). 512px on the long side keeps CLIP's 224px short
+# side covered for anything up to a 2.3:1 panorama. None downloads originals.
+INFERENCE_TRANSFORM = "c_limit,w_512,h_512,q_90,f_jpg"
+DECODE_MIN_SIDE = 224  # Photos are decoded to this short side (CLIP ViT-B/32's input size)
+EXIF_HEADER_BYTES = 64 * 1024  # Range read from the original for its EXIF capture date
+
 # ============================================================================
 # LABEL SETS
 # ============================================================================
@@ -169,231 +271,1337 @@ COLOR_LABELS = [
     "analogous colors", "colorful", "multicolored"
 ]
 
+# Tagging heads scored from a single image embedding: (result key, labels, tags per image)
+TAG_HEADS = [
+    ("content", CONTENT_LABELS, TAGS_PER_IMAGE),
+    ("style", STYLE_LABELS, STYLE_TAGS_PER_IMAGE),
+    ("lighting", LIGHTING_LABELS, LIGHTING_TAGS_PER_IMAGE),
+    ("colors", COLOR_LABELS, COLOR_TAGS_PER_IMAGE)
+]
+
 # ============================================================================
-# CLOUDINARY SETUP
+# RUN METRICS
 # ============================================================================
 
-cloudinary.config(
-    cloud_name=CLOUD_NAME,
-    api_key=API_KEY,
-    api_secret=API_SECRET
-)
+class Metrics:
+    """
+    Per-stage timings and event counters for one run
 
-def fetch_all_images():
-    """Fetch all images from Cloudinary portfolio and rugby asset folders"""
-    print("Fetching images from Cloudinary...")
-    all_images = []
+    Wrap each pipeline stage in `with get_metrics().stage("name"):` and count
+    events with `get_metrics().count("name", amount)`. Recording a stage costs
+    about a microsecond, so stages can be timed per photo. Download threads
+    record into the same object; worker processes send theirs back with
+    take() and the parent merge()s them.
+    """
 
-    # Fetch from both portfolio and rugby asset folders
-    folders = ["portfolio", "rugby"]
+    def __init__(self):
+        self.started = time.time()
+        self.durations = {}  # Stage name -> list of seconds, one per call
+        self.counters = {}  # Event name -> running total
+        self.gauges = {}  # Measurement name -> last value (e.g. warm-up throughput)
+        self.lock = threading.Lock()
 
-    for folder in folders:
-        print(f"\nFetching from '{folder}' asset folder...")
-        next_cursor = None
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.durations.setdefault(name, []).append(elapsed)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def take(self):
+        """Return everything recorded so far and start over (for worker processes)"""
+        with self.lock:
+            snapshot = {"durations": self.durations, "counters": self.counters, "gauges": self.gauges}
+            self.durations, self.counters, self.gauges = {}, {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add a snapshot from take() to this run's totals"""
+        with self.lock:
+            for name, samples in snapshot["durations"].items():
+                self.durations.setdefault(name, []).extend(samples)
+            for name, amount in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            self.gauges.update(snapshot["gauges"])
+
+    def report(self):
+        """Summarize the run: per-stage call counts, totals and latency percentiles, plus counters"""
+        stages = {}
+        for name, samples in self.durations.items():
+            values = np.asarray(samples)
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stages[name] = {
+                "calls": len(values),
+                "total_seconds": round(float(values.sum()), 4),
+                "mean_ms": round(float(values.mean()) * 1000, 3),
+                "p50_ms": round(float(p50) * 1000, 3),
+                "p90_ms": round(float(p90) * 1000, 3),
+                "p99_ms": round(float(p99) * 1000, 3),
+                "max_ms": round(float(values.max()) * 1000, 3)
+            }
 
-        while True:
-            try:
-                # Use resources_by_asset_folder to access UI-based folders
+        return {
+            "started_at": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "duration_seconds": round(time.time() - self.started, 3),
+            "stages": stages,
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges)
+        }
+
+    def print_summary(self):
+        report = self.report()
+
+        print(f"\nRun summary ({report['duration_seconds']:.1f}s)")
+        print(f"  {'stage':<14} {'calls':>7} {'total s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}")
+        for name, stats in sorted(report["stages"].items(), key=lambda item: -item[1]["total_seconds"]):
+            print(f"  {name:<14} {stats['calls']:>7} {stats['total_seconds']:>9.2f} "
+                  f"{stats['p50_ms']:>9.1f} {stats['p90_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+
+        if report["counters"]:
+            print("  " + ", ".join(f"{name}: {value}" for name, value in sorted(report["counters"].items())))
+        if report["gauges"]:
+            print("  " + ", ".join(f"{name}: {value}" for name, value in sorted(report["gauges"].items())))
+
+    def write_json(self, path):
+        atomic_write(path, json.dumps(self.report(), indent=2).encode('utf-8'))
+
+    def write_prometheus(self, path):
+        """Write the report in the Prometheus textfile format (for node_exporter's textfile collector)"""
+        report = self.report()
+        lines = [
+            "# HELP classify_run_duration_seconds Wall time of the last tagging run.",
+            "# TYPE classify_run_duration_seconds gauge",
+            f"classify_run_duration_seconds {report['duration_seconds']}",
+            "# HELP classify_run_timestamp_seconds Start of the last tagging run.",
+            "# TYPE classify_run_timestamp_seconds gauge",
+            f"classify_run_timestamp_seconds {self.started:.0f}",
+            "# HELP classify_stage_seconds Time spent per pipeline stage in the last run.",
+            "# TYPE classify_stage_seconds summary"
+        ]
+        for name, stats in sorted(report["stages"].items()):
+            for quantile in ("50", "90", "99"):
+                seconds = round(stats[f"p{quantile}_ms"] / 1000, 6)
+                lines.append(f'classify_stage_seconds{{stage="{name}",quantile="0.{quantile}"}} {seconds}')
+            lines.append(f'classify_stage_seconds_sum{{stage="{name}"}} {stats["total_seconds"]}')
+            lines.append(f'classify_stage_seconds_count{{stage="{name}"}} {stats["calls"]}')
+
+        lines += [
+            "# HELP classify_events Events counted in the last run (bytes, retries, skips, failures).",
+            "# TYPE classify_events gauge"
+        ]
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f'classify_events{{event="{name}"}} {value}')
+
+        lines += [
+            "# HELP classify_measurement Measurements taken during the last run (e.g. encoder warm-up throughput).",
+            "# TYPE classify_measurement gauge"
+        ]
+        for name, value in sorted(report["gauges"].items()):
+            lines.append(f'classify_measurement{{name="{name}"}} {value}')
+
+        atomic_write(path, ("\n".join(lines) + "\n").encode('utf-8'))
+
+_metrics = None
+
+def get_metrics():
+    """Get this run's metrics, creating them on first use"""
+    global _metrics
+
+    if _metrics is None:
+        _metrics = Metrics()
+
+    return _metrics
+
+# ============================================================================
+# CLOUDINARY SETUP
+# ============================================================================
+
+class ListingError(Exception):
+    """A folder could not be listed; the run stops rather than tag (or prune) a partial library"""
+
+class RateLimiter:
+    """
+    Shared view of the Admin API rate limit, from the headers of each response
+
+    Once the calls left in the current window drop to the reserve, every
+    listing thread waits for the window to reset instead of running into
+    420/429 errors.
+    """
+
+    def __init__(self, reserve=LISTING_RATE_RESERVE):
+        self.reserve = reserve
+        self.remaining = None
+        self.reset_at = None  # Unix time
+        self.lock = threading.Lock()
+
+    def update(self, response):
+        with self.lock:
+            if response.rate_limit_remaining is not None:
+                self.remaining = response.rate_limit_remaining
+            if response.rate_limit_reset_at is not None:
+                self.reset_at = calendar.timegm(response.rate_limit_reset_at)
+
+    def seconds_until_reset(self):
+        return max(0.0, self.reset_at - time.time()) if self.reset_at else 0.0
+
+    def wait(self):
+        """Block while the rate limit is exhausted (holding the lock, so all threads wait together)"""
+        with self.lock:
+            if self.remaining is None or self.remaining > self.reserve:
+                return
+
+            delay = self.seconds_until_reset()
+            if delay > 0:
+                print(f"  Admin API rate limit nearly used ({self.remaining} calls left), "
+                      f"waiting {delay:.0f}s for it to reset...")
+                time.sleep(delay)
+            self.remaining = None
+
+def list_folder_page(folder, next_cursor, limiter):
+    """Fetch one page of an asset folder, retrying rate limiting and server errors with backoff"""
+    for attempt in range(LISTING_RETRIES + 1):
+        limiter.wait()
+        try:
+            # Use resources_by_asset_folder to access UI-based folders
+            with get_metrics().stage("listing_page"):
                 result = cloudinary.api.resources_by_asset_folder(
                     folder,
-                    max_results=500,
+                    max_results=LISTING_PAGE_SIZE,
                     next_cursor=next_cursor
                 )
+            limiter.update(result)
+            return result
+        except (RateLimited, GeneralError) as e:
+            if attempt == LISTING_RETRIES:
+                raise
+
+            get_metrics().count("listing_retries")
+            delay = LISTING_BACKOFF * (2 ** attempt)
+            if isinstance(e, RateLimited):
+                delay = max(delay, limiter.seconds_until_reset())
+            print(f"  Listing '{folder}' failed ({e}), retrying in {delay:.0f}s...")
+            time.sleep(delay)
+
+def list_folder(folder, pages, limiter, stop):
+    """
+    Page through one asset folder on a listing thread
 
-                folder_images = result.get("resources", [])
+    Each page's resources go onto the `pages` queue as soon as they arrive,
+    followed by None when the folder is done, or by a ListingError.
+    """
+    next_cursor = None
+    try:
+        while not stop.is_set():
+            result = list_folder_page(folder, next_cursor, limiter)
+            pages.put(result.get("resources", []))
 
-                # Add folder information to each image
-                for img in folder_images:
-                    img["folder"] = folder
+            next_cursor = result.get("next_cursor")
+            if not next_cursor:
+                break
+        pages.put(None)
+    except Exception as e:
+        pages.put(ListingError(f"Error fetching images from {folder}: {e}"))
+
+def listing_entry(resource, folder):
+    """Turn an Admin API resource into the image dict used by the pipeline"""
+    # public_id, secure_url, folder, created_at (upload date), dimensions and fingerprint
+    return {
+        "public_id": resource["public_id"],
+        "url": resource["secure_url"],
+        "folder": folder,
+        "created_at": resource.get("created_at", ""),  # Cloudinary upload date
+        "width": resource.get("width"),
+        "height": resource.get("height"),
+        # Fingerprint used by incremental runs to skip unchanged assets
+        "version": resource.get("version"),
+        "bytes": resource.get("bytes"),
+        "etag": resource.get("etag")
+    }
+
+def iter_cloudinary_images(folders):
+    """
+    List Cloudinary asset folders, yielding images as their pages arrive
 
-                all_images.extend(folder_images)
-                next_cursor = result.get("next_cursor")
+    Folders are paged concurrently on LISTING_WORKERS threads, but images are
+    yielded folder by folder in page order, so the listing order (and with it
+    tags.json and the embedding store) is the same on every run. The first
+    page can be tagged while the rest of the listing is still coming in.
 
-                print(f"  Fetched {len(folder_images)} images from '{folder}'")
-                print(f"  Total so far: {len(all_images)} images")
+    Raises:
+        ListingError: A folder could not be listed even after retries
+    """
+    get_context().configure_cloudinary()
 
-                if not next_cursor:
-                    break
-            except Exception as e:
-                print(f"Error fetching images from {folder}: {e}")
-                break
+    limiter = RateLimiter()
+    stop = threading.Event()
+    pages = {folder: queue.Queue() for folder in folders}
 
-    print(f"\nTotal images found: {len(all_images)}")
+    with ThreadPoolExecutor(max_workers=max(1, min(LISTING_WORKERS, len(folders)))) as executor:
+        for folder in folders:
+            executor.submit(list_folder, folder, pages[folder], limiter, stop)
 
-    # Return public_id, secure_url, folder, and created_at (upload date)
-    return [
-        {
-            "public_id": r["public_id"],
-            "url": r["secure_url"],
-            "folder": r.get("folder", "unknown"),
-            "created_at": r.get("created_at", "")  # Cloudinary upload date
-        }
-        for r in all_images
-    ]
+        try:
+            for folder in folders:
+                count = 0
+                while True:
+                    page = pages[folder].get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+
+                    count += len(page)
+                    for resource in page:
+                        yield listing_entry(resource, folder)
+
+                print(f"  Listed {count} images from '{folder}'")
+        finally:
+            # Abandoned or failed: stop the other folders after their current page
+            stop.set()
+
+def fetch_all_images(folders=DEFAULT_FOLDERS):
+    """Fetch the full listing of the given Cloudinary asset folders (portfolio and rugby by default)"""
+    print("Fetching images from Cloudinary...")
+    images = list(iter_cloudinary_images(folders))
+    print(f"\nTotal images found: {len(images)}")
+    return images
+
+def discover_folders():
+    """List the root folders of the Cloudinary account"""
+    get_context().configure_cloudinary()
+
+    folders = []
+    next_cursor = None
+    while True:
+        result = cloudinary.api.root_folders(max_results=LISTING_PAGE_SIZE, next_cursor=next_cursor)
+        folders.extend(folder["path"] for folder in result.get("folders", []))
+        next_cursor = result.get("next_cursor")
+        if not next_cursor:
+            return folders
+
+# ============================================================================
+# IMAGE SOURCES
+# ============================================================================
+
+# Files picked up by LocalSource (and by manifests that point at local files)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff")
+
+class CloudinarySource:
+    """
+    Photos in Cloudinary asset folders, downloaded as small derivatives
+
+    The folders are those named in .cloudinary-config ("folders"), else
+    DEFAULT_FOLDERS; with discover=True, every root folder of the account.
+    """
+
+    def __init__(self, discover=False):
+        self.discover = discover
+        self._folders = None
+
+    def default_folders(self):
+        if self._folders is None:
+            if self.discover:
+                self._folders = discover_folders()
+                print(f"Found folders: {', '.join(self._folders)}")
+            else:
+                self._folders = list(get_context().configure_cloudinary().get("folders") or DEFAULT_FOLDERS)
+        return list(self._folders)
+
+    def list_images(self, folders):
+        return fetch_all_images(folders)
+
+    def iter_images(self, folders):
+        """Yield listed images while the listing is still running"""
+        print("Listing images from Cloudinary...")
+        return iter_cloudinary_images(folders)
+
+    def fetch(self, img_data):
+        """Return (PIL Image or None, EXIF capture date or None) for one listed photo"""
+        return download_photo(img_data)
+
+class LocalSource:
+    """
+    Photos in a directory on disk, for tagging a shoot before it is uploaded
+
+    Each subdirectory is a folder; images directly inside the root belong to
+    a folder named after the root. Public IDs are paths relative to the root
+    without the extension. With url_prefix, URLs are where the files will be
+    served from once uploaded (e.g. a Cloudinary /upload/ URL); otherwise
+    they are file:// URIs.
+    """
+
+    def __init__(self, root, url_prefix=None):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix
+
+    def folder_path(self, folder):
+        return self.root if folder == os.path.basename(self.root) else os.path.join(self.root, folder)
+
+    def default_folders(self):
+        folders = sorted(entry.name for entry in os.scandir(self.root)
+                         if entry.is_dir() and not entry.name.startswith("."))
+        if any(name.lower().endswith(IMAGE_EXTENSIONS) for name in os.listdir(self.root)):
+            folders.insert(0, os.path.basename(self.root))
+        return folders
+
+    def list_images(self, folders):
+        print(f"Listing images in {self.root}...")
+        images = []
+
+        for folder in folders:
+            directory = self.folder_path(folder)
+            if not os.path.isdir(directory):
+                print(f"  No folder '{folder}' in {self.root}")
+                continue
+
+            for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+                if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+
+                relative = Path(os.path.relpath(entry.path, self.root)).as_posix()
+                stat = entry.stat()
+                images.append({
+                    "public_id": os.path.splitext(relative)[0],
+                    "url": self.url_prefix + relative if self.url_prefix else Path(entry.path).as_uri(),
+                    "path": entry.path,
+                    "folder": folder,
+                    # File date; the EXIF capture date replaces it when there is one
+                    "created_at": datetime.fromtimestamp(stat.st_mtime).isoformat(timespec="seconds"),
+                    "width": None,
+                    "height": None,
+                    # Fingerprint used by incremental runs to skip unchanged files
+                    "version": int(stat.st_mtime),
+                    "bytes": stat.st_size,
+                    "etag": None
+                })
+
+        print(f"Total images found: {len(images)}")
+        return images
+
+    def iter_images(self, folders):
+        # Listed in full up front; a list keeps its length for the progress bars
+        return self.list_images(folders)
+
+    def fetch(self, img_data):
+        return read_local_photo(img_data["path"])
+
+class ManifestSource:
+    """
+    Photos listed in a manifest file: a JSON list, JSON lines or CSV
+
+    Each record needs public_id, url and folder, and may carry created_at,
+    width, height, version, bytes and etag. URLs can be http(s) (fetched like
+    Cloudinary photos, as derivatives when they have an /upload/ segment) or
+    local paths, which are read from disk relative to the manifest.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def read_records(self):
+        with open(self.path, newline='') as f:
+            if self.path.endswith(".csv"):
+                return list(csv.DictReader(f))
+            if self.path.endswith(".jsonl"):
+                return [json.loads(line) for line in f if line.strip()]
+            return json.load(f)
+
+    def default_folders(self):
+        folders = []
+        for record in self.read_records():
+            folder = record.get("folder") or "unknown"
+            if folder not in folders:
+                folders.append(folder)
+        return folders
+
+    def list_images(self, folders):
+        images = []
+        for record in self.read_records():
+            folder = record.get("folder") or "unknown"
+            if folder not in folders:
+                continue
+
+            def number(field):
+                value = record.get(field)
+                return int(value) if value not in (None, "") else None
+
+            images.append({
+                "public_id": record["public_id"],
+                "url": record["url"],
+                "folder": folder,
+                "created_at": record.get("created_at") or "",
+                "width": number("width"),
+                "height": number("height"),
+                "version": number("version"),
+                "bytes": number("bytes"),
+                "etag": record.get("etag") or None
+            })
+
+        print(f"Total images found in {os.path.basename(self.path)}: {len(images)}")
+        return images
+
+    def iter_images(self, folders):
+        # Listed in full up front; a list keeps its length for the progress bars
+        return self.list_images(folders)
+
+    def fetch(self, img_data):
+        url = img_data["url"]
+        if url.startswith(("http://", "https://")):
+            return download_photo(img_data)
+
+        path = url[len("file://"):] if url.startswith("file://") else url
+        return read_local_photo(os.path.join(os.path.dirname(self.path), path))
+
+def read_local_photo(path):
+    """
+    Read and decode a photo from disk
+
+    The file is memory-mapped and decoded in place, so no copy of the file is
+    made and JPEG draft decoding only touches the pages it needs.
+
+    Returns:
+        (PIL Image or None, EXIF capture date or None)
+    """
+    metrics = get_metrics()
+
+    try:
+        with open(path, "rb") as f, metrics.stage("read"):
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                metrics.count("bytes_read", len(data))
+                with metrics.stage("decode"):
+                    image = decode_image(data)
+                with metrics.stage("exif"):
+                    data.seek(0)
+                    photo_date = get_photo_date(Image.open(data))
+    except Exception as e:
+        metrics.count("read_failures")
+        print(f"    Error reading {path}: {e}")
+        return None, None
+
+    return image, photo_date
+
+# Where photos come from; Cloudinary unless the command line picks another source
+_source = None
+
+def get_source():
+    """Get the shared image source, creating the Cloudinary source on first use"""
+    global _source
+
+    if _source is None:
+        _source = CloudinarySource()
+
+    return _source
+
+def configure_source(source):
+    """Replace the shared image source"""
+    global _source
+
+    _source = source
+    return _source
 
 # ============================================================================
 # CLIP MODEL
 # ============================================================================
 
-print("Loading CLIP model...")
-
-# Check for GPU availability (NVIDIA CUDA, AMD DirectML, or CPU)
-if torch.cuda.is_available():
-    device = "cuda"
-    print(f"Using device: NVIDIA CUDA GPU")
-    print(f"  GPU Name: {torch.cuda.get_device_name(0)}")
-elif hasattr(torch.version, 'hip') and torch.version.hip is not None:
-    # AMD ROCm support (Linux only)
-    device = "cuda"  # ROCm uses 'cuda' as device string in PyTorch
-    print(f"Using device: AMD ROCm GPU")
-else:
-    device = "cpu"
-    print(f"Using device: CPU")
-
-    # Check if DirectML could be available (Windows AMD/Intel GPUs)
-    import platform
-    if platform.system() == "Windows":
-        try:
-            import torch_directml
-            device = torch_directml.device()
-            print(f"  DirectML device available - using AMD/Intel GPU acceleration")
-        except ImportError:
-            print(f"  No GPU acceleration available")
-            print(f"")
-            print(f"  For AMD GPUs on Windows, install DirectML:")
-            print(f"    pip install torch-directml")
-            print(f"  This enables GPU acceleration for AMD and Intel GPUs on Windows")
+def select_device():
+    """Pick the best available torch device (NVIDIA CUDA, AMD ROCm/DirectML, or CPU)"""
+    import torch
+
+    # Check for GPU availability (NVIDIA CUDA, AMD DirectML, or CPU)
+    if torch.cuda.is_available():
+        device = "cuda"
+        print(f"Using device: NVIDIA CUDA GPU")
+        print(f"  GPU Name: {torch.cuda.get_device_name(0)}")
+    elif hasattr(torch.version, 'hip') and torch.version.hip is not None:
+        # AMD ROCm support (Linux only)
+        device = "cuda"  # ROCm uses 'cuda' as device string in PyTorch
+        print(f"Using device: AMD ROCm GPU")
+    else:
+        device = "cpu"
+        print(f"Using device: CPU")
+
+        # Check if DirectML could be available (Windows AMD/Intel GPUs)
+        import platform
+        if platform.system() == "Windows":
+            try:
+                import torch_directml
+                device = torch_directml.device()
+                print(f"  DirectML device available - using AMD/Intel GPU acceleration")
+            except ImportError:
+                print(f"  No GPU acceleration available")
+                print(f"")
+                print(f"  For AMD GPUs on Windows, install DirectML:")
+                print(f"    pip install torch-directml")
+                print(f"  This enables GPU acceleration for AMD and Intel GPUs on Windows")
+
+    return device
+
+class ClipEncoder:
+    """
+    Image and text encoder used by the tagging pipeline
+
+    Wraps a CLIP-style model. encode_image takes a batch of preprocessed images
+    and encode_text a batch of tokenized prompts, both on the encoder's device.
+    Any model with this interface can be plugged in through ENCODERS.
+    """
+
+    def __init__(self, model, preprocess, device, model_name, quantized=False):
+        self.model = model
+        self.preprocess = preprocess
+        self.device = device
+        self.model_name = model_name  # Embedding space, shared by quantized copies
+        self.quantized = quantized
+
+    def encode_image(self, images):
+        return self.model.encode_image(images)
+
+    def encode_text(self, tokens):
+        return self.model.encode_text(tokens)
+
+    def tokenize(self, texts):
+        import clip
+        return clip.tokenize(texts)
+
+def load_clip_encoder(device):
+    """Load the pretrained CLIP model (downloads weights on first use)"""
+    import clip
+
+    model, preprocess = clip.load(MODEL_NAME, device=device)
+    return ClipEncoder(model, preprocess, device, MODEL_NAME)
+
+def load_tiny_encoder(device):
+    """
+    Build a tiny, randomly initialized CLIP with the real architecture
+
+    Tags are meaningless, but it runs the whole pipeline in seconds with no
+    weight download, which is what tests and benchmarks need.
+    """
+    import torch
+    from clip.model import CLIP
+    from clip.clip import _transform
+
+    torch.manual_seed(0)
+    model = CLIP(
+        embed_dim=64,
+        image_resolution=64, vision_layers=2, vision_width=64, vision_patch_size=16,
+        context_length=77, vocab_size=49408,
+        transformer_width=64, transformer_heads=2, transformer_layers=2
+    )
+    return ClipEncoder(model.to(device).eval(), _transform(64), device, TINY_MODEL_NAME)
+
+def quantize_encoder(encoder):
+    """
+    Make an int8 copy of an encoder for CPU inference
+
+    The vision transformer's Linear layers are dynamically quantized to int8,
+    which is where nearly all of the per-image time goes. The text encoder is
+    left in fp32, so cached label features stay valid.
+    """
+    import copy
+    import torch
+
+    model = copy.deepcopy(encoder.model).float().cpu()
+    model.visual = torch.ao.quantization.quantize_dynamic(
+        model.visual, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return ClipEncoder(model, encoder.preprocess, "cpu", encoder.model_name, quantized=True)
+
+class CompiledEncoder(ClipEncoder):
+    """
+    ClipEncoder whose vision and text towers run through compiled (or traced) graphs
+
+    On the CPU images are fed channels-last and, with torch.compile, the
+    towers run under bfloat16 autocast; features come back in float32 like
+    the eager model's.
+    """
+
+    def __init__(self, encoder, encode_image, encode_text, channels_last, bfloat16, backend):
+        super().__init__(encoder.model, encoder.preprocess, encoder.device, encoder.model_name, encoder.quantized)
+        self._encode_image = encode_image
+        self._encode_text = encode_text
+        self.channels_last = channels_last
+        self.bfloat16 = bfloat16
+        self.backend = backend  # "torch.compile" or "torch.jit.trace"
+
+    def precision(self):
+        import torch
+        return torch.autocast("cpu", dtype=torch.bfloat16) if self.bfloat16 else nullcontext()
+
+    def encode_image(self, images):
+        import torch
+
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        with self.precision():
+            features = self._encode_image(images)
+        return features.float() if self.bfloat16 else features
+
+    def encode_text(self, tokens):
+        with self.precision():
+            features = self._encode_text(tokens)
+        return features.float() if self.bfloat16 else features
+
+def images_per_second(encoder, images, runs=ENGINE_WARMUP_RUNS):
+    """Throughput of encoder.encode_image on one batch, after a first untimed call"""
+    import torch
+
+    def run():
+        encoder.encode_image(images)
+        if images.is_cuda:
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        run()
+        started = time.perf_counter()
+        for _ in range(runs):
+            run()
+    return runs * len(images) / (time.perf_counter() - started)
+
+def compile_encoder(encoder, batch_size=BATCH_SIZE):
+    """
+    Build the compiled inference engine for an encoder, warmed up and timed against eager
+
+    Both towers go through torch.compile, or TorchScript tracing (in float32)
+    where it is unavailable (no C++ compiler, old torch). Warm-up runs a full batch
+    through both, so compilation happens here and not in the first batch.
+    Eager and compiled throughput on that batch are recorded as run metrics.
+    If the compiled engine turns out slower on this host, the eager one is kept.
+    """
+    import torch
+
+    model = encoder.model
+    cpu_fast_path = encoder.device == "cpu" and not encoder.quantized
+
+    resolution = model.visual.input_resolution
+    dtype = next(model.visual.parameters()).dtype if not encoder.quantized else torch.float32
+    images = torch.randn(batch_size, 3, resolution, resolution, device=encoder.device, dtype=dtype)
+    tokens = encoder.tokenize([PROMPT_TEMPLATE.format(label="warm-up")] * 8).to(encoder.device)
+
+    eager_speed = images_per_second(encoder, images)
+    if cpu_fast_path:
+        model.visual.to(memory_format=torch.channels_last)
+
+    try:
+        compiled = CompiledEncoder(
+            encoder, torch.compile(model.visual), torch.compile(model.encode_text),
+            cpu_fast_path, cpu_fast_path, "torch.compile"
+        )
+        speed = images_per_second(compiled, images)
+    except Exception as e:
+        print(f"  torch.compile unavailable ({type(e).__name__}), tracing instead")
+        with torch.no_grad():
+            example = images.contiguous(memory_format=torch.channels_last) if cpu_fast_path else images
+            visual = torch.jit.freeze(torch.jit.trace(model.visual, example).eval())
+            text = torch.jit.trace_module(model, {"encode_text": tokens}).encode_text
+        compiled = CompiledEncoder(encoder, visual, text, cpu_fast_path, False, "torch.jit.trace")
+        speed = images_per_second(compiled, images)
+
+    # Partial batches and other label counts too, so no shape compiles mid-run
+    with torch.no_grad():
+        compiled.encode_image(images[:1])
+        compiled.encode_text(tokens)
+        compiled.encode_text(tokens[:1])
+
+    metrics = get_metrics()
+    metrics.gauge("eager_images_per_second", round(eager_speed, 2))
+    metrics.gauge("compiled_images_per_second", round(speed, 2))
+    metrics.gauge("engine_speedup", round(speed / eager_speed, 2))
+    layout = (", bfloat16" if compiled.bfloat16 else "") + (", channels-last" if compiled.channels_last else "")
+    print(f"  {compiled.backend}{layout}: "
+          f"{speed:.1f} images/s vs {eager_speed:.1f} eager ({speed / eager_speed:.2f}x)")
+
+    if speed < eager_speed:
+        print("  Compiled engine is slower on this host, using eager")
+        if cpu_fast_path:
+            model.visual.to(memory_format=torch.contiguous_format)
+        return encoder
+    return compiled
+
+# Available encoders: name -> (embedding space name, loader)
+ENCODERS = {
+    "clip": (MODEL_NAME, load_clip_encoder),
+    "tiny": (TINY_MODEL_NAME, load_tiny_encoder)
+}
+
+class ClassifierContext:
+    """
+    Cloudinary credentials and CLIP encoder, loaded on first use
+
+    Nothing is read or imported up front, so commands that never need the
+    model (list, stats) start without importing torch or loading CLIP.
+    """
 
-model, preprocess = clip.load("ViT-B/32", device=device)
-print("CLIP model loaded successfully!")
+    def __init__(self, encoder=ENCODER, quantize=False, engine=ENGINE, batch_size=BATCH_SIZE, device=None):
+        self.encoder_name = encoder
+        self.quantize = quantize
+        self.engine = engine
+        self.batch_size = batch_size  # Warm-up batch of the compiled engine
+        self._config = None
+        self._device = device  # None: picked by select_device on first use
+        self._encoder = None
+
+    def configure_cloudinary(self):
+        """Load .cloudinary-config and configure the Cloudinary API"""
+        if self._config is None:
+            self._config = load_config()
+            cloudinary.config(
+                cloud_name=self._config['cloud_name'],
+                api_key=self._config['api_key'],
+                api_secret=self._config['api_secret']
+            )
+        return self._config
+
+    @property
+    def model_name(self):
+        """Embedding space of the encoder; caches and the embedding store are keyed by it"""
+        return ENCODERS[self.encoder_name][0]
+
+    @property
+    def device(self):
+        if self._device is None:
+            if self.quantize:
+                # int8 kernels only run on the CPU
+                self._device = "cpu"
+                print(f"Using device: CPU (int8 quantized encoder)")
+            else:
+                self._device = select_device()
+        return self._device
+
+    @property
+    def encoder(self):
+        self.load_model()
+        return self._encoder
+
+    @property
+    def preprocess(self):
+        return self.encoder.preprocess
+
+    def load_model(self):
+        """Load the encoder (once)"""
+        if self._encoder is None:
+            print(f"Loading CLIP model ({self.encoder_name})...")
+            with get_metrics().stage("model_load"):
+                encoder = ENCODERS[self.encoder_name][1](self.device)
+                if self.quantize:
+                    encoder = quantize_encoder(encoder)
+                if self.engine == "compiled":
+                    encoder = compile_encoder(encoder, self.batch_size)
+            self._encoder = encoder
+            print("CLIP model loaded successfully!")
+
+_context = None
+
+def get_context():
+    """Get the shared classifier context, creating it on first use"""
+    global _context
+
+    if _context is None:
+        _context = ClassifierContext()
+
+    return _context
+
+def configure_context(encoder=ENCODER, quantize=False, engine=ENGINE, batch_size=BATCH_SIZE, device=None):
+    """Replace the shared classifier context, e.g. to pick another encoder from the CLI"""
+    global _context
+
+    _context = ClassifierContext(encoder, quantize, engine, batch_size, device)
+    return _context
 
 # ============================================================================
 # CLIP TAGGING FUNCTIONS
 # ============================================================================
 
-def get_clip_tags(image, labels, top_k):
+# Label features already loaded in this run, keyed by cache key
+_label_features = {}
+
+def label_cache_key(labels):
+    """
+    Build the text cache key for a label set
+
+    The key covers the model name, the prompt template and a hash of the labels,
+    so editing any of them invalidates only the affected label set.
     """
-    Get top-k labels for an image using CLIP similarity scoring
+    labels_hash = hashlib.sha256("\n".join(labels).encode("utf-8")).hexdigest()
+    key_source = "\n".join([get_context().model_name, PROMPT_TEMPLATE, labels_hash])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()[:16]
+
+def get_label_features(labels):
+    """
+    Get normalized CLIP text features for a label set
+
+    Features are encoded once, then loaded from TEXT_CACHE_DIR on later runs.
 
     Args:
-        image: PIL Image
         labels: List of label strings
-        top_k: Number of top labels to return
 
     Returns:
-        List of top-k label strings
+        Tensor of normalized text features, one row per label
     """
-    try:
-        # Preprocess image
-        image_input = preprocess(image).unsqueeze(0).to(device)
+    import torch
 
-        # Tokenize labels
-        text_inputs = clip.tokenize([f"a photo of {label}" for label in labels]).to(device)
+    key = label_cache_key(labels)
+    if key in _label_features:
+        return _label_features[key]
 
-        # Get features
-        with torch.no_grad():
-            image_features = model.encode_image(image_input)
-            text_features = model.encode_text(text_inputs)
+    ctx = get_context()
+
+    cache_path = os.path.join(TEXT_CACHE_DIR, f"text-{key}.pt")
+    text_features = None
+
+    if os.path.exists(cache_path):
+        try:
+            text_features = torch.load(cache_path, map_location="cpu")["features"].to(ctx.device)
+        except Exception as e:
+            print(f"    Ignoring unreadable text cache {cache_path}: {e}")
 
-            # Normalize
-            image_features /= image_features.norm(dim=-1, keepdim=True)
+    if text_features is None:
+        encoder = ctx.encoder
+        text_inputs = encoder.tokenize([PROMPT_TEMPLATE.format(label=label) for label in labels]).to(encoder.device)
+        with torch.no_grad():
+            # The eager text tower: features cached under this key must not depend on
+            # the engine (a compiled one may run in bfloat16)
+            text_features = encoder.model.encode_text(text_inputs)
             text_features /= text_features.norm(dim=-1, keepdim=True)
 
-            # Calculate similarity
-            similarity = (image_features @ text_features.T).squeeze(0)
+        # Write to a temp file first so an interrupted run never leaves a broken cache
+        os.makedirs(TEXT_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        torch.save({
+            "model": ctx.model_name,
+            "template": PROMPT_TEMPLATE,
+            "labels": labels,
+            "features": text_features.cpu()
+        }, tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    _label_features[key] = text_features
+    return text_features
+
+def is_out_of_memory(error):
+    """Check whether an exception was raised because the device ran out of memory"""
+    return isinstance(error, MemoryError) or 'out of memory' in str(error).lower()
+
+def encode_images(image_inputs, batch_size=BATCH_SIZE, encoder=None):
+    """
+    Encode preprocessed images with CLIP, several images per forward pass
 
-        # Get top-k
-        values, indices = similarity.topk(top_k)
+    Args:
+        image_inputs: List of preprocessed image tensors (output of `preprocess`)
+        batch_size: Maximum number of images per forward pass
+        encoder: Encoder to use (default: the shared context's encoder)
 
-        return [labels[i] for i in indices.cpu().numpy()]
-    except Exception as e:
-        print(f"    Error in CLIP tagging: {e}")
-        return []
+    Returns:
+        Tensor of normalized image features, one row per input image
+    """
+    import torch
+
+    encoder = encoder or get_context().encoder
+    features = []
+    start = 0
+
+    while start < len(image_inputs):
+        batch = torch.stack(image_inputs[start:start + batch_size]).to(encoder.device)
+
+        try:
+            with torch.no_grad():
+                batch_features = encoder.encode_image(batch)
+        except (RuntimeError, MemoryError) as e:
+            if not is_out_of_memory(e) or batch_size == 1:
+                raise
+
+            # Retry the same images with a smaller batch
+            del batch
+            if encoder.device == "cuda":
+                torch.cuda.empty_cache()
+            batch_size = max(1, batch_size // 2)
+            get_metrics().count("oom_retries")
+            print(f"    Out of memory, retrying with batch size {batch_size}")
+            continue
+
+        batch_features /= batch_features.norm(dim=-1, keepdim=True)
+        features.append(batch_features)
+        start += len(batch)
+
+    return torch.cat(features)
+
+# Stacked label features of all TAG_HEADS and each head's row range, per embedding space
+_head_features = {}
+
+def get_head_features():
+    """
+    Stack the label features of every tagging head into one matrix
+
+    Returns:
+        Tuple of (features tensor, list of (start, end) row ranges per head)
+    """
+    import torch
+
+    model_name = get_context().model_name
+    if model_name not in _head_features:
+        features = [get_label_features(labels) for _, labels, _ in TAG_HEADS]
+
+        segments = []
+        start = 0
+        for head_features in features:
+            segments.append((start, start + len(head_features)))
+            start += len(head_features)
+
+        _head_features[model_name] = (torch.cat(features), segments)
+
+    return _head_features[model_name]
+
+def tag_image_features(image_features):
+    """
+    Get the top-k labels of every tagging head for encoded images
+
+    Each image is scored against all heads with one matrix product, then the
+    similarity row is split back into per-head segments for top-k.
+
+    Args:
+        image_features: Tensor of normalized image features (output of encode_images)
+
+    Returns:
+        List of {head name: [labels]} dicts, one per image
+    """
+    text_features, segments = get_head_features()
+    similarity = image_features @ text_features.to(image_features.dtype).T
+
+    tags = [{} for _ in range(len(similarity))]
+    for (name, labels, top_k), (start, end) in zip(TAG_HEADS, segments):
+        values, indices = similarity[:, start:end].topk(top_k, dim=-1)
+        for image_tags, row in zip(tags, indices.cpu().numpy()):
+            image_tags[name] = [labels[i] for i in row]
+
+    return tags
+
+# Shared HTTP session so every download reuses pooled connections
+_session = None
+_session_pool_size = 0
+
+def get_session(pool_size=DOWNLOAD_WORKERS):
+    """
+    Get the shared requests session, with one pooled connection per download worker
+
+    Callers that start a thread pool pass its size first, so the connection
+    pool grows to match and no connection is discarded for lack of room.
+    """
+    global _session, _session_pool_size
+
+    if _session is None:
+        _session = requests.Session()
+
+    if pool_size > _session_pool_size:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+        _session_pool_size = pool_size
+
+    return _session
+
+def is_retryable_download_error(error):
+    """Check whether a failed download is worth retrying (network trouble, throttling, server errors)"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+def get_with_retries(url, retries=DOWNLOAD_RETRIES, **kwargs):
+    """GET a URL, retrying transient failures with backoff; returns the response or None"""
+    for attempt in range(retries + 1):
+        try:
+            response = get_session().get(url, timeout=10, **kwargs)
+            response.raise_for_status()
+            return response
+        except Exception as e:
+            if attempt == retries or not is_retryable_download_error(e):
+                get_metrics().count("download_failures")
+                print(f"    Error downloading image: {e}")
+                return None
+
+            get_metrics().count("download_retries")
+            delay = DOWNLOAD_BACKOFF * (2 ** attempt)
+            print(f"    Download failed ({e}), retrying in {delay:.0f}s...")
+            time.sleep(delay)
+
+def download_bytes(url, retries=DOWNLOAD_RETRIES):
+    """Download a file and return its contents, retrying transient failures with backoff"""
+    response = get_with_retries(url, retries)
+    if response is None:
+        return None
+
+    get_metrics().count("bytes_downloaded", len(response.content))
+    return response.content
+
+def decode_image(data, min_side=DECODE_MIN_SIDE):
+    """
+    Decode an image straight to the working size shared by every later stage
+
+    JPEGs are decoded with DCT scaling (draft mode) at 1/2, 1/4 or 1/8 size,
+    the smallest that still keeps the short side >= min_side, so the
+    full-resolution bitmap is never built. One resize then brings the short
+    side to exactly min_side, which CLIP's preprocess leaves as is and which
+    get_pixel_array thumbnails further for the colour statistics.
+
+    Photos are turned upright by their EXIF orientation (Cloudinary
+    derivatives have none left, local files and manifest originals can).
+
+    Args:
+        data: Encoded image as bytes, or a readable file object such as an mmap
+        min_side: Short side of the working image
+
+    Returns:
+        RGB PIL Image, with the file's own upright size in info["original_size"]
+    """
+    image = Image.open(data if hasattr(data, "read") else BytesIO(data))
+    original_size = image.size
+    image.draft('RGB', (min_side, min_side))  # No-op for formats other than JPEG
+    image.load()  # Decode now, while the data is still available
+
+    # Orientations 5-8 turn the photo a quarter, swapping its sides
+    if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        original_size = original_size[::-1]
+    image = ImageOps.exif_transpose(image)
+
+    # Convert to RGB if necessary
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    width, height = image.size
+    short_side, long_side = min(width, height), max(width, height)
+    if short_side > min_side:
+        # Same rounding as CLIP's Resize, so preprocess doesn't resample again
+        long_side = int(min_side * long_side / short_side)
+        size = (min_side, long_side) if width <= height else (long_side, min_side)
+        image = image.resize(size, Image.BICUBIC)
+
+    image.info["original_size"] = original_size
+    return image
+
+def derivative_url(url, transform=INFERENCE_TRANSFORM):
+    """
+    Insert a Cloudinary transformation into a delivery URL
+
+    URL format: https://res.cloudinary.com/{cloud}/image/upload/{public_id}
+    URLs without an /upload/ segment (or transform=None) are returned unchanged.
+    """
+    if not transform:
+        return url
+    return url.replace('/upload/', f'/upload/{transform}/', 1)
+
+def read_header_bytes(url, size):
+    """Read the first `size` bytes of a file with an HTTP Range request"""
+    response = get_with_retries(url, headers={"Range": f"bytes=0-{size - 1}"}, stream=True)
+    if response is None:
+        return b""
 
-def download_image(url):
-    """Download image from URL and return PIL Image"""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content))
+        # A server that ignores Range sends the whole file; stop reading after `size` bytes
+        data = response.raw.read(size, decode_content=True)
+        get_metrics().count("bytes_downloaded", len(data))
+        return data
+    finally:
+        response.close()
+
+def find_exif_segment(data):
+    """
+    Locate the EXIF payload in the start of a JPEG file
+
+    Walks the marker segments up to the first scan. Returns the payload's
+    (start, end) offsets, or None if there is no EXIF (or the file isn't a
+    JPEG). If data stops before the answer is known, start is None and end
+    is how many bytes are needed to get further.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
 
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+    pos = 2
+    while True:
+        if pos + 10 > len(data):
+            return None, pos + 10
+        if data[pos] != 0xFF:
+            return None
 
-        return image
-    except Exception as e:
-        print(f"    Error downloading image: {e}")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1  # Fill byte
+            continue
+        if marker in (0xDA, 0xD9):
+            return None  # Start of scan or end of image: no EXIF in the header
+
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        if marker == 0xE1 and data[pos + 4:pos + 10] == b"Exif\x00\x00":
+            return pos + 10, pos + 2 + length
+        pos += 2 + length
+
+def read_exif_date(url, header_bytes=EXIF_HEADER_BYTES):
+    """
+    Get the capture date from an image's EXIF, downloading only the file header
+
+    Only JPEG headers are parsed here. Other formats (TIFF, WebP, HEIC), and
+    JPEGs whose EXIF sits beyond what is worth reading in ranges, fall back
+    to downloading the whole original and letting PIL find the EXIF.
+    """
+    data = read_header_bytes(url, header_bytes)
+    if not data:
+        return None
+    if data[:2] != b"\xff\xd8":
+        return read_full_exif_date(url)
+
+    for _ in range(3):
+        segment = find_exif_segment(data)
+        if segment is None:
+            return None  # Reached the first scan: the JPEG has no EXIF
+
+        start, end = segment
+        if start is not None and end <= len(data):
+            break
+
+        # Large segments (ICC profile, EXIF thumbnail) ran past the first read
+        size = max(end, 2 * len(data))
+        if len(data) < header_bytes:
+            return None  # Whole file already read
+        if size > 16 * header_bytes:
+            return read_full_exif_date(url)  # Not worth chasing in ranges
+        data = read_header_bytes(url, size)
+        header_bytes = size
+    else:
+        return read_full_exif_date(url)
+
+    try:
+        exif = Image.Exif()
+        exif.load(data[start:end])
+        return exif_capture_date(exif)
+    except Exception:
         return None
 
-def calculate_saturation(image):
-    """Calculate the average saturation of an image to determine if it's truly grayscale"""
+def read_full_exif_date(url):
+    """Get the capture date from an image's EXIF, downloading the whole file"""
+    get_metrics().count("exif_full_downloads")
+    data = download_bytes(url)
+    if data is None:
+        return None
     try:
-        import numpy as np
-        from colorsys import rgb_to_hsv
+        return get_photo_date(Image.open(BytesIO(data)))
+    except Exception:
+        return None  # A format PIL can't open, such as HEIC without its plugin
 
-        # Resize for faster processing
-        img = image.copy()
-        img.thumbnail((150, 150))
+def download_photo(img_data):
+    """
+    Download what the pipeline needs for one photo
 
-        # Convert to numpy array
-        pixels = np.array(img).reshape(-1, 3) / 255.0  # Normalize to 0-1
+    Pixels come from a small Cloudinary derivative, decoded once to the
+    working size (see decode_image). Derivatives have their metadata
+    stripped, so the capture date comes from a Range read of the original's
+    header instead (or the whole original, see read_exif_date).
 
-        # Calculate saturation for each pixel
-        saturations = []
-        for pixel in pixels:
-            _, s, _ = rgb_to_hsv(pixel[0], pixel[1], pixel[2])
-            saturations.append(s)
+    Returns:
+        (PIL Image or None, EXIF capture date or None)
+    """
+    metrics = get_metrics()
+    url = img_data["url"]
+    small_url = derivative_url(url, INFERENCE_TRANSFORM)
 
-        # Return average saturation (0 = grayscale, 1 = fully saturated)
-        return np.mean(saturations)
-    except Exception as e:
-        print(f"    Error calculating saturation: {e}")
-        return 0.5  # Default to assuming color
+    with metrics.stage("download"):
+        data = download_bytes(small_url)
+    if data is None:
+        return None, None
 
-def get_color_palette(image, num_colors=5):
-    """Extract color palette from image using k-means clustering"""
     try:
-        # Resize for faster processing
-        img = image.copy()
-        img.thumbnail((150, 150))
+        with metrics.stage("decode"):
+            image = decode_image(data)
+    except Exception as e:
+        metrics.count("decode_failures")
+        print(f"    Error decoding image: {e}")
+        return None, None
+
+    with metrics.stage("exif"):
+        if small_url == url:
+            # Opening only parses the header, which is all get_photo_date reads
+            photo_date = get_photo_date(Image.open(BytesIO(data)))
+        else:
+            photo_date = read_exif_date(url)
 
-        # Convert to numpy array and reshape
-        import numpy as np
-        from sklearn.cluster import KMeans
+    return image, photo_date
 
-        pixels = np.array(img).reshape(-1, 3)
+def prefetch_images(images, workers=DOWNLOAD_WORKERS, prefetch=PREFETCH_IMAGES):
+    """
+    Fetch photos from the image source on a worker pool, yielding them in listing order
 
-        # Use k-means to find dominant colors
-        kmeans = KMeans(n_clusters=num_colors, random_state=42, n_init=10)
-        kmeans.fit(pixels)
+    While image N is being processed, images N+1..N+prefetch download in the
+    background. No more than `prefetch` downloads are queued at once, so memory
+    stays bounded however large the library is.
 
-        # Get cluster centers (the dominant colors)
-        colors = kmeans.cluster_centers_
+    Args:
+        images: List of image dicts from the source's list_images
+        workers: Number of download threads
+        prefetch: Maximum number of downloads running ahead of the consumer
 
-        # Count pixels in each cluster to get color weights
-        labels = kmeans.labels_
-        counts = np.bincount(labels)
+    Yields:
+        (img_data, PIL Image or None, EXIF capture date or None) tuples
+    """
+    source = get_source()
+    get_session(workers)  # One pooled connection per download thread
+    image_iter = iter(images)
+    in_flight = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit_next():
+            img_data = next(image_iter, None)
+            if img_data is not None:
+                in_flight.append((img_data, executor.submit(source.fetch, img_data)))
+
+        for _ in range(max(1, prefetch)):
+            submit_next()
+
+        while in_flight:
+            img_data, future = in_flight.popleft()
+            submit_next()
+            yield (img_data, *future.result())
+
+# Thumbnail size used for saturation and palette statistics
+COLOR_STATS_SIZE = 150
+
+def get_pixel_array(image, size=COLOR_STATS_SIZE):
+    """Thumbnail an image once and return its pixels as an (N, 3) uint8 array"""
+    img = image.copy()
+    img.thumbnail((size, size))
+    return np.asarray(img, dtype=np.uint8).reshape(-1, 3)
+
+def calculate_saturation(pixels):
+    """
+    Calculate the average saturation of an image to determine if it's truly grayscale
 
-        # Sort by frequency (most common first)
-        indices = np.argsort(-counts)
+    Vectorized equivalent of averaging colorsys.rgb_to_hsv saturation over all pixels.
 
-        # Return colors sorted by frequency
-        palette = [
-            {
-                'r': int(colors[i][0]),
-                'g': int(colors[i][1]),
-                'b': int(colors[i][2]),
-                'weight': float(counts[i] / len(labels))
-            }
-            for i in indices
-        ]
+    Args:
+        pixels: (N, 3) uint8 pixel array from get_pixel_array
+
+    Returns:
+        Average saturation (0 = grayscale, 1 = fully saturated)
+    """
+    try:
+        maxc = pixels.max(axis=1).astype(np.float64)
+        minc = pixels.min(axis=1).astype(np.float64)
 
-        return palette
+        # HSV saturation is (max - min) / max, and 0 for black pixels
+        saturations = np.divide(maxc - minc, maxc, out=np.zeros_like(maxc), where=maxc > 0)
+
+        return float(saturations.mean())
     except Exception as e:
-        print(f"    Error extracting color palette: {e}")
-        # Return default gray palette
-        return [{'r': 128, 'g': 128, 'b': 128, 'weight': 1.0}]
+        print(f"    Error calculating saturation: {e}")
+        return 0.5  # Default to assuming color
 
 def filter_bw_tags(color_tags, saturation):
     """
@@ -429,8 +1637,21 @@ def get_photo_date(image):
     """Extract the date the photo was taken from EXIF metadata"""
     try:
         # Get EXIF data
-        exif_data = image._getexif()
+        return exif_capture_date(image.getexif())
+    except Exception as e:
+        # print(f"    Error extracting EXIF date: {e}")
+        return None
+
+def exif_capture_date(exif):
+    """Get the capture date from a PIL Exif, whatever format it was read from"""
+    # Capture dates live in the Exif sub-IFD, DateTime in the main IFD
+    exif_data = dict(exif)
+    exif_data.update(exif.get_ifd(0x8769))
+    return parse_exif_date(exif_data)
 
+def parse_exif_date(exif_data):
+    """Get the capture date from a {tag id: value} EXIF dict"""
+    try:
         if exif_data is None:
             return None
 
@@ -468,93 +1689,1544 @@ def get_photo_date(image):
         return None
 
 # ============================================================================
-# MAIN PROCESSING
+# COLOR PALETTE ENGINE
 # ============================================================================
 
-def process_all_images():
-    """Main function to process all images"""
+# Palette settings
+PALETTE_COLORS = 5
+PALETTE_MODE = "histogram"  # "histogram" (fast, batched) or "kmeans" (per image, needs scikit-learn)
+PALETTE_BITS = 4  # Bits kept per channel when quantizing pixels (2^12 = 4096 color bins)
+PALETTE_ITERATIONS = 20
+PALETTE_SEED = 42
 
-    # Fetch images from Cloudinary
-    images = fetch_all_images()
+DEFAULT_PALETTE = [{'r': 128, 'g': 128, 'b': 128, 'weight': 1.0}]
 
-    if not images:
-        print("No images found!")
-        return
+def build_color_histograms(pixel_buffers, bits=PALETTE_BITS):
+    """
+    Quantize pixel buffers into per-image color histograms with one bincount
 
-    print(f"\nProcessing {len(images)} images with CLIP tagging...")
-    print("=" * 60)
+    Args:
+        pixel_buffers: List of (N, 3) uint8 pixel arrays from get_pixel_array
+        bits: Bits kept per channel
 
-    results = {}
+    Returns:
+        Tuple of (bin colors (images, bins, 3), bin pixel counts (images, bins)),
+        where each bin's color is the mean of the pixels that fell into it
+    """
+    num_bins = 1 << (3 * bits)
+    shift = 8 - bits
+
+    # Offset every image's bin indices so all images share one flat histogram
+    bin_indices = []
+    for i, pixels in enumerate(pixel_buffers):
+        q = (pixels >> shift).astype(np.int64)
+        bin_indices.append(i * num_bins + ((q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]))
+    bin_indices = np.concatenate(bin_indices)
+    all_pixels = np.concatenate(pixel_buffers).astype(np.float64)
+
+    size = len(pixel_buffers) * num_bins
+    counts = np.bincount(bin_indices, minlength=size)
+    sums = np.stack([
+        np.bincount(bin_indices, weights=all_pixels[:, c], minlength=size)
+        for c in range(3)
+    ], axis=-1)
+
+    colors = sums / np.maximum(counts, 1)[:, None]
+    return colors.reshape(len(pixel_buffers), num_bins, 3), counts.reshape(len(pixel_buffers), num_bins).astype(np.float64)
+
+def sample_rows(weights, draw):
+    """Pick one column index per row, with probability proportional to the row's weights"""
+    cumulative = np.cumsum(weights, axis=1)
+    targets = draw * cumulative[:, -1]
+    indices = (cumulative <= targets[:, None]).sum(axis=1)
+    return np.minimum(indices, weights.shape[1] - 1)
+
+def weighted_kmeans(colors, weights, num_colors, iterations=PALETTE_ITERATIONS, seed=PALETTE_SEED):
+    """
+    Run weighted k-means on many images' color histograms at once
+
+    Centers are initialized with k-means++ from a fixed seed. Every image uses
+    the same random draws, so a palette doesn't depend on which other images
+    share its batch, and is the same from run to run.
+
+    Args:
+        colors: Bin colors (images, bins, 3)
+        weights: Bin pixel counts (images, bins)
+        num_colors: Clusters per image
+
+    Returns:
+        Tuple of (centers (images, k, 3), cluster pixel counts (images, k))
+    """
+    draws = np.random.default_rng(seed).random(num_colors)
+    rows = np.arange(len(colors))
+
+    # k-means++ initialization, vectorized across images
+    centers = np.empty((len(colors), num_colors, 3))
+    centers[:, 0] = colors[rows, sample_rows(weights, draws[0])]
+    closest = ((colors - centers[:, None, 0]) ** 2).sum(axis=-1)
+    for j in range(1, num_colors):
+        centers[:, j] = colors[rows, sample_rows(weights * closest, draws[j])]
+        closest = np.minimum(closest, ((colors - centers[:, None, j]) ** 2).sum(axis=-1))
+
+    flat_weights = weights.ravel()
+    flat_colors = colors.reshape(-1, 3)
+    size = len(colors) * num_colors
+
+    def assign(centers):
+        distances = ((colors[:, :, None, :] - centers[:, None, :, :]) ** 2).sum(axis=-1)
+        flat = (rows[:, None] * num_colors + distances.argmin(axis=-1)).ravel()
+        cluster_weights = np.bincount(flat, weights=flat_weights, minlength=size)
+        cluster_sums = np.stack([
+            np.bincount(flat, weights=flat_weights * flat_colors[:, c], minlength=size)
+            for c in range(3)
+        ], axis=-1)
+        return cluster_weights.reshape(-1, num_colors), cluster_sums.reshape(-1, num_colors, 3)
+
+    # Lloyd iterations; empty clusters keep their previous center, and each
+    # image stops updating once it converges (independently of the others)
+    active = np.ones(len(colors), dtype=bool)
+    for _ in range(iterations):
+        cluster_weights, cluster_sums = assign(centers)
+        new_centers = np.where(
+            cluster_weights[..., None] > 0,
+            cluster_sums / np.maximum(cluster_weights, 1)[..., None],
+            centers
+        )
+        converged = np.isclose(new_centers, centers, atol=0.5).all(axis=(1, 2))
+        centers = np.where(active[:, None, None], new_centers, centers)
+        active &= ~converged
+        if not active.any():
+            break
+
+    cluster_weights, _ = assign(centers)
+    return centers, cluster_weights
+
+def kmeans_palette(pixels, num_colors=PALETTE_COLORS):
+    """Extract a palette from one image with scikit-learn KMeans (original, slower method)"""
+    from sklearn.cluster import KMeans
+
+    # Use k-means to find dominant colors
+    kmeans = KMeans(n_clusters=num_colors, random_state=PALETTE_SEED, n_init=10)
+    kmeans.fit(pixels)
+
+    # Count pixels in each cluster to get color weights
+    counts = np.bincount(kmeans.labels_, minlength=num_colors)
+    return kmeans.cluster_centers_, counts
+
+def get_color_palettes(pixel_buffers, num_colors=PALETTE_COLORS):
+    """
+    Extract color palettes for a batch of images
+
+    Args:
+        pixel_buffers: List of (N, 3) uint8 pixel arrays from get_pixel_array
+        num_colors: Number of dominant colors per image
+
+    Returns:
+        List of palettes, each a list of {r, g, b, weight} dicts sorted by weight
+    """
+    if not pixel_buffers:
+        return []
+
+    try:
+        if PALETTE_MODE == "kmeans":
+            clustered = [kmeans_palette(pixels, num_colors) for pixels in pixel_buffers]
+        else:
+            colors, weights = build_color_histograms(pixel_buffers)
+            centers, cluster_weights = weighted_kmeans(colors, weights, num_colors)
+            clustered = zip(centers, cluster_weights)
+
+        palettes = []
+        for colors, counts in clustered:
+            # Sort by frequency (most common first), dropping empty clusters
+            indices = [i for i in np.argsort(-counts, kind="stable") if counts[i] > 0]
+            palettes.append([
+                {
+                    'r': int(colors[i][0]),
+                    'g': int(colors[i][1]),
+                    'b': int(colors[i][2]),
+                    'weight': float(counts[i] / counts.sum())
+                }
+                for i in indices
+            ])
+
+        return palettes
+    except Exception as e:
+        print(f"    Error extracting color palette: {e}")
+        # Return default gray palettes
+        return [list(DEFAULT_PALETTE) for _ in pixel_buffers]
+
+# ============================================================================
+# EMBEDDING STORE
+# ============================================================================
+
+class EmbeddingStore:
+    """
+    Compact on-disk store of normalized CLIP image embeddings
+
+    Embeddings live in one memory-mapped float16 matrix (vectors.f16) with a
+    JSON index mapping each public_id to its row, Cloudinary version and
+    saturation. Changed photos overwrite their row, new photos are appended.
+    With model_name=None the store is opened with whatever model built it.
+
+    Rows are flushed batch by batch, but the index only now and then; rows
+    written after the last index save are recovered from the journal (see
+    restore). The index's generation names the current vectors file, so a
+    journal never restores rows into a file that has since started over.
+    """
+
+    def __init__(self, directory=EMBEDDINGS_DIR, model_name=MODEL_NAME):
+        self.directory = directory
+        self.model_name = model_name
+        self.vectors_path = os.path.join(directory, "vectors.f16")
+        self.index_path = os.path.join(directory, "index.json")
+
+        self.dim = None
+        self.ids = {}  # public_id -> {"row", "version", "saturation"}
+        self.pending = {}  # row -> float16 vector not yet written
+        self.rows = 0
+        self.reset = False
+        self.generation = None  # Set once the vectors file's index is on disk
+        self.dirty = False  # Index changed since it was last written
+        self.index_saved_at = time.monotonic()
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+
+            if model_name is None or index.get("model") == model_name:
+                self.model_name = index.get("model")
+                self.dim = index["dim"]
+                self.ids = index["ids"]
+                self.rows = index["rows"]
+                self.generation = index.get("generation")
+            else:
+                # Embeddings from another model can't be mixed with new ones
+                print(f"Embedding store was built with {index.get('model')}, starting a new one")
+                self.reset = True
+
+    def __contains__(self, public_id):
+        return public_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def vectors(self):
+        """Memory-map the stored embeddings as a read-only (rows, dim) float16 array"""
+        if self.rows == 0 or self.reset:
+            return np.zeros((0, self.dim or 0), dtype=np.float16)
+        return np.memmap(self.vectors_path, dtype=np.float16, mode='r', shape=(self.rows, self.dim))
+
+    def get(self, public_ids, version=None, dtype=np.float32):
+        """
+        Get embeddings for a list of public_ids as a (len(public_ids), dim) array
+
+        If version is given, a stored embedding of another version counts as missing.
+        Raises KeyError for missing ids.
+        """
+        rows = []
+        for public_id in public_ids:
+            entry = self.ids[public_id]
+            if version is not None and entry["version"] != version:
+                raise KeyError(public_id)
+            rows.append(entry["row"])
+
+        vectors = self.vectors()
+        return np.stack([
+            self.pending[row] if row in self.pending else vectors[row]
+            for row in rows
+        ]).astype(dtype)
+
+    def put(self, public_id, version, embedding, saturation):
+        """Add or replace the embedding of a photo (written on save)"""
+        if self.dim is None:
+            self.dim = len(embedding)
+
+        entry = self.ids.get(public_id)
+        if entry is None:
+            entry = {"row": self.rows}
+            self.rows += 1
+
+        entry["version"] = version
+        entry["saturation"] = float(saturation)
+        self.ids[public_id] = entry
+        self.pending[entry["row"]] = np.asarray(embedding, dtype=np.float16)
+        self.dirty = True
+
+    def record(self, public_id):
+        """Where a flushed photo is stored, for its journal line (see restore)"""
+        return {"generation": self.generation, **self.ids[public_id]}
+
+    def restore(self, public_id, record):
+        """
+        Re-add a photo whose row was flushed after the index was last saved
+
+        Args:
+            record: The photo's record(), read back from the journal
+
+        Returns:
+            True if the row belongs to the current vectors file and was restored
+        """
+        if self.generation is None or record.get("generation") != self.generation:
+            return False
+        if os.path.getsize(self.vectors_path) < (record["row"] + 1) * self.dim * 2:
+            return False
+
+        self.ids[public_id] = {field: record[field] for field in ("row", "version", "saturation")}
+        self.rows = max(self.rows, record["row"] + 1)
+        self.dirty = True
+        return True
+
+    def flush(self):
+        """Write pending embeddings into the vectors file, leaving the index for save"""
+        if not self.pending:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        if self.reset or not os.path.exists(self.vectors_path):
+            open(self.vectors_path, 'wb').close()
+            self.reset = False
+            self.generation = None
+
+        # Grow the file to the new row count, then write changed rows in place
+        with open(self.vectors_path, 'r+b') as f:
+            f.truncate(self.rows * self.dim * 2)
+        vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r+', shape=(self.rows, self.dim))
+        for row, embedding in self.pending.items():
+            vectors[row] = embedding
+        vectors.flush()
+        del vectors
+        self.pending = {}
+
+        # A new vectors file: name it on disk before any of its rows reach the journal
+        if self.generation is None:
+            self.generation = f"{time.time_ns():x}"
+            self.save_index()
+
+    def save(self):
+        """Write pending embeddings to disk, then the index"""
+        self.flush()
+        if self.dirty:
+            self.save_index()
+
+    def save_index(self):
+        """Replace the index atomically so it never points at missing rows"""
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                "model": self.model_name, "generation": self.generation,
+                "dim": self.dim, "rows": self.rows, "ids": self.ids
+            }, f)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+        self.index_saved_at = time.monotonic()
+
+_embedding_store = None
+
+def get_embedding_store():
+    """Open the shared embedding store on first use"""
+    global _embedding_store
+
+    if _embedding_store is None:
+        _embedding_store = EmbeddingStore(model_name=get_context().model_name)
+
+        # Rows an interrupted run flushed after its last index save
+        restored = sum(
+            _embedding_store.restore(public_id, record["stored"])
+            for public_id, record in read_journal().items()
+            if "stored" in record
+        )
+        if restored:
+            print(f"Recovered {restored} stored embeddings from {JOURNAL_PATH}")
+
+    return _embedding_store
+
+def retag_from_embeddings(path='tags.json', chunk_size=4096, compact=False):
+    """
+    Recompute all four tag heads from stored embeddings, without downloading or encoding images
+
+    Useful after editing a label set: only the edited labels are re-encoded
+    (see get_label_features), and every photo is re-scored from the store.
+    """
+    import torch
+
+    existing_tags = load_existing_tags(path)
+    store = get_embedding_store()
+    device = get_context().device
+
+    ids = [public_id for public_id in existing_tags if public_id in store]
+    missing = len(existing_tags) - len(ids)
+    print(f"Retagging {len(ids)} photos from stored embeddings")
+    if missing:
+        print(f"  {missing} photos have no stored embedding and keep their current tags")
+
+    for start in tqdm(range(0, len(ids), chunk_size), desc="Retagging"):
+        chunk = ids[start:start + chunk_size]
+        image_features = torch.from_numpy(store.get(chunk)).to(device)
+
+        # Renormalize after the float16 round trip
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+
+        for public_id, tags in zip(chunk, tag_image_features(image_features)):
+            existing_tags[public_id].update(
+                build_tag_fields(tags, store.ids[public_id]["saturation"])
+            )
+
+    add_similar_photos(existing_tags)
+    save_tags(existing_tags, path, compact)
+
+    return existing_tags
+
+# ============================================================================
+# SIMILAR PHOTOS
+# ============================================================================
+
+def compute_neighbors(vectors, k=SIMILAR_PER_PHOTO, block_size=SIMILARITY_BLOCK_SIZE):
+    """
+    Find the k most similar photos of every photo using blocked matrix products
+
+    Only one block_size x block_size block of scores exists at a time, and a
+    running top-k is kept per row, so memory does not grow with N x N.
+
+    Args:
+        vectors: (N, D) array of normalized embeddings
+        k: Neighbours per photo
+        block_size: Rows per block
+
+    Returns:
+        Tuple of (neighbour indices (N, k), cosine similarities (N, k)),
+        each row sorted from most to least similar
+    """
+    n = len(vectors)
+    k = min(k, n - 1)
+    if k <= 0:
+        return np.zeros((n, 0), dtype=np.int64), np.zeros((n, 0), dtype=np.float32)
+
+    all_indices = np.empty((n, k), dtype=np.int64)
+    all_scores = np.empty((n, k), dtype=np.float32)
+
+    for q_start in range(0, n, block_size):
+        queries = np.asarray(vectors[q_start:q_start + block_size], dtype=np.float32)
+        top_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        top_indices = np.zeros((len(queries), k), dtype=np.int64)
+
+        for k_start in range(0, n, block_size):
+            keys = np.asarray(vectors[k_start:k_start + block_size], dtype=np.float32)
+            scores = queries @ keys.T
+
+            # A photo is not its own neighbour
+            if k_start == q_start:
+                np.fill_diagonal(scores, -np.inf)
+
+            # Merge this block into the running top-k
+            candidate_scores = np.concatenate([top_scores, scores], axis=1)
+            candidate_indices = np.concatenate([
+                top_indices,
+                np.broadcast_to(np.arange(k_start, k_start + len(keys)), scores.shape)
+            ], axis=1)
+            keep = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(candidate_scores, keep, axis=1)
+            top_indices = np.take_along_axis(candidate_indices, keep, axis=1)
+
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        all_scores[q_start:q_start + len(queries)] = np.take_along_axis(top_scores, order, axis=1)
+        all_indices[q_start:q_start + len(queries)] = np.take_along_axis(top_indices, order, axis=1)
+
+    return all_indices, all_scores
+
+def add_similar_photos(results, k=SIMILAR_PER_PHOTO):
+    """
+    Store the public_ids of each photo's most similar photos as its "similar" list
+
+    Neighbours come from the stored CLIP image embeddings, so the browser can
+    show similar photos without any pairwise work. Photos without a stored
+    embedding get no "similar" list. Duplicates are left out of the neighbours
+    (they would crowd out everything else) and share their original's list.
+    """
+    store = get_embedding_store()
+    ids = [
+        public_id for public_id, entry in results.items()
+        if public_id in store and entry.get("duplicate_of") is None
+    ]
+    if len(ids) < 2:
+        return results
+
+    print(f"\nFinding similar photos for {len(ids)} photos...")
+    indices, _ = compute_neighbors(store.get(ids, dtype=np.float16), k)
+
+    for public_id, row in zip(ids, indices):
+        results[public_id]["similar"] = [ids[i] for i in row]
+
+    for entry in results.values():
+        original = results.get(entry.get("duplicate_of"))
+        if original is not None and "similar" in original:
+            entry["similar"] = original["similar"]
+
+    return results
+
+# ============================================================================
+# SEMANTIC SEARCH
+# ============================================================================
+
+def nearest_centers(vectors, centers, block_size=SIMILARITY_BLOCK_SIZE):
+    """Index of the nearest center (squared Euclidean) of every row, a block of rows at a time"""
+    center_norms = (centers ** 2).sum(axis=1)
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+        labels[start:start + len(block)] = (center_norms - 2 * block @ centers.T).argmin(axis=1)
+    return labels
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """
+    Lloyd's k-means on (N, D) float32 rows, started from k random rows
+
+    Empty clusters keep their previous center. Returns the (k, D) centers.
+    """
+    rng = np.random.default_rng(seed)
+    centers = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = nearest_centers(vectors, centers)
+        order = np.argsort(labels, kind="stable")
+        clusters, starts = np.unique(labels[order], return_index=True)
+        sums = np.add.reduceat(vectors[order], starts, axis=0)
+        counts = np.diff(np.append(starts, len(vectors)))
+        centers[clusters] = sums / counts[:, None]
+
+    return centers
+
+class SearchIndex:
+    """
+    Approximate nearest-neighbour index over the stored image embeddings
+
+    An inverted file (IVF) of k-means lists, with each photo's residual from
+    its list center compressed by a product quantizer (PQ) to one byte per
+    subspace. A query scores only the lists nearest to it, from one small
+    lookup table, then re-scores the best candidates with the exact float16
+    embeddings from the store.
+    """
+
+    def __init__(self, key, ids, folders, urls, rows, centroids, codebooks, codes, offsets):
+        self.key = key  # Identifies the stored photos the index was built from
+        self.ids = ids  # Public ids, grouped by list
+        self.folders = folders
+        self.urls = urls
+        self.rows = rows  # Embedding store rows
+        self.centroids = centroids  # (lists, D) list centers
+        self.codebooks = codebooks  # (subspaces, codewords, D / subspaces)
+        self.codes = codes  # (photos, subspaces) uint8 residual codes
+        self.offsets = offsets  # Photos of list i are offsets[i]:offsets[i + 1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, store, ids, folders, urls, key, subvectors=SEARCH_SUBVECTORS, seed=0):
+        """Train the lists and the quantizer on (a sample of) the photos, then encode every photo"""
+        vectors = store.get(ids, dtype=np.float16)
+        n, dim = vectors.shape
+
+        # About 4 sqrt(N) lists, with enough photos per list to train them
+        num_lists = max(1, min(int(4 * np.sqrt(n)), n // 39))
+        while dim % subvectors:
+            subvectors -= 1
+        sub_dim = dim // subvectors
+
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(n, min(n, max(32 * num_lists, 8192)), replace=False)
+        train = vectors[np.sort(sample)].astype(np.float32)
+        centroids = kmeans(train, num_lists, seed=seed)
+
+        # 64 residuals per codeword are plenty to train the quantizer
+        train = train[:256 * 64]
+        train_residuals = train - centroids[nearest_centers(train, centroids)]
+        codewords = min(256, len(train))
+        codebooks = np.stack([
+            kmeans(np.ascontiguousarray(train_residuals[:, m * sub_dim:(m + 1) * sub_dim]), codewords, seed=seed)
+            for m in range(subvectors)
+        ])
+
+        lists = nearest_centers(vectors, centroids)
+        codes = np.empty((n, subvectors), dtype=np.uint8)
+        for start in range(0, n, SIMILARITY_BLOCK_SIZE):
+            block = slice(start, start + SIMILARITY_BLOCK_SIZE)
+            residuals = vectors[block].astype(np.float32) - centroids[lists[block]]
+            for m in range(subvectors):
+                codes[block, m] = nearest_centers(residuals[:, m * sub_dim:(m + 1) * sub_dim], codebooks[m])
+
+        order = np.argsort(lists, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=num_lists))])
+        rows = np.array([store.ids[public_id]["row"] for public_id in ids], dtype=np.int64)
+
+        return cls(
+            key,
+            np.asarray(ids)[order],
+            np.asarray(folders)[order],
+            np.asarray(urls)[order],
+            rows[order],
+            centroids,
+            codebooks,
+            codes[order],
+            offsets
+        )
+
+    def save(self, path=SEARCH_INDEX_PATH):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f, key=np.array(self.key), ids=self.ids, folders=self.folders, urls=self.urls, rows=self.rows,
+                centroids=self.centroids, codebooks=self.codebooks, codes=self.codes, offsets=self.offsets
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=SEARCH_INDEX_PATH):
+        with np.load(path) as data:
+            return cls(
+                str(data["key"]), data["ids"], data["folders"], data["urls"], data["rows"],
+                data["centroids"], data["codebooks"], data["codes"], data["offsets"]
+            )
+
+    def search(self, query, vectors, k=SEARCH_RESULTS, probes=SEARCH_PROBES, rerank=SEARCH_RERANK, folder=None):
+        """
+        Find the photos whose embeddings best match a normalized query vector
+
+        Args:
+            query: (D,) float32 normalized text (or image) embedding
+            vectors: The store's embedding matrix, for re-scoring
+            folder: Only return photos of this folder
+
+        Returns:
+            List of (position, cosine similarity), best first; see ids, folders and urls
+        """
+        # q . x = q . center + sum over subspaces of q_m . codeword_m
+        list_scores = self.centroids @ query
+        probed = np.argsort(-list_scores)[:probes]
+        subvectors, _, sub_dim = self.codebooks.shape
+        table = np.einsum("mcd,md->mc", self.codebooks, query.reshape(subvectors, sub_dim))
+
+        positions = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in probed])
+        list_of = np.repeat(probed, np.diff(self.offsets)[probed])
+        if folder is not None:
+            in_folder = self.folders[positions] == folder
+            positions, list_of = positions[in_folder], list_of[in_folder]
+        if len(positions) == 0:
+            return []
+
+        approximate = list_scores[list_of] + table[np.arange(subvectors), self.codes[positions]].sum(axis=1)
+
+        if len(positions) > rerank:
+            keep = np.argpartition(-approximate, rerank - 1)[:rerank]
+            positions = positions[keep]
+
+        # Exact scores for the survivors, read from the memory-mapped store
+        rows = self.rows[positions]
+        order = np.argsort(rows)
+        exact = np.empty(len(rows), dtype=np.float32)
+        exact[order] = np.asarray(vectors[rows[order]], dtype=np.float32) @ query
+
+        best = np.argsort(-exact, kind="stable")[:k]
+        return [(positions[i], float(exact[i])) for i in best]
+
+_search_index = None
+
+def get_search_index(path=SEARCH_INDEX_PATH):
+    """
+    Load the search index on first use, rebuilding it if the stored photos changed
+
+    The index covers the photos of tags.json (every stored embedding if there
+    is none) except duplicates, which would only repeat their original.
+    It is checked once per process, so restart `serve` after tagging.
+    """
+    global _search_index
+
+    if _search_index is not None:
+        return _search_index
+
+    tags = load_existing_tags()
+    store = get_embedding_store()
+    ids = [
+        public_id for public_id in (tags or store.ids)
+        if public_id in store and tags.get(public_id, {}).get("duplicate_of") is None
+    ]
+    folders = [tags.get(public_id, {}).get("folder", "unknown") for public_id in ids]
+    urls = [tags.get(public_id, {}).get("url", "") for public_id in ids]
+
+    key_source = json.dumps([store.model_name, [
+        (public_id, store.ids[public_id]["version"], store.ids[public_id]["row"], folder, url)
+        for public_id, folder, url in zip(ids, folders, urls)
+    ]])
+    key = hashlib.sha256(key_source.encode("utf-8")).hexdigest()[:16]
+
+    index = None
+    if os.path.exists(path):
+        try:
+            index = SearchIndex.load(path)
+        except Exception as e:
+            print(f"Ignoring unreadable search index {path}: {e}")
+        if index is not None and index.key != key:
+            index = None
+
+    if index is None:
+        if not ids:
+            raise ValueError("No stored embeddings to search; run `tag` first")
+
+        print(f"Building search index for {len(ids)} photos...")
+        start = time.perf_counter()
+        index = SearchIndex.build(store, ids, folders, urls, key)
+        index.save(path)
+        print(f"Search index built in {time.perf_counter() - start:.1f}s ({len(index.centroids)} lists)")
+
+    _search_index = index
+    return index
+
+def encode_query(text):
+    """Normalized CLIP text embedding of a search query, as a float32 vector"""
+    import torch
+
+    encoder = get_context().encoder
+    tokens = encoder.tokenize([PROMPT_TEMPLATE.format(label=text)]).to(encoder.device)
+    with torch.no_grad():
+        features = encoder.encode_text(tokens).float()
+        features /= features.norm(dim=-1, keepdim=True)
+    return features[0].cpu().numpy()
+
+def search_photos(query, k=SEARCH_RESULTS, folder=None):
+    """
+    Find the photos that best match a free-text query
+
+    Returns:
+        {"query", "results": [{"public_id", "score", "url", "folder"}], "took_ms"}
+    """
+    index = get_search_index()
+    get_context().encoder  # Loads the model on first use, outside the timing
+    start = time.perf_counter()
+
+    matches = index.search(encode_query(query), get_embedding_store().vectors(), k, folder=folder)
+    results = [
+        {
+            "public_id": str(index.ids[position]),
+            "score": round(score, 4),
+            "url": str(index.urls[position]),
+            "folder": str(index.folders[position])
+        }
+        for position, score in matches
+    ]
+
+    return {"query": query, "results": results, "took_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+def serve_search(host=SEARCH_HOST, port=SEARCH_PORT):
+    """
+    Serve search_photos over HTTP: GET /search?q=<query>[&k=<count>][&folder=<folder>]
+
+    Responses are JSON with CORS enabled, so the photo site can query it directly.
+    Requests are answered one at a time, each in milliseconds.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+
+    lock = threading.Lock()  # One query at a time through the model and the index
+
+    class SearchHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/search":
+                return self.send_json(404, {"error": "not found, use /search?q=<query>"})
+
+            params = parse_qs(url.query)
+            query = params.get("q", [""])[0].strip()
+            if not query:
+                return self.send_json(400, {"error": "missing q"})
+            try:
+                k = min(max(int(params.get("k", [SEARCH_RESULTS])[0]), 1), 1000)
+            except ValueError:
+                return self.send_json(400, {"error": "k must be a number"})
 
-    # Process each image
-    for idx, img_data in enumerate(tqdm(images, desc="Processing images")):
+            with lock:
+                response = search_photos(query, k, params.get("folder", [None])[0])
+            self.send_json(200, response)
+
+    # Build or load the index and load the model before the first request
+    search_photos("photo", 1)
+
+    server = ThreadingHTTPServer((host, port), SearchHandler)
+    print(f"Serving photo search on http://{host}:{port}/search?q=... ({len(get_search_index())} photos)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# ============================================================================
+# INCREMENTAL UPDATES
+# ============================================================================
+
+# Cloudinary fields stored with each tags.json entry to detect changed assets
+FINGERPRINT_FIELDS = ["version", "bytes", "etag"]
+
+def load_existing_tags(path='tags.json'):
+    """Load a previous tags.json, or an empty dict if there is none"""
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, 'r') as f:
+        existing_tags = json.load(f)
+    print(f"Loaded {len(existing_tags)} existing tags from {path}")
+    return existing_tags
+
+def is_unchanged(img_data, entry):
+    """Check whether a listed asset still matches its stored tags.json entry"""
+    if all(field in entry for field in FINGERPRINT_FIELDS):
+        return all(entry[field] == img_data.get(field) for field in FINGERPRINT_FIELDS)
+
+    # Entries written before fingerprints were stored: the secure URL embeds the version
+    return entry.get("url") == img_data["url"]
+
+def iter_changed(images, existing_tags, unchanged):
+    """
+    Pass on new and changed assets, setting unchanged ones aside
+
+    Works on a stream, so changed photos are tagged while the listing is
+    still running. Unchanged duplicates are held until the listing ends: if
+    their original was deleted or changed they are tagged again, which also
+    re-runs duplicate detection for them.
+
+    Args:
+        images: Image dicts from the source
+        existing_tags: Previous tags.json contents
+        unchanged: Dict that receives {public_id: entry} for unchanged assets
+
+    Yields:
+        Image dicts of new or changed assets
+    """
+    held = []  # Unchanged duplicates, kept only if their original is unchanged too
+
+    for img_data in images:
+        entry = existing_tags.get(img_data["public_id"])
+        if entry is not None and is_unchanged(img_data, entry):
+            # Keep the old tags, refreshing the stored fingerprint
+            entry = {**entry, **{field: img_data.get(field) for field in FINGERPRINT_FIELDS}}
+
+            # Entries tagged before dimensions were recorded get them from the listing
+            if "width" not in entry and img_data.get("width") and img_data.get("height"):
+                entry.update(get_dimensions(img_data["width"], img_data["height"]))
+
+            if entry.get("duplicate_of") is not None:
+                held.append((img_data, entry))
+            else:
+                unchanged[img_data["public_id"]] = entry
+        else:
+            yield img_data
+
+    for img_data, entry in held:
+        if entry["duplicate_of"] in unchanged:
+            unchanged[img_data["public_id"]] = entry
+        else:
+            yield img_data
+
+def merge_incremental(existing_tags, images, results, folders):
+    """
+    Merge new results into existing tags, dropping assets deleted from Cloudinary
+
+    Only entries of the listed folders can be dropped, so a single-folder run
+    never touches the other folders.
+
+    Args:
+        existing_tags: Previous tags.json contents
+        images: Full listing of the processed folders
+        results: Entries for unchanged and freshly tagged assets
+        folders: Folders that were listed
+
+    Returns:
+        Merged tags dict
+    """
+    listed_ids = {img_data["public_id"] for img_data in images}
+
+    merged = {}
+    deleted = 0
+    for public_id, entry in existing_tags.items():
+        if public_id in listed_ids or entry.get("folder") not in folders:
+            merged[public_id] = entry
+        else:
+            deleted += 1
+
+    merged.update(results)
+    print(f"Removed {deleted} deleted photos")
+    return merged
+
+def process_incremental(images, folders, batch_size=BATCH_SIZE, workers=DOWNLOAD_WORKERS, processes=PROCESSES,
+                        dedup_distance=DEDUP_DISTANCE, thumbnails=False):
+    """
+    Tag only new or changed assets and merge them into the existing tags.json
+
+    Args:
+        images: Listing of the folders being processed (a list or a stream)
+        folders: Folders that were listed
+
+    Returns:
+        Merged tags dict
+    """
+    existing_tags = load_existing_tags()
+    listed = []
+    unchanged = {}
+
+    changed = match_listing(iter_changed(record_listing(images, listed), existing_tags, unchanged), images)
+    tagged = process_images_only(changed, batch_size, workers, processes, dedup_distance, thumbnails)
+
+    print(f"Incremental update: {len(tagged)} new or changed, {len(unchanged)} unchanged")
+    get_metrics().count("photos_unchanged", len(unchanged))
+
+    # Listing order, like a full run
+    results = {**unchanged, **tagged}
+    results = {
+        img_data["public_id"]: results[img_data["public_id"]]
+        for img_data in listed
+        if img_data["public_id"] in results
+    }
+
+    return merge_incremental(existing_tags, listed, results, folders)
+
+# ============================================================================
+# DUPLICATE DETECTION
+# ============================================================================
+
+# Perceptual hash: DCT of a 32x32 grayscale thumbnail, 8x8 lowest frequencies
+PHASH_SAMPLE = 32
+PHASH_SIZE = 8
+
+def dct_matrix(size):
+    """Orthonormal DCT-II basis, so dct(x) = D @ x"""
+    n = np.arange(size)
+    basis = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    basis[0] *= 1 / np.sqrt(2)
+    return basis * np.sqrt(2 / size)
+
+_dct_basis = dct_matrix(PHASH_SAMPLE)
+
+def perceptual_hash(image):
+    """
+    64-bit DCT perceptual hash (pHash) of an image
+
+    Each bit says whether a low-frequency DCT coefficient is above the median,
+    which survives resizing, recompression and small changes between frames.
+    """
+    gray = image.convert("L").resize((PHASH_SAMPLE, PHASH_SAMPLE), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.float64)
+    low = (_dct_basis @ pixels @ _dct_basis.T)[:PHASH_SIZE, :PHASH_SIZE]
+    bits = (low > np.median(low)).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    """
+    Burkhard-Keller tree over perceptual hashes, for Hamming-radius lookups
+
+    Each child edge is labelled with its distance to the parent, so by the
+    triangle inequality a search only descends into edges within `radius`
+    of the query's distance to the node, instead of comparing every hash.
+    """
+
+    def __init__(self):
+        self.root = None  # [hash, values, {distance: child}]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(key, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key, radius):
+        """Return [(distance, value)] for every stored hash within `radius` of key, nearest first"""
+        found = []
+        stack = [self.root] if self.root is not None else []
+
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(key, node[0])
+            if distance <= radius:
+                found.extend((distance, value) for value in node[1])
+
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+
+        return sorted(found, key=lambda item: item[0])
+
+class Deduplicator:
+    """
+    Finds photos that are near-identical to one already seen in this run
+
+    Duplicates are not encoded: once their original is tagged they get a copy
+    of its embedding, tags and palette, plus "duplicate_of".
+    """
+
+    def __init__(self, distance=DEDUP_DISTANCE):
+        self.distance = distance
+        self.tree = BKTree()
+        self.tagged = {}  # Original id -> (entry, embedding or None), once its batch is tagged
+        self.waiting = {}  # Original id -> duplicate items still waiting for it
+
+    def find_original(self, phash):
+        """Public id of the nearest earlier photo within the distance, or None"""
+        matches = self.tree.search(phash, self.distance)
+        return matches[0][1] if matches else None
+
+    def add_original(self, phash, public_id):
+        self.tree.add(phash, public_id)
+
+    def add_duplicate(self, item, original_id):
+        self.waiting.setdefault(original_id, []).append(item)
+
+    def resolve(self, finished, embeddings):
+        """
+        Record a tagged batch and add entries for the duplicates it unblocks
+
+        Args:
+            finished, embeddings: Output of tag_image_batch; updated in place
+        """
+        for public_id, entry in finished.items():
+            self.tagged[public_id] = (entry, embeddings.get(public_id))
+
+        for original_id in list(self.waiting):
+            if original_id not in self.tagged:
+                continue
+
+            entry, embedding = self.tagged[original_id]
+            for item in self.waiting.pop(original_id):
+                finished[item["public_id"]] = duplicate_entry(item, entry, original_id)
+                if embedding is not None:
+                    embeddings[item["public_id"]] = (item["fingerprint"]["version"], *embedding[1:])
+
+def duplicate_entry(item, original, original_id):
+    """tags.json entry for a duplicate: the original's tags and palette, with its own identity"""
+    return {
+        "url": item["url"],
+        "folder": item["folder"],
+        "created_at": item["created_at"],
+        **{field: original[field] for field in ("content", "style", "lighting", "colors", "color_palette", "all_tags")},
+        **item["dimensions"],
+        **item["fingerprint"],
+        "duplicate_of": original_id
+    }
+
+def clear_dangling_duplicates(results):
+    """
+    Turn duplicates whose original is no longer in results into photos of their own
+
+    Their copied tags still describe them, and without "duplicate_of" they
+    get their own similar list and show up in search again.
+
+    Returns:
+        Number of entries cleared
+    """
+    dangling = [
+        entry for entry in results.values()
+        if entry.get("duplicate_of") is not None and entry["duplicate_of"] not in results
+    ]
+    for entry in dangling:
+        del entry["duplicate_of"]
+    return len(dangling)
+
+def duplicate_groups(results):
+    """Group duplicates under their original: {original id: [duplicate ids]}"""
+    groups = {}
+    for public_id, entry in results.items():
+        original_id = entry.get("duplicate_of")
+        if original_id is not None:
+            groups.setdefault(original_id, []).append(public_id)
+    return groups
+
+# ============================================================================
+# IMAGE PIPELINE
+# ============================================================================
+
+def get_dimensions(width, height):
+    """
+    Build the dimension fields of a tags.json entry
+
+    Lets the frontend lay photos out without loading each one first.
+    """
+    aspect_ratio = width / height
+
+    if abs(aspect_ratio - 1) < 0.02:
+        orientation = "square"
+    elif aspect_ratio > 1:
+        orientation = "landscape"
+    else:
+        orientation = "portrait"
+
+    return {
+        "width": width,
+        "height": height,
+        "aspect_ratio": round(aspect_ratio, 4),
+        "orientation": orientation
+    }
+
+def build_tag_fields(tags, saturation):
+    """
+    Turn per-head CLIP tags into the tag fields of a tags.json entry
+
+    Args:
+        tags: {head name: [labels]} dict from tag_image_features
+        saturation: Average saturation of the image (0-1)
+
+    Returns:
+        Dict with content, style, lighting, colors and all_tags lists
+    """
+    # Filter out incorrect B&W tags for colored images
+    color_tags = filter_bw_tags(tags["colors"], saturation)
+
+    return {
+        "content": tags["content"],
+        "style": tags["style"],
+        "lighting": tags["lighting"],
+        "colors": color_tags,
+        # Combine all tags
+        "all_tags": tags["content"] + tags["style"] + tags["lighting"] + color_tags
+    }
+
+def tag_image_batch(batch, batch_size=BATCH_SIZE):
+    """
+    Run CLIP tagging on a batch of downloaded images
+
+    Args:
+        batch: List of pending image dicts built by iter_tagged_batches
+        batch_size: Maximum number of images per forward pass
+
+    Returns:
+        Tuple of ({public_id: entry} for the batch,
+        {public_id: (version, float16 embedding, saturation)} for the embedding store)
+    """
+    metrics = get_metrics()
+    image_inputs = [item["image_input"] for item in batch]
+
+    # Encode each image once and score it against all four label sets
+    try:
+        with metrics.stage("clip"):
+            image_features = encode_images(image_inputs, batch_size)
+        with metrics.stage("tagging"):
+            batch_tags = tag_image_features(image_features)
+    except Exception as e:
+        metrics.count("clip_failures")
+        print(f"    Error in CLIP tagging: {e}")
+        image_features = None
+        batch_tags = [{name: [] for name, _, _ in TAG_HEADS} for _ in batch]
+
+    # Keep the embeddings so tags can be recomputed later without the images
+    embeddings = {}
+    if image_features is not None:
+        for item, embedding in zip(batch, image_features.float().cpu().numpy()):
+            embeddings[item["public_id"]] = (
+                item["fingerprint"]["version"],
+                embedding.astype(np.float16),
+                item["saturation"]
+            )
+
+    # Extract color palettes (5 dominant colors) for the whole batch at once
+    with metrics.stage("palette"):
+        palettes = get_color_palettes([item["pixels"] for item in batch])
+
+    # Scatter the batched tags back to each image
+    finished = {}
+    for item, tags, color_palette in zip(batch, batch_tags, palettes):
+        fields = build_tag_fields(tags, item["saturation"])
+
+        finished[item["public_id"]] = {
+            "url": item["url"],
+            "folder": item["folder"],  # Store which folder this image belongs to
+            "created_at": item["created_at"],  # Use actual photo date from EXIF
+            "content": fields["content"],
+            "style": fields["style"],
+            "lighting": fields["lighting"],
+            "colors": fields["colors"],
+            "color_palette": color_palette,
+            "all_tags": fields["all_tags"],
+            **item["dimensions"],
+            **item["fingerprint"]
+        }
+
+    metrics.count("photos_tagged", len(finished))
+    return finished, embeddings
+
+def save_batch(finished, embeddings):
+    """Persist a tagged batch: embeddings to the store, entries to the journal"""
+    store = get_embedding_store()
+    for public_id, (version, embedding, saturation) in embeddings.items():
+        store.put(public_id, version, embedding, saturation)
+    store.flush()
+
+    # Journal the batch right away so a crash doesn't lose it; each line also
+    # records the photo's store row, so the index can be saved less often
+    append_journal(finished, stored={public_id: store.record(public_id) for public_id in embeddings})
+    if time.monotonic() - store.index_saved_at >= STORE_INDEX_INTERVAL:
+        store.save()
+
+def iter_tagged_batches(images, batch_size=BATCH_SIZE, workers=DOWNLOAD_WORKERS, progress=True,
+                        dedup_distance=DEDUP_DISTANCE, thumbnails=False):
+    """
+    Download, analyze and tag images, yielding results one CLIP batch at a time
+
+    Photos whose perceptual hash is within dedup_distance of an earlier photo
+    (burst sequences, re-uploads) skip CLIP and reuse that photo's results.
+
+    Args:
+        images: List of image dicts from fetch_all_images
+        batch_size: Images per CLIP forward pass
+        workers: Number of download threads
+        progress: Show a progress bar (off inside worker processes)
+        dedup_distance: Max Hamming distance for a duplicate (negative disables)
+        thumbnails: Cache each photo's atlas thumbnail (see build_atlases)
+
+    Yields:
+        (finished entries, embeddings) tuples from tag_image_batch, plus the
+        duplicates of photos tagged so far
+    """
+    metrics = get_metrics()
+    pending = []  # Downloaded images waiting for the next CLIP batch
+    dedup = Deduplicator(dedup_distance) if dedup_distance >= 0 else None
+
+    def tag_pending():
+        finished, embeddings = tag_image_batch(pending, batch_size)
+        if dedup is not None:
+            dedup.resolve(finished, embeddings)
+        return finished, embeddings
+
+    downloads = prefetch_images(images, workers)
+    if progress:
+        downloads = tqdm(downloads, total=listing_size(images), desc="Processing images")
+
+    for img_data, image, photo_date in downloads:
         public_id = img_data["public_id"]
         url = img_data["url"]
         folder = img_data.get("folder", "unknown")
 
-        # Progress update every 10 images
-        if (idx + 1) % 10 == 0:
-            print(f"\nProcessed {idx + 1}/{len(images)} images...")
-
         try:
-            # Download image
-            image = download_image(url)
+            # Image was downloaded in the background by prefetch_images
             if image is None:
+                metrics.count("photos_skipped")
                 print(f"  Skipping {public_id} (download failed)")
                 continue
 
-            # Extract photo date from EXIF metadata (actual date photo was taken)
-            photo_date = get_photo_date(image)
+            # Photo date from EXIF metadata (actual date photo was taken), read by download_photo
             if photo_date is None:
                 # Fallback to Cloudinary upload date if no EXIF data
                 photo_date = img_data.get("created_at", "")
 
-            # Calculate saturation to detect truly grayscale images
-            saturation = calculate_saturation(image)
+            # Original size from the Cloudinary listing, else from the downloaded file
+            # (which may be a derivative: smaller, but with the same aspect ratio)
+            width, height = image.info.get("original_size", image.size)
+            width = img_data.get("width") or width
+            height = img_data.get("height") or height
 
-            # Generate tags
-            content_tags = get_clip_tags(image, CONTENT_LABELS, TAGS_PER_IMAGE)
-            style_tags = get_clip_tags(image, STYLE_LABELS, STYLE_TAGS_PER_IMAGE)
-            lighting_tags = get_clip_tags(image, LIGHTING_LABELS, LIGHTING_TAGS_PER_IMAGE)
-            color_tags_raw = get_clip_tags(image, COLOR_LABELS, COLOR_TAGS_PER_IMAGE)
+            item = {
+                "public_id": public_id,
+                "fingerprint": {field: img_data.get(field) for field in FINGERPRINT_FIELDS},
+                "url": url,
+                "folder": folder,
+                "created_at": photo_date,
+                "dimensions": get_dimensions(width, height)
+            }
 
-            # Filter out incorrect B&W tags for colored images
-            color_tags = filter_bw_tags(color_tags_raw, saturation)
+            if thumbnails:
+                with metrics.stage("thumbnail"):
+                    save_thumbnail(public_id, img_data.get("version"), image)
+
+            # Near-identical to a photo already in this run: wait for its tags instead of encoding
+            if dedup is not None:
+                with metrics.stage("phash"):
+                    phash = perceptual_hash(image)
+                original_id = dedup.find_original(phash)
+                if original_id is not None:
+                    dedup.add_duplicate(item, original_id)
+                    metrics.count("duplicates")
+                    continue
+
+            # The decoded image is already at working size; CLIP preprocesses it as is
+            # and one small thumbnail of it feeds saturation and the palette
+            with metrics.stage("pixels"):
+                pixels = get_pixel_array(image)
 
-            # Extract color palette (5 dominant colors)
-            color_palette = get_color_palette(image, num_colors=5)
+            # Calculate saturation to detect truly grayscale images
+            with metrics.stage("saturation"):
+                saturation = calculate_saturation(pixels)
 
-            # Combine all tags
-            all_tags = content_tags + style_tags + lighting_tags + color_tags
+            preprocess = get_context().preprocess  # Loads the model on first use
+            with metrics.stage("preprocess"):
+                image_input = preprocess(image)
 
-            # Store results
-            results[public_id] = {
-                "url": url,
-                "folder": folder,  # Store which folder this image belongs to
-                "created_at": photo_date,  # Use actual photo date from EXIF
-                "content": content_tags,
-                "style": style_tags,
-                "lighting": lighting_tags,
-                "colors": color_tags,
-                "color_palette": color_palette,
-                "all_tags": all_tags
-            }
+            # Keep only the small preprocessed tensor until the batch is encoded
+            item.update(image_input=image_input, saturation=saturation, pixels=pixels)
+            pending.append(item)
+            if dedup is not None:
+                dedup.add_original(phash, public_id)
 
         except Exception as e:
+            metrics.count("photos_failed")
             print(f"  Error processing {public_id}: {e}")
             continue
 
-    print("\n" + "=" * 60)
-    print(f"Successfully processed {len(results)}/{len(images)} images")
+        if len(pending) >= batch_size:
+            yield tag_pending()
+            pending = []
 
-    # Save results
-    output_file = "tags.json"
-    print(f"\nSaving results to {output_file}...")
+    # Final partial batch
+    if pending:
+        yield tag_pending()
+
+    # Duplicates of photos tagged in earlier batches, listed after the last batch
+    if dedup is not None and dedup.waiting:
+        finished, embeddings = {}, {}
+        dedup.resolve(finished, embeddings)
+        yield finished, embeddings
+
+# ============================================================================
+# CPU SHARDING
+# ============================================================================
+
+def init_worker(threads, encoder, quantize, engine, batch_size, source):
+    """Set up a worker process: tune torch threading, load the model once and use the parent's image source"""
+    import torch
+
+    torch.set_num_threads(threads)
+    configure_source(source)
+    configure_context(encoder, quantize, engine, batch_size).load_model()
+
+def tag_chunk(images, batch_size, workers, dedup_distance, thumbnails):
+    """Worker task: tag a chunk of images and return its batches and the metrics they recorded"""
+    batches = list(iter_tagged_batches(
+        images, batch_size, workers, progress=False, dedup_distance=dedup_distance, thumbnails=thumbnails
+    ))
+    return batches, get_metrics().take()
+
+def iter_parallel_batches(images, processes, batch_size=BATCH_SIZE, workers=DOWNLOAD_WORKERS,
+                          dedup_distance=DEDUP_DISTANCE, thumbnails=False):
+    """
+    Tag images across several worker processes, yielding batches in listing order
+
+    The images are cut into chunks of CHUNK_BATCHES batches, handed out as
+    the listing produces them, which worker processes pick up as they free.
+    That keeps all cores busy. Each worker loads the model once and gets an
+    equal share of the cores as torch threads. Batches are yielded in chunk
+    order, so the journal and the embedding store come out the same on every run.
+    Duplicates are only found within a chunk.
+
+    Args:
+        images: Image dicts from the source (a list, or a stream from iter_images)
+        processes: Number of worker processes
+
+    Yields:
+        (finished entries, embeddings) tuples, like iter_tagged_batches
+    """
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    chunk_size = batch_size * CHUNK_BATCHES
+
+    # Split the download threads between the processes
+    workers_per_process = max(2, workers // processes)
+
+    print(f"CPU sharding: {processes} processes x {threads} torch threads, chunks of {chunk_size} images")
+
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(threads, get_context().encoder_name, get_context().quantize, get_context().engine, batch_size, get_source())
+    ) as executor, tqdm(total=listing_size(images), desc="Processing images") as progress_bar:
+        submitted = deque()  # (future, chunk size), oldest first
+
+        def collect(wait):
+            # Yield finished chunks in submission order; with wait=False stop at the first unfinished one
+            while submitted and (wait or submitted[0][0].done()):
+                future, size = submitted.popleft()
+                batches, worker_metrics = future.result()
+                get_metrics().merge(worker_metrics)
+                progress_bar.update(size)
+                yield from batches
+
+        chunk = []
+        try:
+            for img_data in images:
+                chunk.append(img_data)
+                if len(chunk) == chunk_size:
+                    submitted.append((executor.submit(tag_chunk, chunk, batch_size, workers_per_process, dedup_distance, thumbnails), len(chunk)))
+                    chunk = []
+                    yield from collect(wait=False)
+        except ListingError:
+            # Hand back the chunks already submitted so their photos reach the journal
+            yield from collect(wait=True)
+            raise
+
+        if chunk:
+            submitted.append((executor.submit(tag_chunk, chunk, batch_size, workers_per_process, dedup_distance, thumbnails), len(chunk)))
+        yield from collect(wait=True)
+
+# ============================================================================
+# QUANTIZATION PARITY
+# ============================================================================
+
+def load_reference_images(folders, limit=50):
+    """
+    Load the reference set for a parity check from the image source
+
+    Args:
+        folders: Folders to sample
+        limit: Maximum number of images
+
+    Returns:
+        List of (name, PIL Image) tuples
+    """
+    images = get_source().list_images(folders)[:limit]
+    return [(img_data["public_id"], image) for img_data, image, photo_date in prefetch_images(images)
+            if image is not None]
+
+def time_encoder(encoder, image_inputs, batch_size):
+    """Encode and tag image_inputs, returning (tags, images per second)"""
+    started = time.perf_counter()
+    tags = tag_image_features(encode_images(image_inputs, batch_size, encoder).float())
+    elapsed = time.perf_counter() - started
+    return tags, len(image_inputs) / elapsed if elapsed else 0.0
+
+def check_quantized_parity(references, batch_size=BATCH_SIZE):
+    """
+    Compare tags from the fp32 encoder and its int8 copy on the same images
 
-    with open(output_file, 'w') as f:
-        json.dump(results, f, indent=2)
+    Both run on the CPU and share the fp32 label features, so any difference
+    comes from quantizing the image encoder. The shared context is replaced
+    by a CPU one, so the label features are encoded by (and live on the same
+    device as) the fp32 encoder, and no second copy of the model is loaded.
 
-    print(f"Results saved to {output_file}")
+    Args:
+        references: List of (name, PIL Image) tuples
+        batch_size: Images per forward pass
+
+    Returns:
+        Report dict with per-head agreement, throughput and mismatching images
+    """
+    ctx = configure_context(get_context().encoder_name, device="cpu")
+    encoder = ctx.encoder
+    quantized = quantize_encoder(encoder)
+    image_inputs = [encoder.preprocess(image) for name, image in references]
+
+    # Warm up both so one-off allocation doesn't count against either
+    encode_images(image_inputs[:batch_size], batch_size, encoder)
+    encode_images(image_inputs[:batch_size], batch_size, quantized)
+
+    fp32_tags, fp32_speed = time_encoder(encoder, image_inputs, batch_size)
+    int8_tags, int8_speed = time_encoder(quantized, image_inputs, batch_size)
+
+    heads = {}
+    for name, labels, top_k in TAG_HEADS:
+        exact = top1 = overlap = 0
+        for expected, actual in zip(fp32_tags, int8_tags):
+            exact += expected[name] == actual[name]
+            top1 += expected[name][0] == actual[name][0]
+            overlap += len(set(expected[name]) & set(actual[name])) / top_k
+        count = len(references) or 1
+        heads[name] = {
+            "exact_match": round(exact / count, 4),
+            "top1_agreement": round(top1 / count, 4),
+            "mean_overlap": round(overlap / count, 4)
+        }
+
+    mismatches = [
+        {"image": name, "fp32": expected, "int8": actual}
+        for (name, image), expected, actual in zip(references, fp32_tags, int8_tags)
+        if expected != actual
+    ]
+
+    return {
+        "model": ctx.model_name,
+        "images": len(references),
+        "heads": heads,
+        "images_per_second": {"fp32": round(fp32_speed, 2), "int8": round(int8_speed, 2)},
+        "speedup": round(int8_speed / fp32_speed, 2) if fp32_speed else None,
+        "mismatches": mismatches
+    }
+
+# ============================================================================
+# MAIN PROCESSING
+# ============================================================================
+
+def process_all_images(folders=None, batch_size=BATCH_SIZE, workers=DOWNLOAD_WORKERS,
+                       incremental=False, compact=False, processes=PROCESSES, dedup_distance=DEDUP_DISTANCE,
+                       atlas=False):
+    """
+    Main function to process all images
+
+    Tagging every default folder of the image source replaces tags.json;
+    tagging only some folders merges into it and keeps the other folders' photos.
+    Texture atlases are written when requested, and refreshed whenever they already exist.
+    """
+
+    metrics = get_metrics()
+    source = get_source()
+    folders = folders or source.default_folders()
+
+    # Images stream in from the source (Cloudinary by default) and are tagged as
+    # they arrive; a listing that fails part way raises ListingError before anything is saved
+    listed = []
+    source_images = source.iter_images(folders)
+    images = match_listing(record_listing(source_images, listed), source_images)
+    atlas = atlas or os.path.isdir(ATLAS_DIR)
+
+    if incremental:
+        results = process_incremental(images, folders, batch_size, workers, processes, dedup_distance, atlas)
+    else:
+        results = process_images_only(images, batch_size, workers, processes, dedup_distance, atlas)
+
+    if not listed:
+        print("No images found!")
+        return
+
+    if not incremental and set(folders) != set(source.default_folders()):
+        # Merge with existing
+        results = {**load_existing_tags(), **results}
+
+    # An incremental run over some folders can delete the original of a duplicate in another folder
+    cleared = clear_dangling_duplicates(results)
+    if cleared:
+        print(f"Cleared {cleared} duplicates whose original is gone")
+
+    with metrics.stage("similar"):
+        add_similar_photos(results)
+
+    # Save results, then drop the journal entries they came from
+    with metrics.stage("write"):
+        save_tags(results, compact=compact)
+        # A local report for reviewing bursts, not published, so no .gz copy
+        atomic_write(DUPLICATES_PATH, json.dumps(duplicate_groups(results), indent=2).encode('utf-8'))
+    if atlas:
+        with metrics.stage("atlas"):
+            build_atlases(results, workers=workers)
+    prune_journal({img_data["public_id"] for img_data in listed})
     print(f"Total tagged photos: {len(results)}")
 
     # Print sample
@@ -568,155 +3240,803 @@ def process_all_images():
         print(f"  Lighting: {', '.join(sample['lighting'])}")
         print(f"  Colors: {', '.join(sample['colors'])}")
 
-def process_images_only(images):
-    """Process images and return results without saving"""
-    print(f"\nProcessing {len(images)} images with CLIP tagging...")
+def process_images_only(images, batch_size=BATCH_SIZE, workers=DOWNLOAD_WORKERS, processes=PROCESSES,
+                        dedup_distance=DEDUP_DISTANCE, thumbnails=False):
+    """
+    Process images and return results without saving
+
+    `images` can be a stream from the source's iter_images: tagging starts
+    with the first listed photo, without waiting for the listing to finish.
+    """
+    print(f"\nProcessing images with CLIP tagging...")
+    print(f"Batch size: {batch_size}, download workers: {workers}")
     print("=" * 60)
 
+    listed = []
     results = {}
+    resumed = []
+
+    # Resume photos already finished by an interrupted run of the same assets
+    journaled = load_journal()
+
+    def remaining():
+        for img_data in record_listing(images, listed):
+            entry = journaled.get(img_data["public_id"])
+            if entry is not None and entry.get("version") == img_data.get("version"):
+                results[img_data["public_id"]] = entry
+                resumed.append(img_data["public_id"])
+            else:
+                yield img_data
+
+    # Worker processes only pay off without a GPU
+    if processes > 1 and get_context().device != "cpu":
+        print("  GPU available, ignoring --processes and tagging in this process")
+        processes = 1
+
+    to_tag = match_listing(remaining(), images)
+    if processes > 1:
+        batches = iter_parallel_batches(to_tag, processes, batch_size, workers, dedup_distance, thumbnails)
+    else:
+        batches = iter_tagged_batches(to_tag, batch_size, workers, dedup_distance=dedup_distance,
+                                      thumbnails=thumbnails)
 
-    for idx, img_data in enumerate(tqdm(images, desc="Processing images")):
-        public_id = img_data["public_id"]
-        url = img_data["url"]
-        folder = img_data.get("folder", "unknown")
+    for finished, embeddings in batches:
+        with get_metrics().stage("save_batch"):
+            save_batch(finished, embeddings)
+        results.update(finished)
 
-        if (idx + 1) % 10 == 0:
-            print(f"\nProcessed {idx + 1}/{len(images)} images...")
+    # The index catches up with the rows flushed since its last save, before the journal is pruned
+    get_embedding_store().save()
 
-        try:
-            image = download_image(url)
-            if image is None:
-                print(f"  Skipping {public_id} (download failed)")
+    if resumed:
+        get_metrics().count("photos_resumed", len(resumed))
+        print(f"Resumed {len(resumed)} photos already finished in {JOURNAL_PATH}")
+
+    # Back to listing order (resumed photos were added as they were listed)
+    results = {
+        img_data["public_id"]: results[img_data["public_id"]]
+        for img_data in listed
+        if img_data["public_id"] in results
+    }
+
+    print("\n" + "=" * 60)
+    print(f"Successfully processed {len(results)}/{len(listed)} images")
+    duplicates = sum(1 for entry in results.values() if entry.get("duplicate_of") is not None)
+    if duplicates:
+        print(f"Reused tags for {duplicates} near-duplicate photos (see {DUPLICATES_PATH})")
+
+    return results
+
+def record_listing(images, listed):
+    """Pass a stream of listed images through, keeping each one in `listed`"""
+    for img_data in images:
+        listed.append(img_data)
+        yield img_data
+
+def listing_size(images):
+    """Number of images if known up front (a list), else None (a stream)"""
+    return len(images) if hasattr(images, "__len__") else None
+
+def match_listing(images, listing):
+    """
+    Collect a filtered listing into a list if the listing it came from was one
+
+    Local and manifest listings are complete up front, so filtering them
+    eagerly costs nothing and keeps a total for the progress bars. Cloudinary
+    listings stay streams, so tagging still starts with the first page.
+    """
+    return list(images) if listing_size(listing) is not None else images
+
+# ============================================================================
+# OUTPUT
+# ============================================================================
+
+# Tag lists stored per photo in the compact export (all_tags is rebuilt from these)
+COMPACT_TAG_FIELDS = ["content", "style", "lighting", "colors"]
+
+def read_journal(path=JOURNAL_PATH):
+    """
+    Read the journal's records
+
+    Returns:
+        {public_id: {"public_id", "entry", "stored"}} dict, "stored" being the
+        store record of photos with an embedding (a torn line from a crash is ignored)
+    """
+    records = {}
+    if not os.path.exists(path):
+        return records
+
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
                 continue
+            records[record["public_id"]] = record
 
-            photo_date = get_photo_date(image)
-            if photo_date is None:
-                photo_date = img_data.get("created_at", "")
+    return records
 
-            # Calculate saturation to detect truly grayscale images
-            saturation = calculate_saturation(image)
+def load_journal(path=JOURNAL_PATH):
+    """
+    Read photos finished by an earlier, interrupted run
+
+    Returns:
+        {public_id: entry} dict
+    """
+    return {public_id: record["entry"] for public_id, record in read_journal(path).items()}
+
+def journal_lines(records):
+    """One JSON line per finished photo"""
+    return "".join(json.dumps(record) + "\n" for record in records.values())
 
-            content_tags = get_clip_tags(image, CONTENT_LABELS, TAGS_PER_IMAGE)
-            style_tags = get_clip_tags(image, STYLE_LABELS, STYLE_TAGS_PER_IMAGE)
-            lighting_tags = get_clip_tags(image, LIGHTING_LABELS, LIGHTING_TAGS_PER_IMAGE)
-            color_tags_raw = get_clip_tags(image, COLOR_LABELS, COLOR_TAGS_PER_IMAGE)
+def append_journal(entries, path=JOURNAL_PATH, stored=None):
+    """
+    Append finished photos to the journal and flush them to disk
 
-            # Filter out incorrect B&W tags for colored images
-            color_tags = filter_bw_tags(color_tags_raw, saturation)
+    Args:
+        entries: {public_id: entry} of finished photos
+        stored: {public_id: EmbeddingStore.record} of those with a stored embedding
+    """
+    stored = stored or {}
+    records = {}
+    for public_id, entry in entries.items():
+        records[public_id] = {"public_id": public_id, "entry": entry}
+        if public_id in stored:
+            records[public_id]["stored"] = stored[public_id]
+
+    with open(path, 'a+b') as f:
+        # After a crash mid-write, start on a fresh line instead of extending the torn one
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        f.write(journal_lines(records).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+def prune_journal(public_ids, path=JOURNAL_PATH):
+    """
+    Drop photos from the journal once their results are safely in tags.json
 
-            color_palette = get_color_palette(image, num_colors=5)
+    Photos this run didn't list (an interrupted run over other folders) stay
+    in the journal for that run to resume.
 
-            all_tags = content_tags + style_tags + lighting_tags + color_tags
+    Args:
+        public_ids: Photos listed by the run that just saved
+    """
+    remaining = {
+        public_id: record
+        for public_id, record in read_journal(path).items()
+        if public_id not in public_ids
+    }
+
+    if remaining:
+        atomic_write(path, journal_lines(remaining).encode())
+    elif os.path.exists(path):
+        os.remove(path)
+
+def atomic_write(path, data):
+    """Write bytes to a temp file and rename it over path, so readers never see a partial file"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def write_json(path, data, **kwargs):
+    """Write JSON to a file, plus a precompressed .gz copy for static hosting"""
+    text = json.dumps(data, **kwargs).encode('utf-8')
+    atomic_write(path, text)
+
+    # mtime=0 keeps the .gz byte-identical when the contents don't change
+    atomic_write(path + '.gz', gzip.compress(text, compresslevel=9, mtime=0))
+
+def pack_palettes(palettes, num_colors=PALETTE_COLORS):
+    """
+    Pack color palettes into a base64 string of uint8 (r, g, b, weight * 255) values
 
-            results[public_id] = {
-                "url": url,
-                "folder": folder,
-                "created_at": photo_date,
-                "content": content_tags,
-                "style": style_tags,
-                "lighting": lighting_tags,
-                "colors": color_tags,
-                "color_palette": color_palette,
-                "all_tags": all_tags
-            }
+    Every palette takes num_colors slots; shorter palettes are padded with weight 0.
+    """
+    packed = np.zeros((len(palettes), num_colors, 4), dtype=np.uint8)
+    for i, palette in enumerate(palettes):
+        for j, color in enumerate(palette[:num_colors]):
+            packed[i, j] = [color['r'], color['g'], color['b'], round(color['weight'] * 255)]
+    return base64.b64encode(packed.tobytes()).decode('ascii')
 
-        except Exception as e:
-            print(f"  Error processing {public_id}: {e}")
+def folder_file_stem(folder):
+    """
+    File name stem for a folder's export files
+
+    Folder names can be nested ("portfolio/2024") or hold characters that are
+    unsafe in file names and URLs; those are replaced and a hash of the full
+    name is appended so two folders never share a file.
+    """
+    stem = "".join(c if c.isascii() and (c.isalnum() or c in "-_") else "_" for c in folder) or "folder"
+    if stem != folder or stem == "index":
+        stem += "-" + hashlib.sha1(folder.encode("utf-8")).hexdigest()[:8]
+    return stem
+
+def export_compact(results, directory=COMPACT_EXPORT_DIR):
+    """
+    Write tags as columnar, dictionary-encoded shards, one per folder
+
+    index.json holds the shared tag dictionary and the list of shards with
+    the file of each folder. Each shard stores one array per field, tags as
+    integer ids into the dictionary, and palettes packed as uint8. Every file
+    also gets a .gz variant; shards of folders that are gone are removed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    written = {"index.json", "index.json.gz"}
+
+    tag_ids = {}
+    def encode_tags(tags):
+        return [tag_ids.setdefault(tag, len(tag_ids)) for tag in tags]
+
+    folders = {}
+    for public_id, entry in results.items():
+        folders.setdefault(entry.get("folder", "unknown"), []).append((public_id, entry))
+
+    shards = []
+    for folder, entries in folders.items():
+        shard = {
+            "folder": folder,
+            "ids": [public_id for public_id, _ in entries],
+            "url": [entry["url"] for _, entry in entries],
+            "created_at": [entry.get("created_at", "") for _, entry in entries],
+            "width": [entry.get("width") for _, entry in entries],
+            "height": [entry.get("height") for _, entry in entries],
+            **{
+                field: [encode_tags(entry.get(field, [])) for _, entry in entries]
+                for field in COMPACT_TAG_FIELDS
+            },
+            "color_palette": pack_palettes([entry.get("color_palette", DEFAULT_PALETTE) for _, entry in entries]),
+            "similar": [entry.get("similar", []) for _, entry in entries],
+            "duplicate_of": [entry.get("duplicate_of") for _, entry in entries]
+        }
+
+        file_name = f"{folder_file_stem(folder)}.json"
+        write_json(os.path.join(directory, file_name), shard, separators=(',', ':'))
+        written.update([file_name, file_name + ".gz"])
+        shards.append({"folder": folder, "file": file_name, "count": len(entries)})
+
+    index = {
+        "format": 1,
+        "palette_colors": PALETTE_COLORS,
+        "tags": list(tag_ids),
+        "shards": shards
+    }
+    write_json(os.path.join(directory, "index.json"), index, separators=(',', ':'))
+
+    # Drop shards of folders removed since the last export
+    for name in os.listdir(directory):
+        if name not in written and name.endswith((".json", ".gz")):
+            os.remove(os.path.join(directory, name))
+
+    print(f"Compact export saved to {directory}/ ({len(shards)} shards, {len(tag_ids)} distinct tags)")
+
+def save_tags(results, path='tags.json', compact=False):
+    """
+    Save results to tags.json, atomically replacing the previous file
+
+    The compact export is written when requested, and refreshed whenever it
+    already exists so the frontend never reads a stale copy.
+    """
+    print(f"\nSaving results to {path}...")
+
+    atomic_write(path, json.dumps(results, indent=2).encode('utf-8'))
+
+    print(f"Results saved to {path}")
+
+    if compact or os.path.isdir(COMPACT_EXPORT_DIR):
+        export_compact(results)
+
+# ============================================================================
+# TEXTURE ATLASES
+# ============================================================================
+
+def thumbnail_path(public_id, version):
+    """Cache file of a photo's atlas thumbnail (a new version gets a new file)"""
+    name = hashlib.sha1(public_id.encode("utf-8")).hexdigest()[:20]
+    return os.path.join(THUMBNAIL_CACHE_DIR, f"{name}-{version}.jpg")
+
+def make_thumbnail(image):
+    """Resize an image to ATLAS_ROW_HEIGHT high, keeping its aspect ratio"""
+    width = round(ATLAS_ROW_HEIGHT * image.width / image.height)
+    width = min(max(width, 1), ATLAS_SIZE - 2 * ATLAS_PADDING)
+    return image.resize((width, ATLAS_ROW_HEIGHT), Image.LANCZOS)
+
+def save_thumbnail(public_id, version, image):
+    """Cache the atlas thumbnail of a decoded photo (the working image is plenty)"""
+    os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+    buffer = BytesIO()
+    make_thumbnail(image).save(buffer, "JPEG", quality=90)
+    atomic_write(thumbnail_path(public_id, version), buffer.getvalue())
+
+def fetch_thumbnail(public_id, entry):
+    """
+    Cache the thumbnail of a photo tagged without one, from its tags.json url
+
+    Cloudinary URLs get a small derivative, file:// URLs are read from disk.
+    Returns False if the photo can't be read.
+    """
+    url = entry.get("url") or ""
+    try:
+        if url.startswith("file://"):
+            from urllib.parse import urlparse
+            from urllib.request import url2pathname
+            with open(url2pathname(urlparse(url).path), 'rb') as f:
+                image = decode_image(f, ATLAS_ROW_HEIGHT)
+        elif url.startswith(("http://", "https://")):
+            data = download_bytes(derivative_url(url, ATLAS_TRANSFORM))
+            if data is None:
+                return False
+            image = decode_image(data, ATLAS_ROW_HEIGHT)
+        else:
+            return False
+    except Exception as e:
+        print(f"  Error reading thumbnail of {public_id}: {e}")
+        return False
+
+    save_thumbnail(public_id, entry.get("version"), image)
+    return True
+
+def pack_shelves(widths, max_size=ATLAS_SIZE, height=ATLAS_ROW_HEIGHT + 2 * ATLAS_PADDING):
+    """
+    Place equally tall boxes left to right in rows, starting a new page when one is full
+
+    The last page is packed again at the width that gives the smallest
+    power-of-two page, so small folders don't get a mostly empty 2048px page.
+
+    Args:
+        widths: Box widths, padding included
+
+    Returns:
+        Tuple of ([(page, x, y)] per box, [(page width, page height)])
+    """
+    def layout(indices, page_width):
+        x = y = 0
+        placed = []
+        for i in indices:
+            if x + widths[i] > page_width:
+                x, y = 0, y + height
+            placed.append((x, y))
+            x += widths[i]
+        return placed, y + height
+
+    def power_of_two(size):
+        return 1 << max(0, int(size) - 1).bit_length()
+
+    positions = [None] * len(widths)
+    pages = []
+    remaining = list(range(len(widths)))
+
+    while remaining:
+        placed, used_height = layout(remaining, max_size)
+        if used_height > max_size:
+            # Fill one page and carry the rest over
+            count = sum(1 for _, y in placed if y + height <= max_size)
+            for i, (x, y) in zip(remaining[:count], placed[:count]):
+                positions[i] = (len(pages), x, y)
+            pages.append((max_size, max_size))
+            remaining = remaining[count:]
             continue
 
-    print("\n" + "=" * 60)
-    print(f"Successfully processed {len(results)}/{len(images)} images")
+        # Last page: the narrowest power-of-two width that still gives the smallest page
+        best = None
+        page_width = power_of_two(max(widths[i] for i in remaining))
+        while page_width <= max_size:
+            placed, used_height = layout(remaining, page_width)
+            if used_height <= max_size:
+                page_height = power_of_two(used_height)
+                cost = (page_width * page_height, max(page_width, page_height))  # Smallest, then squarest
+                if best is None or cost < best[0]:
+                    best = (cost, page_width, page_height, placed)
+            page_width *= 2
+
+        _, page_width, page_height, placed = best
+        for i, (x, y) in zip(remaining, placed):
+            positions[i] = (len(pages), x, y)
+        pages.append((page_width, page_height))
+        remaining = []
+
+    return positions, pages
+
+def build_atlases(results, directory=ATLAS_DIR, workers=DOWNLOAD_WORKERS):
+    """
+    Pack every folder's photo thumbnails into a few power-of-two atlas pages
+
+    Each folder gets <stem>-<n>.jpg pages and <stem>.json (see
+    folder_file_stem) with every photo's page and UV rectangle, [u_min, v_min,
+    u_max, v_max] with v up (the WebGL/three.js convention). index.json maps
+    the folders to their files and gives the row height. Photos
+    without a cached thumbnail are fetched first; photos that can't be read
+    are left out and the frontend loads them one by one as before.
+    """
+    os.makedirs(directory, exist_ok=True)
 
-    return results
+    missing = [
+        (public_id, entry) for public_id, entry in results.items()
+        if not os.path.exists(thumbnail_path(public_id, entry.get("version")))
+    ]
+    if missing:
+        print(f"Fetching {len(missing)} thumbnails missing from {THUMBNAIL_CACHE_DIR}/...")
+        get_session(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(tqdm(executor.map(lambda item: fetch_thumbnail(*item), missing), total=len(missing), desc="Thumbnails"))
+
+    folders = {}
+    for public_id, entry in results.items():
+        path = thumbnail_path(public_id, entry.get("version"))
+        if os.path.exists(path):
+            folders.setdefault(entry.get("folder", "unknown"), []).append((public_id, path))
+
+    written = {"index.json"}
+    index = {}
+    for folder, photos in folders.items():
+        # Only the headers are read here; pixels are loaded one page at a time
+        sizes = []
+        for _, path in photos:
+            with Image.open(path) as thumbnail:
+                sizes.append(thumbnail.size)
+        positions, pages = pack_shelves([width + 2 * ATLAS_PADDING for width, _ in sizes])
+
+        files = []
+        uvs = [None] * len(photos)
+        for page, (page_width, page_height) in enumerate(pages):
+            canvas = Image.new("RGB", (page_width, page_height), (245, 244, 242))  # Canvas placeholder cream
+
+            for i, (position, (width, height)) in enumerate(zip(positions, sizes)):
+                if position[0] != page:
+                    continue
+                _, x, y = position
+                with Image.open(photos[i][1]) as thumbnail:
+                    thumbnail = thumbnail.convert("RGB")
+                # Stretched copy underneath fills the padding with the photo's edge colours
+                canvas.paste(thumbnail.resize((width + 2 * ATLAS_PADDING, height + 2 * ATLAS_PADDING)), (x, y))
+                canvas.paste(thumbnail, (x + ATLAS_PADDING, y + ATLAS_PADDING))
+
+                left, top = x + ATLAS_PADDING, y + ATLAS_PADDING
+                uvs[i] = [
+                    round(left / page_width, 6),
+                    round(1 - (top + height) / page_height, 6),
+                    round((left + width) / page_width, 6),
+                    round(1 - top / page_height, 6)
+                ]
+
+            file_name = f"{folder_file_stem(folder)}-{page}.jpg"
+            buffer = BytesIO()
+            canvas.save(buffer, "JPEG", quality=ATLAS_QUALITY, optimize=True)
+            atomic_write(os.path.join(directory, file_name), buffer.getvalue())
+            files.append({"file": file_name, "width": page_width, "height": page_height})
+            written.add(file_name)
+
+        shard = {
+            "folder": folder,
+            "atlases": files,
+            "ids": [public_id for public_id, _ in photos],
+            "atlas": [position[0] for position in positions],
+            "uv": uvs
+        }
+        file_name = f"{folder_file_stem(folder)}.json"
+        write_json(os.path.join(directory, file_name), shard, separators=(',', ':'))
+        written.update([file_name, file_name + ".gz"])
+        index[folder] = {"file": file_name, "count": len(photos), "pages": len(pages)}
+
+    write_json(os.path.join(directory, "index.json"), {
+        "format": 1,
+        "row_height": ATLAS_ROW_HEIGHT,
+        "folders": index
+    }, separators=(',', ':'))
+    written.add("index.json.gz")
+
+    # Drop pages and folders left over from earlier builds
+    for name in os.listdir(directory):
+        if name not in written and name.endswith((".jpg", ".json", ".gz")):
+            os.remove(os.path.join(directory, name))
+
+    packed = sum(len(photos) for photos in folders.values())
+    pages = sum(folder["pages"] for folder in index.values())
+    print(f"Texture atlases saved to {directory}/ ({packed} photos on {pages} pages)")
+    if packed < len(results):
+        print(f"  {len(results) - packed} photos have no thumbnail and are not in an atlas")
 
 # ============================================================================
 # ENTRY POINT
 # ============================================================================
 
-if __name__ == "__main__":
+def print_banner():
     print("=" * 60)
     print("CLOUDINARY PHOTO CLASSIFIER WITH CLIP")
     print("=" * 60)
     print()
 
-    # Check for command-line argument
-    if len(sys.argv) > 1:
-        folder_arg = sys.argv[1].lower()
-        if folder_arg in ['portfolio', 'rugby']:
-            print(f"Processing only '{folder_arg}' folder")
-            # Modify fetch_all_images to only fetch specified folder
-            import classify_cloudinary
-            original_fetch = fetch_all_images
+def print_done():
+    print("\n" + "=" * 60)
+    print("DONE! You can now use tags.json in your Photography World.")
+    print("=" * 60)
 
-            def fetch_single_folder():
-                return fetch_images_from_folder(folder_arg)
+def command_tag(args):
+    """Download, tag and save photos"""
+    print_banner()
 
-            def fetch_images_from_folder(folder_name):
-                print(f"\nFetching from '{folder_name}' asset folder...")
-                all_images = []
-                next_cursor = None
+    folders = args.folders or get_source().default_folders()
+    if args.folders:
+        print(f"Processing only {', '.join(repr(folder) for folder in folders)}")
 
-                while True:
-                    try:
-                        result = cloudinary.api.resources_by_asset_folder(
-                            folder_name,
-                            max_results=500,
-                            next_cursor=next_cursor
-                        )
-
-                        folder_images = result.get("resources", [])
-                        for img in folder_images:
-                            img["folder"] = folder_name
-
-                        all_images.extend(folder_images)
-                        next_cursor = result.get("next_cursor")
-
-                        print(f"  Fetched {len(folder_images)} images from '{folder_name}'")
-                        print(f"  Total so far: {len(all_images)} images")
-
-                        if not next_cursor:
-                            break
-                    except Exception as e:
-                        print(f"Error fetching images from {folder_name}: {e}")
-                        break
+    try:
+        process_all_images(
+            folders,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            incremental=args.incremental,
+            compact=args.compact,
+            processes=args.processes,
+            dedup_distance=args.dedup_distance,
+            atlas=args.atlas
+        )
+    except ListingError as e:
+        # Tagging a partial listing would silently drop photos (and prune them in --incremental)
+        print(f"\n{e}")
+        print(f"Listing failed, tags.json was not changed. Finished photos are kept in {JOURNAL_PATH}; rerun to resume.")
+        sys.exit(1)
 
-                print(f"\nTotal images found: {len(all_images)}")
-                return [
-                    {
-                        "public_id": r["public_id"],
-                        "url": r["secure_url"],
-                        "folder": r.get("folder", "unknown"),
-                        "created_at": r.get("created_at", "")  # Cloudinary upload date
-                    }
-                    for r in all_images
-                ]
+    metrics = get_metrics()
+    metrics.print_summary()
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+        print(f"Metrics written to {args.metrics_json}")
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+        print(f"Prometheus metrics written to {args.metrics_prom}")
+    print_done()
+
+def command_list(args):
+    """List assets in the image source without downloading or tagging them"""
+    try:
+        images = get_source().list_images(args.folders or get_source().default_folders())
+    except ListingError as e:
+        print(f"\n{e}")
+        sys.exit(1)
 
-            # Load existing tags and merge
-            existing_tags = {}
-            if os.path.exists('tags.json'):
-                with open('tags.json', 'r') as f:
-                    existing_tags = json.load(f)
-                print(f"Loaded {len(existing_tags)} existing tags from tags.json")
-
-            # Fetch and process only specified folder
-            images = fetch_images_from_folder(folder_arg)
-            if images:
-                results = process_images_only(images)
-                # Merge with existing
-                final_results = {**existing_tags, **results}
-                # Save
-                with open('tags.json', 'w') as f:
-                    json.dump(final_results, f, indent=2)
-                print(f"\nResults saved to tags.json")
-                print(f"Total photos in database: {len(final_results)}")
-        else:
-            print(f"Unknown folder: {folder_arg}")
-            print("Usage: python classify_cloudinary.py [portfolio|rugby]")
-            sys.exit(1)
+    print()
+    for img_data in images:
+        size = f"{img_data['width']}x{img_data['height']}" if img_data.get("width") else "?"
+        print(f"  {img_data['folder']:<12} {img_data['public_id']:<40} {size:>11}  v{img_data.get('version')}")
+
+def command_retag(args):
+    """Re-score stored embeddings against the current label sets (no downloads)"""
+    print_banner()
+    retag_from_embeddings(compact=args.compact)
+    print_done()
+
+def command_parity(args):
+    """Check that the int8 encoder tags a reference set like the fp32 one"""
+    references = load_reference_images(args.folders or get_source().default_folders(), args.limit)
+    if not references:
+        print("No reference images found")
+        sys.exit(1)
+
+    print(f"Comparing fp32 and int8 tags on {len(references)} images...")
+    report = check_quantized_parity(references, args.batch_size)
+
+    print(f"\n{'head':<10} {'exact':>7} {'top-1':>7} {'overlap':>8}")
+    for name, scores in report["heads"].items():
+        print(f"{name:<10} {scores['exact_match']:>7.1%} {scores['top1_agreement']:>7.1%} "
+              f"{scores['mean_overlap']:>8.1%}")
+
+    speed = report["images_per_second"]
+    print(f"\nfp32: {speed['fp32']:.1f} images/s, int8: {speed['int8']:.1f} images/s "
+          f"({report['speedup']}x)")
+    print(f"Images with any tag difference: {len(report['mismatches'])}/{report['images']}")
+
+    if args.output:
+        atomic_write(args.output, json.dumps(report, indent=2).encode('utf-8'))
+        print(f"Report written to {args.output}")
+
+def command_search(args):
+    """Find photos matching a text query, from stored embeddings"""
+    try:
+        response = search_photos(" ".join(args.query), args.limit, args.folder)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    for result in response["results"]:
+        print(f"  {result['score']:.3f}  {result['public_id']}")
+    print(f"{len(response['results'])} photos in {response['took_ms']} ms")
+
+def command_serve(args):
+    """Serve text search over HTTP"""
+    try:
+        serve_search(args.host, args.port)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+def command_atlas(args):
+    """Pack texture atlases for the photos in tags.json"""
+    tags = load_existing_tags()
+    if not tags:
+        print("No tags.json to build atlases from; run `tag` first")
+        sys.exit(1)
+
+    build_atlases(tags, workers=args.workers)
+
+def command_stats(args):
+    """Summarize tags.json and the local caches, without Cloudinary or the model"""
+    tags = load_existing_tags()
+
+    folders = {}
+    tag_counts = {}
+    for entry in tags.values():
+        folder = entry.get("folder", "unknown")
+        folders[folder] = folders.get(folder, 0) + 1
+        for tag in entry.get("all_tags", []):
+            tag_counts[tag] = tag_counts.get(tag, 0) + 1
+
+    print(f"Photos in tags.json: {len(tags)}")
+    for folder, count in sorted(folders.items()):
+        print(f"  {folder}: {count}")
+
+    if tag_counts:
+        print("\nMost common tags:")
+        for tag, count in sorted(tag_counts.items(), key=lambda item: -item[1])[:10]:
+            print(f"  {tag}: {count}")
+
+    # Whichever encoder built the store, without choosing one on the command line
+    store = EmbeddingStore(model_name=None)
+    if store.model_name is None:
+        print("\nStored embeddings: 0")
     else:
-        # Default: process both folders
-        process_all_images()
+        print(f"\nStored embeddings: {len(store)} ({store.model_name})")
+
+    journaled = load_journal()
+    if journaled:
+        print(f"Unfinished run: {len(journaled)} photos in {JOURNAL_PATH}")
+
+    if os.path.isdir(COMPACT_EXPORT_DIR):
+        print(f"Compact export: {COMPACT_EXPORT_DIR}/")
+
+    if os.path.isdir(ATLAS_DIR):
+        print(f"Texture atlases: {ATLAS_DIR}/")
+
+COMMANDS = {
+    "tag": command_tag,
+    "list": command_list,
+    "retag": command_retag,
+    "parity": command_parity,
+    "stats": command_stats,
+    "search": command_search,
+    "serve": command_serve,
+    "atlas": command_atlas
+}
+
+def add_source_arguments(parser):
+    """Add the image source options to a subcommand"""
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--all-folders", action="store_true",
+                        help="process every root folder of the Cloudinary account")
+    source.add_argument("--local", metavar="DIR",
+                        help="read photos from this directory instead of Cloudinary (subdirectories are folders)")
+    source.add_argument("--manifest", metavar="FILE",
+                        help="read the photo list from a JSON, JSON lines or CSV manifest")
+    parser.add_argument("--url-prefix", metavar="URL",
+                        help="with --local, URL the files will be served from (default: file:// URIs)")
+
+def configure_source_from_args(args):
+    """Pick the image source named on the command line"""
+    if getattr(args, "local", None):
+        return configure_source(LocalSource(args.local, args.url_prefix))
+    if getattr(args, "manifest", None):
+        return configure_source(ManifestSource(args.manifest))
+    if getattr(args, "all_folders", False):
+        return configure_source(CloudinarySource(discover=True))
+    return get_source()
+
+def add_encoder_arguments(parser):
+    """Add the encoder choice and quantization switch to a subcommand"""
+    parser.add_argument("--encoder", choices=sorted(ENCODERS), default=ENCODER,
+                        help=f"image/text encoder (default: {ENCODER}; tiny is random and only for testing)")
+    parser.add_argument("--quantize", action="store_true",
+                        help="run the image encoder with int8 weights on the CPU")
+    parser.add_argument("--engine", choices=["eager", "compiled"], default=ENGINE,
+                        help="inference engine: compiled uses torch.compile (bfloat16 and channels-last on the CPU), "
+                             f"warmed up and timed against eager at startup (default: {ENGINE})")
+
+def build_parser():
+    """Build the command-line parser"""
+    parser = argparse.ArgumentParser(
+        description="Tag photos (Cloudinary, a local directory or a manifest) with CLIP and write tags.json"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    tag = commands.add_parser("tag", help="download, tag and save photos (default)")
+    tag.add_argument("folders", nargs="*",
+                     help=f"asset folders to process (default: {' '.join(DEFAULT_FOLDERS)}, "
+                          "or every folder of --local/--manifest)")
+    tag.add_argument("--incremental", action="store_true",
+                     help="only tag new or changed photos and drop deleted ones")
+    tag.add_argument("--compact", action="store_true",
+                     help="also write the compact sharded export to tags/")
+    tag.add_argument("--atlas", action="store_true",
+                     help=f"also pack per-folder texture atlases into {ATLAS_DIR}/ for zoomed-out views")
+    tag.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                     help=f"images per CLIP forward pass (default: {BATCH_SIZE})")
+    tag.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS,
+                     help=f"parallel downloads (default: {DOWNLOAD_WORKERS})")
+    tag.add_argument("--processes", type=int, default=PROCESSES,
+                     help="worker processes for CPU-only hosts, each loading its own model (default: 1)")
+    tag.add_argument("--dedup-distance", type=int, default=DEDUP_DISTANCE, metavar="BITS",
+                     help="reuse an earlier photo's tags when perceptual hashes differ by at most this many "
+                          f"of 64 bits (default: {DEDUP_DISTANCE}, -1 disables)")
+    tag.add_argument("--metrics-json", metavar="PATH",
+                     help="write per-stage timings and counters to this JSON file")
+    tag.add_argument("--metrics-prom", metavar="PATH",
+                     help="write the same metrics as a Prometheus textfile (e.g. for node_exporter)")
+    add_source_arguments(tag)
+    add_encoder_arguments(tag)
+
+    list_parser = commands.add_parser("list", help="list photos without tagging them")
+    list_parser.add_argument("folders", nargs="*",
+                             help=f"asset folders to list (default: {' '.join(DEFAULT_FOLDERS)})")
+    add_source_arguments(list_parser)
+
+    retag = commands.add_parser("retag", help="recompute tags from stored embeddings only")
+    retag.add_argument("--compact", action="store_true",
+                       help="also write the compact sharded export to tags/")
+    add_encoder_arguments(retag)
+
+    parity = commands.add_parser("parity", help="compare int8 and fp32 tags on reference images")
+    parity.add_argument("folders", nargs="*",
+                        help=f"asset folders to sample (default: {' '.join(DEFAULT_FOLDERS)})")
+    add_source_arguments(parity)
+    parity.add_argument("--limit", type=int, default=50,
+                        help="maximum reference images (default: 50)")
+    parity.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help=f"images per forward pass (default: {BATCH_SIZE})")
+    parity.add_argument("--output", metavar="JSON",
+                        help="also write the report to this file")
+    parity.add_argument("--encoder", choices=sorted(ENCODERS), default=ENCODER,
+                        help=f"encoder to check (default: {ENCODER})")
+
+    commands.add_parser("stats", help="summarize tags.json and local caches")
+
+    atlas = commands.add_parser("atlas", help="pack texture atlases for the photos in tags.json")
+    atlas.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS,
+                       help=f"parallel downloads of thumbnails missing from the cache (default: {DOWNLOAD_WORKERS})")
+
+    search = commands.add_parser("search", help="find photos matching a text query (from stored embeddings)")
+    search.add_argument("query", nargs="+", help='free-text query, e.g. "muddy scrum at dusk"')
+    search.add_argument("--limit", type=int, default=SEARCH_RESULTS,
+                        help=f"photos to return (default: {SEARCH_RESULTS})")
+    search.add_argument("--folder", help="only search this folder")
+    add_encoder_arguments(search)
+
+    serve = commands.add_parser("serve", help="serve text search over HTTP")
+    serve.add_argument("--host", default=SEARCH_HOST, help=f"address to bind (default: {SEARCH_HOST})")
+    serve.add_argument("--port", type=int, default=SEARCH_PORT, help=f"port (default: {SEARCH_PORT})")
+    add_encoder_arguments(serve)
+
+    return parser
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # No command, or a folder name first: the original `classify_cloudinary.py [folder]` usage
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help")):
+        argv = ["tag"] + list(argv)
+
+    args = build_parser().parse_args(argv)
+    configure_source_from_args(args)
+    if hasattr(args, "encoder"):
+        configure_context(
+            args.encoder,
+            getattr(args, "quantize", False),
+            getattr(args, "engine", ENGINE),
+            getattr(args, "batch_size", BATCH_SIZE)
+        )
+    COMMANDS[args.command](args)
 
-    print("\n" + "=" * 60)
-    print("DONE! You can now use tags.json in your Photography World.")
-    print("=" * 60)
+if __name__ == "__main__":
+    main()
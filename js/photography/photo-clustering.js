@@ -108,6 +108,30 @@ function sortPhotosByDate(photos) {
     });
 }
 
+// Sort photos so visually similar ones sit next to each other
+// Follows the precomputed `similar` lists from tags.json, so there is no pairwise work
+function sortPhotosBySimilarity(photos) {
+    const photosById = new Map(photos.map(photo => [photo.id, photo]));
+    const placed = new Set();
+    const sorted = [];
+
+    // Start each chain at the newest photo not placed yet
+    for (const start of sortPhotosByDate(photos)) {
+        let current = start;
+
+        while (current && !placed.has(current.id)) {
+            placed.add(current.id);
+            sorted.push(current);
+
+            // Continue with the most similar photo that isn't placed yet
+            const nextId = (current.similar || []).find(id => photosById.has(id) && !placed.has(id));
+            current = nextId ? photosById.get(nextId) : null;
+        }
+    }
+
+    return sorted;
+}
+
 // Main entry point - uniform grid layout with various sorting options
 export function clusterAndPositionPhotos(photos, sortBy = 'date') {
     let sortedPhotos = [...photos];
@@ -119,8 +143,8 @@ export function clusterAndPositionPhotos(photos, sortBy = 'date') {
         // Sort by dominant color (rainbow gradient)
         sortedPhotos = sortPhotosByColor(photos);
     } else if (sortBy === 'tags') {
-        // Backup: sort by tag similarity (no sorting, will use original order)
-        sortedPhotos = photos;
+        // Chain visually similar photos together using precomputed neighbours
+        sortedPhotos = sortPhotosBySimilarity(photos);
     }
 
     const positions2D = positionPhotosInGrid(sortedPhotos);
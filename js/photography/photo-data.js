@@ -1,6 +1,17 @@
 export async function loadPhotoDatabase(folderFilter = null) {
-    const response = await fetch('tags.json');
-    const data = await response.json();
+    // Prefer the compact sharded export (only the needed folders), fall back to tags.json
+    // Both requests start together so a deployment without the compact export waits for no extra 404
+    const fallback = new AbortController();
+    const tagsRequest = fetch('tags.json', { signal: fallback.signal });
+    tagsRequest.catch(() => {});  // Rejects when aborted below
+
+    let data = await loadCompactTags(folderFilter);
+    if (data) {
+        fallback.abort();
+    } else {
+        const response = await tagsRequest;
+        data = await response.json();
+    }
 
     // Transform to array format with additional fields
     let photos = Object.entries(data).map(([id, info], index) => ({
@@ -14,13 +25,15 @@ export async function loadPhotoDatabase(folderFilter = null) {
         allTags: info.all_tags,
         colorPalette: info.color_palette || [{ r: 128, g: 128, b: 128, weight: 1.0 }],  // Array of dominant colors
         createdAt: info.created_at || '',  // Upload date from Cloudinary
+        similar: info.similar || [],  // Most similar photo ids (precomputed from CLIP embeddings)
+        duplicateOf: info.duplicate_of || null,  // Id of the near-identical photo whose tags this one reuses
 
         // Computed fields (filled by clustering)
         position2D: null,
         spherePosition: null,
-        aspectRatio: 1,  // Will be updated when image loads
-        width: 3,
-        height: 3
+        aspectRatio: info.aspect_ratio || 1,  // Recorded at tagging time, else updated when image loads
+        width: info.width || 3,
+        height: info.height || 3
     }));
 
     // Filter by folder if specified
@@ -28,12 +41,117 @@ export async function loadPhotoDatabase(folderFilter = null) {
         photos = photos.filter(photo => photo.folder === folderFilter);
     }
 
-    // Load actual dimensions for each photo
-    await Promise.all(photos.map(photo => loadPhotoDimensions(photo)));
+    // Only photos tagged before dimensions were recorded need a thumbnail fetch
+    const missingDimensions = photos.filter(photo => !(data[photo.id].width && data[photo.id].height));
+    await Promise.all(missingDimensions.map(photo => loadPhotoDimensions(photo)));
 
     return photos;
 }
 
+// Load the compact export written by `classify_cloudinary.py --compact`
+// Returns data in the same shape as tags.json, or null if there is no complete compact export
+async function loadCompactTags(folderFilter = null) {
+    let index;
+    try {
+        const response = await fetch('tags/index.json');
+        if (!response.ok) return null;
+        index = await response.json();
+    } catch (error) {
+        return null;
+    }
+
+    const shards = index.shards.filter(shard => !folderFilter || shard.folder === folderFilter);
+    let columns;
+    try {
+        columns = await Promise.all(shards.map(async shard => {
+            const response = await fetch(`tags/${shard.file}`);
+            if (!response.ok) throw new Error(`Missing shard ${shard.file}`);
+            return response.json();
+        }));
+    } catch (error) {
+        return null;
+    }
+
+    const data = {};
+    const decodeTags = ids => ids.map(id => index.tags[id]);
+
+    columns.forEach(shard => {
+        // Palettes are packed as uint8 (r, g, b, weight * 255), palette_colors slots per photo
+        const packed = Uint8Array.from(atob(shard.color_palette), c => c.charCodeAt(0));
+        const slots = index.palette_colors;
+
+        shard.ids.forEach((id, i) => {
+            const content = decodeTags(shard.content[i]);
+            const style = decodeTags(shard.style[i]);
+            const lighting = decodeTags(shard.lighting[i]);
+            const colors = decodeTags(shard.colors[i]);
+
+            const colorPalette = [];
+            for (let j = 0; j < slots; j++) {
+                const offset = (i * slots + j) * 4;
+                if (packed[offset + 3] === 0) continue;  // Padding slot
+                colorPalette.push({
+                    r: packed[offset],
+                    g: packed[offset + 1],
+                    b: packed[offset + 2],
+                    weight: packed[offset + 3] / 255
+                });
+            }
+
+            data[id] = {
+                url: shard.url[i],
+                folder: shard.folder,
+                created_at: shard.created_at[i],
+                content,
+                style,
+                lighting,
+                colors,
+                color_palette: colorPalette,
+                all_tags: [...content, ...style, ...lighting, ...colors],
+                width: shard.width[i],
+                height: shard.height[i],
+                aspect_ratio: shard.width[i] && shard.height[i] ? shard.width[i] / shard.height[i] : null,
+                similar: shard.similar[i],
+                duplicate_of: shard.duplicate_of[i]
+            };
+        });
+    });
+
+    return data;
+}
+
+// Load the texture atlases written by `classify_cloudinary.py --atlas`
+// Returns { rowHeight, photos: { photoId: { file, uv: [uMin, vMin, uMax, vMax] } } },
+// or null if there are no atlases
+export async function loadAtlasIndex(folderFilter = null) {
+    let index;
+    try {
+        const response = await fetch('atlases/index.json');
+        if (!response.ok) return null;
+        index = await response.json();
+    } catch (error) {
+        return null;
+    }
+
+    const folders = Object.entries(index.folders).filter(([folder]) => !folderFilter || folder === folderFilter);
+    const shards = await Promise.all(folders.map(async ([folder, info]) => {
+        const response = await fetch(`atlases/${info.file}`);
+        return response.ok ? response.json() : null;  // Photos of a missing shard load their own textures
+    }));
+
+    const photos = {};
+    shards.filter(shard => shard).forEach(shard => {
+        shard.ids.forEach((id, i) => {
+            photos[id] = {
+                file: `atlases/${shard.atlases[shard.atlas[i]].file}`,
+                uv: shard.uv[i]
+            };
+        });
+    });
+
+    return { rowHeight: index.row_height, photos };
+}
+
 // Load image dimensions to get aspect ratio
 async function loadPhotoDimensions(photo) {
     return new Promise((resolve) => {
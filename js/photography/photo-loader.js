@@ -1,11 +1,27 @@
 import * as THREE from 'three';
 import { getPhotoURL } from './photo-data.js';
 
+// UV rectangle covering a whole texture
+const FULL_UV = [0, 0, 1, 1];
+
+// Point a photo plane at a rectangle of its texture ([uMin, vMin, uMax, vMax], v up)
+function setUVRect(mesh, [uMin, vMin, uMax, vMax]) {
+    // PlaneGeometry vertex order: top-left, top-right, bottom-left, bottom-right
+    const uv = mesh.geometry.attributes.uv;
+    uv.setXY(0, uMin, vMax);
+    uv.setXY(1, uMax, vMax);
+    uv.setXY(2, uMin, vMin);
+    uv.setXY(3, uMax, vMin);
+    uv.needsUpdate = true;
+}
+
 // Lazy loading manager for photos
 export class PhotoLoader {
     constructor(camera, state) {
         this.camera = camera;
         this.state = state;
+        this.atlases = null; // { rowHeight, photos: photoId -> { file, uv } } from loadAtlasIndex, see setAtlases
+        this.atlasTextures = new Map(); // atlas file -> Promise of its texture, shared by all its photos
         this.loadedTextures = new Map(); // photoId -> texture
         this.loadingQueue = new Set();
         this.fadeAnimations = new Map(); // mesh -> { startTime, duration }
@@ -43,6 +59,83 @@ export class PhotoLoader {
                  photoMinY > viewportMaxY);
     }
 
+    /**
+     * Start the fade-in animation of a photo mesh
+     */
+    startFade(mesh) {
+        mesh.material.opacity = 0;
+        this.fadeAnimations.set(mesh, {
+            startTime: Date.now(),
+            duration: 850 // 850ms fade (0.85 seconds)
+        });
+    }
+
+    /**
+     * Use texture atlases for photos drawn small (zoomed-out views)
+     */
+    setAtlases(atlases) {
+        this.atlases = atlases;
+    }
+
+    /**
+     * Get the atlas rectangle of a photo mesh drawn no taller than its atlas thumbnail
+     * Returns null if the photo is drawn bigger, or isn't in an atlas
+     */
+    getAtlasEntry(mesh) {
+        if (!this.atlases) return null;
+
+        const pixelRatio = Math.min(window.devicePixelRatio, 2);  // Same cap as the renderer
+        const pixelsPerUnit = window.innerHeight * pixelRatio * this.state.zoom / 50;
+        if (mesh.userData.height * pixelsPerUnit > this.atlases.rowHeight) return null;
+
+        return this.atlases.photos[mesh.userData.photoId] || null;
+    }
+
+    /**
+     * Load an atlas page once; every photo on it shares the texture
+     */
+    getAtlasTexture(file) {
+        if (!this.atlasTextures.has(file)) {
+            this.atlasTextures.set(file, new Promise((resolve, reject) => {
+                new THREE.TextureLoader().load(file, (texture) => {
+                    texture.colorSpace = THREE.SRGBColorSpace;
+                    resolve(texture);
+                }, undefined, reject);
+            }));
+        }
+        return this.atlasTextures.get(file);
+    }
+
+    /**
+     * Draw a photo mesh from its atlas page (zoomed-out views)
+     */
+    loadAtlasTexture(mesh, { file, uv }) {
+        const photoId = mesh.userData.photoId;
+
+        // Already drawn from the atlas, or from its own sharper texture
+        if (mesh.userData.currentQuality || this.loadingQueue.has(photoId)) {
+            return;
+        }
+
+        this.loadingQueue.add(photoId);
+
+        this.getAtlasTexture(file).then((texture) => {
+            this.loadingQueue.delete(photoId);
+            if (mesh.userData.currentQuality) return;  // Own texture arrived first
+
+            setUVRect(mesh, uv);
+            mesh.material.map = texture;
+            mesh.material.color.setHex(0xffffff);  // Reset color to white
+            mesh.material.needsUpdate = true;
+            mesh.userData.currentQuality = 'atlas';
+            this.startFade(mesh);
+        }).catch((error) => {
+            console.error(`Failed to load atlas ${file}:`, error);
+            this.loadingQueue.delete(photoId);
+            delete this.atlases.photos[photoId];  // Fall back to the photo's own texture
+        });
+    }
+
     /**
      * Load texture for a photo mesh with fade-in animation
      */
@@ -68,8 +161,12 @@ export class PhotoLoader {
         textureLoader.load(
             url,
             (texture) => {
-                // Dispose old texture if exists
-                if (mesh.material.map) {
+                const previousQuality = mesh.userData.currentQuality;
+
+                // Dispose old texture if exists (atlas textures are shared and stay loaded)
+                if (previousQuality === 'atlas') {
+                    setUVRect(mesh, FULL_UV);
+                } else if (mesh.material.map) {
                     mesh.material.map.dispose();
                 }
 
@@ -82,12 +179,10 @@ export class PhotoLoader {
                 mesh.material.needsUpdate = true;
                 mesh.userData.currentQuality = 'medium';
 
-                // Start fade-in animation
-                mesh.material.opacity = 0;
-                this.fadeAnimations.set(mesh, {
-                    startTime: Date.now(),
-                    duration: 850 // 850ms fade (0.85 seconds)
-                });
+                // Start fade-in animation (no fade when replacing the atlas version)
+                if (!previousQuality) {
+                    this.startFade(mesh);
+                }
 
                 this.loadedTextures.set(photoId, texture);
                 this.loadingQueue.delete(photoId);
@@ -107,11 +202,15 @@ export class PhotoLoader {
         const photoId = mesh.userData.photoId;
 
         if (mesh.material.map) {
-            mesh.material.map.dispose();
+            if (mesh.userData.currentQuality === 'atlas') {
+                setUVRect(mesh, FULL_UV);  // The shared atlas texture stays loaded
+            } else {
+                mesh.material.map.dispose();
+                this.loadedTextures.delete(photoId);
+            }
             mesh.material.map = null;
             mesh.material.needsUpdate = true;
             mesh.userData.currentQuality = null;
-            this.loadedTextures.delete(photoId);
         }
     }
 
@@ -149,20 +248,30 @@ export class PhotoLoader {
         // Update fade animations
         this.updateFadeAnimations();
 
+        // Unload only beyond the view, however far out it is zoomed
+        const frustumWidth = 50 / this.state.zoom * window.innerWidth / window.innerHeight;
+        const farThreshold = Math.max(50, frustumWidth);
+
         // Check each photo
         photoMeshes.forEach(mesh => {
             const isVisible = this.isVisible(mesh);
 
             if (isVisible) {
-                // Load if visible (always full quality)
-                this.loadPhotoTexture(mesh);
+                // Small on screen: draw from a handful of atlas textures instead of one request per photo
+                const atlasEntry = this.getAtlasEntry(mesh);
+
+                if (atlasEntry) {
+                    this.loadAtlasTexture(mesh, atlasEntry);
+                } else {
+                    // Load if visible (medium quality when zoomed in)
+                    this.loadPhotoTexture(mesh);
+                }
             } else {
                 // Optionally unload if far from viewport to save memory
                 // Only unload if very far away
                 const position = mesh.position;
                 const distanceX = Math.abs(position.x - this.state.panX);
                 const distanceY = Math.abs(position.y - this.state.panY);
-                const farThreshold = 50; // Unload if more than 50 units away
 
                 if (distanceX > farThreshold || distanceY > farThreshold) {
                     this.unloadPhotoTexture(mesh);
@@ -177,6 +286,8 @@ export class PhotoLoader {
     dispose() {
         this.loadedTextures.forEach(texture => texture.dispose());
         this.loadedTextures.clear();
+        this.atlasTextures.forEach(promise => promise.then(texture => texture.dispose(), () => {}));
+        this.atlasTextures.clear();
         this.fadeAnimations.clear();
     }
 }
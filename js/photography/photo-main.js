@@ -1,7 +1,7 @@
 import * as THREE from 'three';
 import { initScene, scene, camera, renderer, state, photoMeshes } from './photo-scene.js';
 import { PhotoControls } from './photo-controls.js';
-import { loadPhotoDatabase } from './photo-data.js';
+import { loadPhotoDatabase, loadAtlasIndex } from './photo-data.js';
 import { clusterAndPositionPhotos } from './photo-clustering.js';
 import { createAllPhotoMeshes } from './photo-meshes.js';
 import { initPhotoInteractions, initLightboxHandlers } from './photo-interactions.js';
@@ -52,6 +52,16 @@ async function init() {
 
         photoLoader = new PhotoLoader(camera, state);
 
+        // With texture atlases to draw small photos from, zooming out goes as far as the whole layout
+        loadAtlasIndex().then(atlases => {
+            if (!atlases) return;
+            photoLoader.setAtlases(atlases);
+
+            const aspect = window.innerWidth / window.innerHeight;
+            const layoutZoom = 50 / Math.max(bounds.maxY - bounds.minY, (bounds.maxX - bounds.minX) / aspect);
+            state.minZoom = Math.min(state.minZoom, layoutZoom);
+        }).catch(error => console.error('Error loading texture atlases:', error));
+
         // Update UI
         document.getElementById('photo-counter').textContent = `${photos.length} photos`;
 
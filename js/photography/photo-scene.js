@@ -12,7 +12,7 @@ export const state = {
     panX: 0,
     panY: 0,
     zoom: 6,  // Start at medium zoom
-    minZoom: 5.7,  // Minimum zoom (limited to show ~4 photos at once)
+    minZoom: 5.7,  // Minimum zoom (limited to show ~4 photos at once, lowered when texture atlases exist)
     maxZoom: 15,  // Maximum zoom (much closer for detail)
 
     // Boundaries (will be set based on photo count)
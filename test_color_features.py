@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Color Feature Tests
+Checks the vectorized saturation in classify_cloudinary.py against the
+per-pixel colorsys loop it replaced
+"""
+
+from colorsys import rgb_to_hsv
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from classify_cloudinary import calculate_saturation, get_pixel_array
+
+# Largest allowed difference from the colorsys reference
+TOLERANCE = 1e-9
+
+def reference_saturation(image):
+    """Average saturation the way it was computed before vectorizing"""
+    img = image.copy()
+    img.thumbnail((150, 150))
+    pixels = np.array(img).reshape(-1, 3) / 255.0
+    saturations = []
+    for pixel in pixels:
+        _, s, _ = rgb_to_hsv(pixel[0], pixel[1], pixel[2])
+        saturations.append(s)
+    return np.mean(saturations)
+
+def synthetic_images():
+    """Small RGB test images covering black, gray and saturated pixels"""
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, 320, dtype=np.uint8)
+
+    yield "black", Image.new("RGB", (200, 120), (0, 0, 0))
+    yield "gray", Image.new("RGB", (200, 120), (128, 128, 128))
+    yield "white", Image.new("RGB", (64, 64), (255, 255, 255))
+    yield "red", Image.new("RGB", (64, 64), (255, 0, 0))
+    yield "gray ramp", Image.fromarray(np.stack([np.tile(gradient, (40, 1))] * 3, axis=-1))
+    yield "noise", Image.fromarray(rng.integers(0, 256, (240, 180, 3), dtype=np.uint8))
+
+    # Half black, half colored, so black pixels must count as 0, not be skipped
+    mixed = np.zeros((100, 100, 3), dtype=np.uint8)
+    mixed[:, 50:] = (200, 100, 50)
+    yield "half black", Image.fromarray(mixed)
+
+@pytest.mark.parametrize("name,image", list(synthetic_images()))
+def test_saturation_matches_colorsys(name, image):
+    expected = reference_saturation(image)
+    actual = calculate_saturation(get_pixel_array(image))
+    assert abs(actual - expected) <= TOLERANCE, f"{name}: {actual} != {expected}"
+
+def test_saturation_of_gray_and_black_is_zero():
+    assert calculate_saturation(get_pixel_array(Image.new("RGB", (32, 32), (0, 0, 0)))) == 0.0
+    assert calculate_saturation(get_pixel_array(Image.new("RGB", (32, 32), (90, 90, 90)))) == 0.0
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Compact Export Tests
+Checks the sharded tags export of classify_cloudinary.py: file names of
+nested folders, the folder to file mapping and pruning of removed folders
+"""
+
+import json
+import os
+
+import pytest
+
+from classify_cloudinary import export_compact, folder_file_stem
+
+def entry(folder, tags=("beach",)):
+    return {"url": "https://example.com/a.jpg", "folder": folder, "created_at": "", "width": 3, "height": 2,
+            "content": list(tags), "style": [], "lighting": [], "colors": [], "all_tags": list(tags),
+            "color_palette": [{"r": 10, "g": 20, "b": 30, "weight": 1.0}], "similar": [], "duplicate_of": None}
+
+@pytest.fixture
+def export_dir(tmp_path):
+    return str(tmp_path / "tags")
+
+def read_index(directory):
+    with open(os.path.join(directory, "index.json")) as f:
+        return json.load(f)
+
+def test_folder_file_stems_are_safe_and_distinct():
+    folders = ["portfolio", "portfolio/2024", "portfolio_2024", "../etc", "index", "été"]
+    stems = [folder_file_stem(folder) for folder in folders]
+
+    assert stems[0] == "portfolio"
+    assert stems[2] == "portfolio_2024"
+    assert len(set(stems)) == len(stems)
+    assert all("/" not in stem and "." not in stem and stem != "index" for stem in stems)
+
+def test_nested_folders_get_their_own_shard(export_dir):
+    export_compact({"portfolio/2024/a": entry("portfolio/2024"), "portfolio/b": entry("portfolio")}, export_dir)
+
+    shards = {shard["folder"]: shard["file"] for shard in read_index(export_dir)["shards"]}
+    assert set(shards) == {"portfolio/2024", "portfolio"}
+    for folder, file_name in shards.items():
+        with open(os.path.join(export_dir, file_name)) as f:
+            assert json.load(f)["folder"] == folder
+    assert sorted(os.listdir(export_dir)) == sorted(
+        [name for file_name in [*shards.values(), "index.json"] for name in (file_name, file_name + ".gz")])
+
+def test_shards_of_removed_folders_are_pruned(export_dir):
+    export_compact({"rugby/a": entry("rugby"), "portfolio/b": entry("portfolio")}, export_dir)
+    export_compact({"portfolio/b": entry("portfolio", ("sunset",))}, export_dir)
+
+    index = read_index(export_dir)
+    assert [shard["file"] for shard in index["shards"]] == ["portfolio.json"]
+    assert sorted(os.listdir(export_dir)) == ["index.json", "index.json.gz", "portfolio.json", "portfolio.json.gz"]
+    assert index["tags"] == ["sunset"]
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Image Decoding Tests
+Checks that photos are decoded upright, with their upright size, whatever
+EXIF orientation the camera wrote
+"""
+
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from classify_cloudinary import LocalSource, decode_image
+
+def sideways_jpeg(orientation, size=(1200, 600)):
+    """A landscape JPEG with a red left half, stored with the given EXIF orientation"""
+    image = Image.new("RGB", size, (0, 0, 255))
+    image.paste((255, 0, 0), (0, 0, size[0] // 2, size[1]))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", exif=exif)
+    return buffer.getvalue()
+
+@pytest.mark.parametrize("orientation, upright", [(1, (1200, 600)), (3, (1200, 600)), (6, (600, 1200)), (8, (600, 1200))])
+def test_decoded_photos_are_upright(orientation, upright):
+    image = decode_image(sideways_jpeg(orientation), min_side=200)
+
+    assert image.info["original_size"] == upright
+    assert (image.width > image.height) == (upright[0] > upright[1])
+    assert min(image.size) == 200
+
+def test_rotation_moves_the_pixels():
+    # Orientation 6 means the stored image is turned a quarter clockwise to display: left becomes top
+    image = decode_image(sideways_jpeg(6), min_side=200)
+
+    top, bottom = image.getpixel((100, 10)), image.getpixel((100, image.height - 10))
+    assert top[0] > 200 and top[2] < 60
+    assert bottom[2] > 200 and bottom[0] < 60
+
+def test_local_photos_report_their_upright_size(tmp_path):
+    (tmp_path / "portfolio").mkdir()
+    (tmp_path / "portfolio" / "portrait.jpg").write_bytes(sideways_jpeg(6))
+
+    source = LocalSource(str(tmp_path))
+    [img_data] = source.list_images(["portfolio"])
+    image, photo_date = source.fetch(img_data)
+
+    assert image.info["original_size"] == (600, 1200)
+    assert image.height > image.width
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Duplicate Detection Tests
+Checks the BK-tree and Deduplicator of classify_cloudinary.py, and what
+happens to duplicates when their original goes away
+"""
+
+import random
+
+import pytest
+
+from classify_cloudinary import (
+    BKTree, Deduplicator, clear_dangling_duplicates, hamming_distance, iter_changed
+)
+
+def random_hashes(count, seed=0):
+    """64-bit hashes in tight clusters, like bursts of near-identical frames"""
+    rng = random.Random(seed)
+    hashes = []
+    while len(hashes) < count:
+        center = rng.getrandbits(64)
+        for _ in range(rng.randint(1, 6)):
+            flips = sum(1 << bit for bit in rng.sample(range(64), rng.randint(0, 8)))
+            hashes.append(center ^ flips)
+    return hashes[:count]
+
+@pytest.mark.parametrize("radius", [0, 2, 4, 10])
+def test_bktree_search_matches_brute_force(radius):
+    hashes = random_hashes(500)
+    tree = BKTree()
+    for i, key in enumerate(hashes):
+        tree.add(key, i)
+    assert len(tree) == len(hashes)
+
+    for query in random_hashes(50, seed=1) + hashes[:50]:
+        found = tree.search(query, radius)
+        expected = sorted((hamming_distance(query, key), i) for i, key in enumerate(hashes)
+                          if hamming_distance(query, key) <= radius)
+
+        assert sorted(found) == expected
+        assert [distance for distance, value in found] == sorted(distance for distance, value in found)
+
+def test_equal_hashes_share_a_node():
+    tree = BKTree()
+    tree.add(0b1011, "a")
+    tree.add(0b1011, "b")
+    assert tree.search(0b1011, 0) == [(0, "a"), (0, "b")]
+
+def item(public_id, version=1):
+    return {"public_id": public_id, "url": f"https://example.com/{public_id}.jpg", "folder": "p",
+            "created_at": "", "dimensions": {"width": 3, "height": 2},
+            "fingerprint": {"version": version, "bytes": 1, "etag": None}}
+
+def tagged_entry(tags):
+    return {"content": tags, "style": [], "lighting": [], "colors": [], "color_palette": [], "all_tags": tags}
+
+def test_deduplicator_copies_the_original_once_it_is_tagged():
+    dedup = Deduplicator(distance=4)
+    dedup.add_original(0xFF00, "p/original")
+
+    original_id = dedup.find_original(0xFF01)
+    assert original_id == "p/original"
+    assert dedup.find_original(0x00FF) is None
+
+    dedup.add_duplicate(item("p/burst"), original_id)
+    finished, embeddings = {"p/original": tagged_entry(["beach"])}, {"p/original": (1, [0.1, 0.2], 0.5)}
+    dedup.resolve(finished, embeddings)
+
+    assert finished["p/burst"]["duplicate_of"] == "p/original"
+    assert finished["p/burst"]["all_tags"] == ["beach"]
+    assert embeddings["p/burst"] == (1, [0.1, 0.2], 0.5)
+    assert not dedup.waiting
+
+def listing(public_id, version=1):
+    return {"public_id": public_id, "url": f"https://example.com/v{version}/{public_id}.jpg",
+            "version": version, "bytes": 1, "etag": None}
+
+def stored(public_id, version=1, duplicate_of=None):
+    entry = {"url": f"https://example.com/v{version}/{public_id}.jpg", "version": version, "bytes": 1,
+             "etag": None, "folder": "p", "all_tags": ["beach"]}
+    if duplicate_of:
+        entry["duplicate_of"] = duplicate_of
+    return entry
+
+def run_incremental(existing, images):
+    unchanged = {}
+    changed = [img_data["public_id"] for img_data in iter_changed(images, existing, unchanged)]
+    return changed, unchanged
+
+def test_duplicate_of_a_deleted_original_is_tagged_again():
+    existing = {"p/original": stored("p/original"), "p/burst": stored("p/burst", duplicate_of="p/original")}
+
+    changed, unchanged = run_incremental(existing, [listing("p/burst")])
+
+    assert changed == ["p/burst"]
+    assert unchanged == {}
+
+def test_duplicate_of_a_changed_original_is_tagged_again():
+    existing = {"p/original": stored("p/original"), "p/burst": stored("p/burst", duplicate_of="p/original")}
+
+    # Listed before its original, so it is held until the listing ends
+    changed, unchanged = run_incremental(existing, [listing("p/burst"), listing("p/original", version=2)])
+
+    assert changed == ["p/original", "p/burst"]
+
+def test_duplicate_of_an_unchanged_original_is_kept():
+    existing = {"p/original": stored("p/original"), "p/burst": stored("p/burst", duplicate_of="p/original")}
+
+    changed, unchanged = run_incremental(existing, [listing("p/burst"), listing("p/original")])
+
+    assert changed == []
+    assert unchanged["p/burst"]["duplicate_of"] == "p/original"
+
+def test_dangling_duplicates_become_photos_of_their_own():
+    results = {
+        "a/burst": stored("a/burst", duplicate_of="b/deleted"),
+        "a/kept": stored("a/kept", duplicate_of="a/original"),
+        "a/original": stored("a/original")
+    }
+
+    assert clear_dangling_duplicates(results) == 1
+    assert "duplicate_of" not in results["a/burst"]
+    assert results["a/kept"]["duplicate_of"] == "a/original"
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+EXIF Date Tests
+Checks that capture dates are read from the original's header when it is a
+JPEG, and from the whole file for other formats
+"""
+
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import classify_cloudinary
+from classify_cloudinary import read_exif_date
+
+URL = "https://res.cloudinary.com/demo/image/upload/v1/photo"
+TAKEN = "2024:12:25 14:30:45"
+TAKEN_ISO = "2024-12-25T14:30:45"
+
+def encode(image_format, date=TAKEN, **params):
+    """A small image in image_format, with DateTime and DateTimeOriginal set when date is given"""
+    exif = Image.Exif()
+    if date:
+        exif[306] = date
+        exif.get_ifd(0x8769)[36867] = date
+    buffer = BytesIO()
+    Image.new("RGB", (64, 48), (200, 120, 40)).save(buffer, image_format, exif=exif, **params)
+    return buffer.getvalue()
+
+@pytest.fixture
+def original(monkeypatch):
+    """Serve one original over fake Range and full downloads, counting each kind"""
+    served = {"data": b"", "ranges": 0, "full": 0}
+
+    def read_header_bytes(url, size):
+        served["ranges"] += 1
+        return served["data"][:size]
+
+    def download_bytes(url, retries=3):
+        served["full"] += 1
+        return served["data"]
+
+    monkeypatch.setattr(classify_cloudinary, "read_header_bytes", read_header_bytes)
+    monkeypatch.setattr(classify_cloudinary, "download_bytes", download_bytes)
+    return served
+
+def test_jpeg_date_comes_from_the_header(original):
+    original["data"] = encode("JPEG")
+
+    assert read_exif_date(URL) == TAKEN_ISO
+    assert original["full"] == 0
+
+def test_jpeg_without_exif_is_not_downloaded_again(original):
+    original["data"] = encode("JPEG", date=None)
+
+    assert read_exif_date(URL) is None
+    assert original["full"] == 0
+
+def test_jpeg_exif_beyond_the_range_reads_falls_back(original):
+    # Large segments ahead of the EXIF, like an embedded ICC profile
+    data = encode("JPEG")
+    padding = b"".join(b"\xff\xe2" + (65535).to_bytes(2, "big") + b"\0" * 65533 for _ in range(4))
+    original["data"] = data[:2] + padding + data[2:]
+
+    assert read_exif_date(URL, header_bytes=1024) == TAKEN_ISO
+    assert original["full"] == 1
+
+@pytest.mark.parametrize("image_format", ["TIFF", "WEBP", "PNG"])
+def test_other_formats_fall_back_to_the_whole_file(original, image_format):
+    original["data"] = encode(image_format)
+
+    assert read_exif_date(URL) == TAKEN_ISO
+    assert original["full"] == 1
+
+def test_unreadable_format_has_no_date(original):
+    original["data"] = b"\0\0\0\x18ftypheic" + b"\0" * 100
+
+    assert read_exif_date(URL) is None
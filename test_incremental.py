@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Incremental Update Tests
+Checks how --incremental sorts listed assets and merges them into tags.json
+"""
+
+from classify_cloudinary import iter_changed, merge_incremental
+
+def listing(public_id, folder, version, etag="e"):
+    return {"public_id": public_id, "folder": folder, "url": f"https://example.com/v{version}/{public_id}.jpg",
+            "version": version, "bytes": 100, "etag": etag}
+
+def entry(public_id, folder, version, etag="e", tags=("old",)):
+    return {"folder": folder, "url": f"https://example.com/v{version}/{public_id}.jpg",
+            "version": version, "bytes": 100, "etag": etag, "all_tags": list(tags)}
+
+def test_iter_changed_splits_new_changed_and_unchanged():
+    existing = {
+        "p/same": entry("p/same", "p", 1),
+        "p/edited": entry("p/edited", "p", 1)
+    }
+    images = [listing("p/same", "p", 1), listing("p/edited", "p", 2), listing("p/new", "p", 1)]
+
+    unchanged = {}
+    changed = [img_data["public_id"] for img_data in iter_changed(images, existing, unchanged)]
+
+    assert changed == ["p/edited", "p/new"]
+    assert list(unchanged) == ["p/same"]
+    assert unchanged["p/same"]["all_tags"] == ["old"]
+
+def test_entries_without_fingerprint_compare_urls():
+    legacy = {"folder": "p", "url": "https://example.com/v1/p/a.jpg", "all_tags": []}
+
+    unchanged = {}
+    changed = list(iter_changed([listing("p/a", "p", 1)], {"p/a": legacy}, unchanged))
+    assert changed == [] and "p/a" in unchanged
+    # The stored fingerprint is filled in from the listing
+    assert unchanged["p/a"]["version"] == 1
+
+    unchanged = {}
+    changed = list(iter_changed([listing("p/a", "p", 2)], {"p/a": legacy}, unchanged))
+    assert [img_data["public_id"] for img_data in changed] == ["p/a"]
+
+def test_merge_keeps_unchanged_replaces_changed_and_drops_removed():
+    existing = {
+        "p/same": entry("p/same", "p", 1),
+        "p/edited": entry("p/edited", "p", 1),
+        "p/removed": entry("p/removed", "p", 1),
+        "q/other": entry("q/other", "q", 1)
+    }
+    images = [listing("p/same", "p", 1), listing("p/edited", "p", 2), listing("p/new", "p", 1)]
+    results = {
+        "p/same": existing["p/same"],
+        "p/edited": entry("p/edited", "p", 2, tags=("new",)),
+        "p/new": entry("p/new", "p", 1, tags=("new",))
+    }
+
+    merged = merge_incremental(existing, images, results, ["p"])
+
+    assert set(merged) == {"p/same", "p/edited", "p/new", "q/other"}
+    assert merged["p/edited"]["all_tags"] == ["new"]
+    assert merged["p/same"]["all_tags"] == ["old"]
+
+def test_merge_never_drops_folders_that_were_not_listed():
+    existing = {"q/other": entry("q/other", "q", 1), "p/removed": entry("p/removed", "p", 1)}
+
+    merged = merge_incremental(existing, [], {}, ["p"])
+
+    assert set(merged) == {"q/other"}
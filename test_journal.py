@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Results Journal Tests
+Checks that finished photos and their stored embeddings survive an
+interrupted run and are resumed, then pruned
+"""
+
+import json
+
+import numpy as np
+import pytest
+
+import classify_cloudinary
+from classify_cloudinary import (
+    EmbeddingStore, append_journal, load_journal, process_images_only, prune_journal, read_journal
+)
+
+def entry(version, folder="portfolio"):
+    return {"version": version, "folder": folder, "all_tags": ["sunset"]}
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    """Journal path in a temp directory, with a run's worth of finished photos and a torn last line"""
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / classify_cloudinary.JOURNAL_PATH
+    append_journal({"portfolio/a": entry(1), "portfolio/b": entry(1)}, str(path))
+    with open(path, "a") as f:
+        f.write(json.dumps({"public_id": "portfolio/c", "entry": entry(1)})[:25])  # Crash mid-write
+    return str(path)
+
+def test_torn_last_line_is_ignored(journal):
+    assert set(load_journal(journal)) == {"portfolio/a", "portfolio/b"}
+
+def test_append_after_torn_line_keeps_new_entries(journal):
+    append_journal({"portfolio/c": entry(1)}, journal)
+    assert set(load_journal(journal)) == {"portfolio/a", "portfolio/b", "portfolio/c"}
+
+def test_resume_reuses_journaled_photos_of_the_same_version(journal):
+    images = [
+        {"public_id": "portfolio/b", "version": 1, "folder": "portfolio"},
+        {"public_id": "portfolio/a", "version": 1, "folder": "portfolio"}
+    ]
+
+    results = process_images_only(images)
+
+    # Listing order, straight from the journal, nothing downloaded
+    assert list(results) == ["portfolio/b", "portfolio/a"]
+    assert results["portfolio/a"] == entry(1)
+
+def test_prune_keeps_photos_of_other_runs(journal):
+    append_journal({"rugby/x": entry(3, "rugby")}, journal)
+
+    prune_journal({"portfolio/a", "portfolio/b"}, journal)
+    assert set(load_journal(journal)) == {"rugby/x"}
+
+    prune_journal({"rugby/x"}, journal)
+    assert load_journal(journal) == {}
+
+def stored_batch(store, ids, rng):
+    """Put and flush a batch like save_batch, returning the store records journaled with it"""
+    for public_id in ids:
+        store.put(public_id, 1, rng.standard_normal(8), 0.5)
+    store.flush()
+    return {public_id: store.record(public_id) for public_id in ids}
+
+def test_store_index_is_rebuilt_from_the_journal(journal, tmp_path):
+    rng = np.random.default_rng(0)
+    store = EmbeddingStore(str(tmp_path / "embeddings"), model_name="test")
+    stored_batch(store, ["portfolio/a"], rng)
+    store.save()
+
+    # The next batch reaches the vectors file and the journal, then the run dies before the index is saved
+    stored = stored_batch(store, ["portfolio/b", "portfolio/c"], rng)
+    append_journal({public_id: entry(1) for public_id in stored}, journal, stored)
+    expected = store.get(["portfolio/b", "portfolio/c"])
+
+    reopened = EmbeddingStore(str(tmp_path / "embeddings"), model_name="test")
+    assert "portfolio/b" not in reopened
+
+    for public_id, record in read_journal(journal).items():
+        if "stored" in record:
+            reopened.restore(public_id, record["stored"])
+
+    assert set(reopened.ids) == {"portfolio/a", "portfolio/b", "portfolio/c"}
+    np.testing.assert_array_equal(reopened.get(["portfolio/b", "portfolio/c"]), expected)
+
+    # New photos go after the restored rows instead of overwriting them
+    stored_batch(reopened, ["portfolio/d"], rng)
+    assert reopened.ids["portfolio/d"]["row"] == 3
+
+def test_rows_of_a_replaced_vectors_file_are_not_restored(journal, tmp_path):
+    rng = np.random.default_rng(0)
+    store = EmbeddingStore(str(tmp_path / "embeddings"), model_name="test")
+    stored = stored_batch(store, ["portfolio/a", "portfolio/b"], rng)
+
+    # Another encoder starts the store over; the old journal lines point into the old file
+    other = EmbeddingStore(str(tmp_path / "embeddings"), model_name="other")
+    stored_batch(other, ["rugby/x"], rng)
+
+    assert not other.restore("portfolio/b", stored["portfolio/b"])
+    assert set(other.ids) == {"rugby/x"}
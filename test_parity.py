@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Quantization Parity Tests
+Runs the fp32/int8 parity check of classify_cloudinary.py on the tiny random encoder
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import classify_cloudinary
+
+@pytest.fixture
+def tiny_context(tmp_path, monkeypatch):
+    """Tiny encoder, label cache in a temp directory, and no GPU allowed"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(classify_cloudinary, "_label_features", {})
+    monkeypatch.setattr(classify_cloudinary, "_head_features", {})
+
+    def no_device():
+        raise AssertionError("parity must run on the CPU without picking a device")
+
+    monkeypatch.setattr(classify_cloudinary, "select_device", no_device)
+    classify_cloudinary.configure_context("tiny")
+    yield
+    classify_cloudinary.configure_context()
+
+def reference_images(count=6):
+    rng = np.random.default_rng(0)
+    return [(f"photo-{i}", Image.fromarray(rng.integers(0, 256, (80, 96, 3), dtype=np.uint8)))
+            for i in range(count)]
+
+def test_parity_report_on_tiny_encoder(tiny_context):
+    references = reference_images()
+    report = classify_cloudinary.check_quantized_parity(references, batch_size=4)
+
+    assert report["model"] == classify_cloudinary.TINY_MODEL_NAME
+    assert report["images"] == len(references)
+    assert set(report["heads"]) == {name for name, labels, top_k in classify_cloudinary.TAG_HEADS}
+    for scores in report["heads"].values():
+        for value in scores.values():
+            assert 0.0 <= value <= 1.0
+    assert report["images_per_second"]["fp32"] > 0
+    assert report["images_per_second"]["int8"] > 0
+    assert len(report["mismatches"]) <= len(references)
+
+def test_parity_label_features_stay_on_cpu(tiny_context):
+    classify_cloudinary.check_quantized_parity(reference_images(2), batch_size=2)
+
+    text_features, segments = classify_cloudinary.get_head_features()
+    assert text_features.device.type == "cpu"
+    assert classify_cloudinary.get_context().device == "cpu"
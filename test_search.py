@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Semantic Search Tests
+Checks the IVF-PQ search index of classify_cloudinary.py against an exact scan
+"""
+
+import numpy as np
+import pytest
+
+from classify_cloudinary import EmbeddingStore, SearchIndex
+
+PHOTOS = 3000
+DIM = 64
+K = 10
+
+@pytest.fixture(scope="module")
+def indexed_store(tmp_path_factory):
+    """A saved store of clustered, normalized embeddings and an index over it"""
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((40, DIM))
+    vectors = centers[rng.integers(0, len(centers), PHOTOS)] + 0.6 * rng.standard_normal((PHOTOS, DIM))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    store = EmbeddingStore(str(tmp_path_factory.mktemp("embeddings")), model_name="test")
+    ids = [f"photo-{i}" for i in range(PHOTOS)]
+    for public_id, vector in zip(ids, vectors):
+        store.put(public_id, 1, vector, 0.5)
+    store.save()
+
+    folders = ["even" if i % 2 == 0 else "odd" for i in range(PHOTOS)]
+    urls = [f"https://example.com/{public_id}.jpg" for public_id in ids]
+    index = SearchIndex.build(store, ids, folders, urls, key="test")
+    return store, index, rng
+
+def queries(store, rng, count=50):
+    """Noisy copies of stored embeddings, like text queries close to a few photos"""
+    vectors = np.asarray(store.vectors(), dtype=np.float32)
+    picked = vectors[rng.choice(len(vectors), count, replace=False)]
+    noisy = picked + 0.1 * rng.standard_normal(picked.shape)
+    return noisy / np.linalg.norm(noisy, axis=1, keepdims=True)
+
+def test_recall_against_exact_scan(indexed_store):
+    store, index, rng = indexed_store
+    vectors = store.vectors()
+    exact_scores = np.asarray(vectors, dtype=np.float32)
+
+    recalls = []
+    for query in queries(store, rng):
+        expected = set(np.argsort(-(exact_scores @ query))[:K])
+        found = {int(index.rows[position]) for position, score in index.search(query, vectors, k=K)}
+        recalls.append(len(expected & found) / K)
+
+    assert np.mean(recalls) >= 0.9
+
+def test_quantized_scores_alone_rank_well(indexed_store):
+    # With no more candidates re-scored than returned, the order comes from the PQ codes
+    store, index, rng = indexed_store
+    vectors = store.vectors()
+    exact_scores = np.asarray(vectors, dtype=np.float32)
+
+    recalls = []
+    for query in queries(store, rng):
+        expected = set(np.argsort(-(exact_scores @ query))[:K])
+        results = index.search(query, vectors, k=K, probes=8, rerank=K)
+        recalls.append(len(expected & {int(index.rows[position]) for position, score in results}) / K)
+
+    assert np.mean(recalls) >= 0.8
+
+def test_scores_are_exact_and_sorted(indexed_store):
+    store, index, rng = indexed_store
+    vectors = store.vectors()
+    query = queries(store, rng, 1)[0]
+
+    results = index.search(query, vectors, k=K)
+    scores = [score for position, score in results]
+
+    assert len(results) == K
+    assert scores == sorted(scores, reverse=True)
+    for position, score in results:
+        exact = np.asarray(vectors[index.rows[position]], dtype=np.float32) @ query
+        assert score == pytest.approx(float(exact), abs=1e-5)
+
+def test_folder_filter(indexed_store):
+    store, index, rng = indexed_store
+    query = queries(store, rng, 1)[0]
+
+    results = index.search(query, store.vectors(), k=K, folder="odd")
+
+    assert results
+    assert all(index.folders[position] == "odd" for position, score in results)
+    assert index.search(query, store.vectors(), k=K, folder="missing") == []
+
+def test_index_round_trips_through_save(indexed_store, tmp_path):
+    store, index, rng = indexed_store
+    query = queries(store, rng, 1)[0]
+    path = str(tmp_path / "search-index.npz")
+
+    index.save(path)
+    loaded = SearchIndex.load(path)
+
+    assert loaded.key == "test" and len(loaded) == PHOTOS
+    assert loaded.search(query, store.vectors()) == index.search(query, store.vectors())
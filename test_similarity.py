@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Similar Photo Tests
+Checks the blocked k-nearest-neighbour search of classify_cloudinary.py against brute force
+"""
+
+import numpy as np
+import pytest
+
+from classify_cloudinary import compute_neighbors
+
+def normalized_vectors(count, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def brute_force_neighbors(vectors, k):
+    """Top-k by cosine similarity from the full N x N matrix, excluding each photo itself"""
+    scores = vectors @ vectors.T
+    np.fill_diagonal(scores, -np.inf)
+    indices = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    return indices, np.take_along_axis(scores, indices, axis=1)
+
+# Block sizes below, equal to and above the row count, including one that doesn't divide it
+@pytest.mark.parametrize("block_size", [16, 64, 100, 1000])
+def test_blocked_neighbors_match_brute_force(block_size):
+    vectors = normalized_vectors(150)
+    indices, scores = compute_neighbors(vectors, k=5, block_size=block_size)
+    expected_indices, expected_scores = brute_force_neighbors(vectors, 5)
+
+    assert indices.shape == (150, 5)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+
+def test_neighbors_exclude_self_and_are_sorted():
+    vectors = normalized_vectors(40)
+    indices, scores = compute_neighbors(vectors, k=8, block_size=16)
+
+    assert not (indices == np.arange(40)[:, None]).any()
+    assert (np.diff(scores, axis=1) <= 0).all()
+
+def test_k_is_capped_by_the_number_of_other_photos():
+    indices, scores = compute_neighbors(normalized_vectors(4), k=10)
+    assert indices.shape == (4, 3)
+
+    indices, scores = compute_neighbors(normalized_vectors(1), k=10)
+    assert indices.shape == (1, 0)